@@ -0,0 +1,5 @@
+"""Benchmarks for the hot paths of main.py, runnable without network access.
+
+python -m benchmarks runs the whole suite against a local mock server and
+compares it with the stored baselines; see benchmarks/suite.py.
+"""
@@ -0,0 +1,90 @@
+"""Benchmark display_diff's diff engine against difflib on large files.
+
+Generates code-like files full of repeated lines (as in generated code),
+applies scattered edits, and times difflib.unified_diff against
+main.unified_diff. Both diffs are checked to rebuild the edited file.
+
+    python benchmarks/bench_diff.py
+    python benchmarks/bench_diff.py --lines 50000 --edits 200
+"""
+import argparse
+import difflib
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+
+import main  # noqa: E402
+
+
+def generate_file(lines, seed=0):
+    """Code-like text where most lines repeat: braces, blank lines, boilerplate."""
+    rng = random.Random(seed)
+    boilerplate = ["", "}", "    return None", "    pass", "        break", "# ---"]
+    text = []
+    for index in range(lines):
+        if rng.random() < 0.6:
+            text.append(rng.choice(boilerplate))
+        else:
+            text.append(f"    value_{index % 997} = compute({index % 31})")
+    return text
+
+
+def edit_file(lines, edits, seed=1):
+    rng = random.Random(seed)
+    edited = list(lines)
+    for _ in range(edits):
+        position = rng.randrange(len(edited))
+        choice = rng.random()
+        if choice < 0.4:
+            edited[position] = f"    changed_{position} = True"
+        elif choice < 0.7:
+            edited.insert(position, f"    inserted_{position}()")
+        else:
+            del edited[position]
+    return edited
+
+
+def rebuilds(a, b, opcodes):
+    rebuilt = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        rebuilt.extend(a[i1:i2] if tag == "equal" else b[j1:j2])
+    return rebuilt == b
+
+
+def timed(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lines", type=int, default=20000)
+    parser.add_argument("--edits", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    a = generate_file(args.lines)
+    b = edit_file(a, args.edits)
+    print(f"{args.lines:,} lines, {args.edits} edits")
+
+    difflib_time, difflib_lines = timed(
+        lambda: list(difflib.unified_diff(a, b, lineterm="", n=0)), args.repeat
+    )
+    fast_time, fast_lines = timed(lambda: list(main.unified_diff(a, b, n=0)), args.repeat)
+    assert rebuilds(a, b, main.diff_opcodes(a, b)), "diff_opcodes did not rebuild the edited file"
+
+    print(f"difflib    {difflib_time * 1000:>9.2f} ms  {len(difflib_lines):>6} diff lines")
+    print(f"unified    {fast_time * 1000:>9.2f} ms  {len(fast_lines):>6} diff lines")
+    print(f"speedup    {difflib_time / fast_time:.1f}x")
+
+
+if __name__ == "__main__":
+    main_cli()
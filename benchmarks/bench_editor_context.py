@@ -0,0 +1,89 @@
+"""Measure editor input tokens over a long /edit session for each EDITOR_CONTEXT.
+
+Runs the same session of /edit commands, cycling over a few files, against
+the local mock server once per editor context policy, and reports the input
+tokens of the first and last editor calls and the largest one. With "none"
+and "file" they stay flat; with "all" they grow with every edit.
+
+    python -m benchmarks.bench_editor_context
+    python -m benchmarks.bench_editor_context --edits 40 --files 4 --lines 300
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+
+import main  # noqa: E402
+from benchmarks.bench_diff import edit_file, generate_file  # noqa: E402
+from benchmarks.mock_server import MockServer  # noqa: E402
+
+
+def input_tokens(payload):
+    return sum(main.estimate_tokens(message) for message in payload["messages"])
+
+
+async def run_session(policy, args, scratch):
+    """Input tokens of every editor call in a session of args.edits edits."""
+    main.EDITOR_CONTEXT = policy
+    main.undo_store = main.UndoStore(os.path.join(scratch, f"undo-{policy}"))  # Keep the real one clean
+    paths = []
+    for index in range(args.files):
+        path = os.path.join(scratch, f"{policy}_{index}.py")
+        with open(path, "w") as f:
+            f.write("\n".join(generate_file(args.lines, seed=index)))
+        paths.append(path)
+
+    editor_tokens = []
+
+    def respond(payload):
+        if payload["model"] != main.EDITOR_MODEL:
+            return "1. Rename the helpers in the file."  # The planner
+        editor_tokens.append(input_tokens(payload))
+        original = payload["messages"][-1]["content"].split("Original code:", 1)[1].split("Instructions:", 1)[0]
+        return "\n".join(edit_file(original.strip("\n").split("\n"), 3, seed=len(editor_tokens)))
+
+    async with MockServer(respond=respond, chunk_size=4096) as server:
+        await main.close_http_client()
+        main.OPENROUTER_BASE_URL = server.base_url
+        default_chat_history = [{"role": "system", "content": main.SYSTEM_PROMPT}]
+        editor_chat_history = [{"role": "system", "content": main.EDITOR_PROMPT}]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for edit in range(args.edits):
+                path = paths[edit % len(paths)]
+                # Start every planner call from the same history, so only the editor grows
+                default_chat_history, editor_chat_history = await main.handle_edit_command(
+                    default_chat_history[:1], editor_chat_history, [path], "rename the helpers"
+                )
+    await main.close_http_client()
+    return editor_tokens
+
+
+async def run(args):
+    main.EDIT_MODE = "full"
+    main.EDIT_CONCURRENCY = 1
+    main.is_diff_on = False
+    print(f"{args.edits} edits over {args.files} files of {args.lines} lines, editor input tokens per call")
+    print(f"{'policy':<8} {'first':>9} {'last':>9} {'max':>9} {'total':>11}")
+    with tempfile.TemporaryDirectory() as scratch:
+        for policy in main.EDITOR_CONTEXTS:
+            tokens = await run_session(policy, args, scratch)
+            print(f"{policy:<8} {tokens[0]:>9,} {tokens[-1]:>9,} {max(tokens):>9,} {sum(tokens):>11,}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--edits", type=int, default=24)
+    parser.add_argument("--files", type=int, default=3)
+    parser.add_argument("--lines", type=int, default=200, help="Lines per file")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main_cli()
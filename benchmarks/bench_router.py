@@ -0,0 +1,100 @@
+"""Measure the model router against two local endpoints with different latencies.
+
+The first scenario checks routing: a fast and a slow endpoint, and which one
+ends up serving the requests. The second checks hedging: the preferred
+endpoint stalls on every fourth request, and requests are timed with hedging
+off and on.
+
+    python -m benchmarks.bench_router
+    python -m benchmarks.bench_router --requests 40 --hedge-ms 300
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+
+import main  # noqa: E402
+from benchmarks.mock_server import MockServer  # noqa: E402
+
+
+class StallingServer(MockServer):
+    """A mock endpoint whose first token takes stall_ms on every stall_every-th request."""
+
+    def __init__(self, stall_every, stall_ms, **kwargs):
+        super().__init__(**kwargs)
+        self.stall_every = stall_every
+        self.stall = stall_ms / 1000
+        self.usual_delay = self.first_token_delay
+
+    async def stream_reply(self, writer, payload):
+        stalled = self.requests % self.stall_every == 0
+        self.first_token_delay = self.stall if stalled else self.usual_delay
+        await super().stream_reply(writer, payload)
+
+
+async def time_requests(router, count):
+    payload = {"model": "bench/primary", "messages": [{"role": "user", "content": "hi"}], "stream": True}
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        async for _ in router.stream(payload, "plan"):
+            pass
+        times.append(time.perf_counter() - start)
+    return sorted(times)
+
+
+def describe(label, times):
+    p95 = times[min(len(times) - 1, int(len(times) * 0.95))]
+    print(f"  {label:<24} p50 {statistics.median(times) * 1000:>7.0f} ms   p95 {p95 * 1000:>7.0f} ms   "
+          f"max {times[-1] * 1000:>7.0f} ms")
+
+
+def print_routes(router):
+    for route in router.routes:
+        stats = router.stats[route]
+        print(f"  {main.route_label(route):<32} {stats['wins']:>3} wins  {stats['hedges']:>3} hedged")
+
+
+async def run(args):
+    mock = dict(tokens=400, reasoning_ratio=0.0, chunk_size=256)
+
+    print(f"Routing: {args.fast_ms:.0f} ms vs {args.slow_ms:.0f} ms to first token, {args.requests} requests")
+    async with MockServer(first_token_ms=args.fast_ms, **mock) as fast, \
+            MockServer(first_token_ms=args.slow_ms, **mock) as slow:
+        router = main.ModelRouter([f"bench/slow@{slow.base_url}", f"bench/fast@{fast.base_url}"], hedge_ms=0)
+        describe("routed", await time_requests(router, args.requests))
+        print_routes(router)
+    await main.close_http_client()
+
+    print(f"Hedging: primary stalls {args.stall_ms:.0f} ms every 4th request, backup {args.slow_ms:.0f} ms")
+    for hedge_ms in (0, args.hedge_ms):
+        async with StallingServer(4, args.stall_ms, first_token_ms=args.fast_ms, **mock) as primary, \
+                MockServer(first_token_ms=args.slow_ms, **mock) as backup:
+            router = main.ModelRouter(
+                [f"bench/primary@{primary.base_url}", f"bench/backup@{backup.base_url}"], hedge_ms=hedge_ms
+            )
+            await time_requests(router, 2)  # Unmeasured routes go first: one request each
+            times = await time_requests(router, args.requests)
+            describe(f"hedge after {hedge_ms:.0f} ms" if hedge_ms else "no hedging", times)
+            print_routes(router)
+        await main.close_http_client()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=20)
+    parser.add_argument("--fast-ms", type=float, default=50.0, help="First token delay of the fast endpoint")
+    parser.add_argument("--slow-ms", type=float, default=400.0, help="First token delay of the slow endpoint")
+    parser.add_argument("--stall-ms", type=float, default=2000.0, help="First token delay of a stalled request")
+    parser.add_argument("--hedge-ms", type=float, default=250.0, help="Hedge delay for the hedging scenario")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main_cli()
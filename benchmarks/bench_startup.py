@@ -0,0 +1,108 @@
+"""Measure cold start of the console: import, welcome screen and prompt session.
+
+Each run is a fresh interpreter that imports main, prints the welcome screen
+and builds the prompt session, which is everything before the first prompt.
+Time is measured inside the process so interpreter startup, which main.py
+can't change, is reported separately. So is the floor: importing
+prompt_toolkit and building a bare prompt session, which any console needs
+and which alone varies several-fold between machines. The exit code is 1
+when the median time over that floor is over --target milliseconds.
+
+    python -m benchmarks.bench_startup
+    python -m benchmarks.bench_startup --runs 20 --target 60 --imports
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+STARTUP_CODE = """
+import contextlib, io, time
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    import main
+    main.print_welcome_message()
+    main.print_files_and_searches_in_memory()
+    main.get_prompt_session()
+print((time.perf_counter() - start) * 1000)
+"""
+
+FLOOR_CODE = """
+import contextlib, io, time
+start = time.perf_counter()
+with contextlib.redirect_stdout(io.StringIO()):
+    from prompt_toolkit import PromptSession
+    PromptSession()
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+def run_python(code, *flags):
+    env = dict(os.environ, OPENROUTER_API_KEY=os.environ.get("OPENROUTER_API_KEY", "benchmark"))
+    return subprocess.run(
+        [sys.executable, *flags, "-c", code], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+
+
+def median_ms(code, runs):
+    return statistics.median(float(run_python(code).stdout.split()[-1]) for _ in range(runs))
+
+
+def interpreter_startup(runs):
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        run_python("pass")
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def slowest_imports(count):
+    """The direct imports of main that take longest, from python -X importtime."""
+    stderr = run_python("import main", "-X", "importtime").stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or line.count("|") != 2:
+            continue
+        _, cumulative, name = line.split("|")
+        if not name.startswith("  "):  # A top-level import; children are listed before it
+            if name.strip() == "main":
+                break
+            rows = []
+        elif not name.startswith("    "):
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=10)
+    parser.add_argument(
+        "--target", type=float, default=60.0, help="Median milliseconds allowed before the first prompt, over the floor"
+    )
+    parser.add_argument("--imports", action="store_true", help="Also list the slowest imports")
+    args = parser.parse_args()
+
+    run_python("import main")  # Write the bytecode cache first
+    times = sorted(float(run_python(STARTUP_CODE).stdout.split()[-1]) for _ in range(args.runs))
+    median = statistics.median(times)
+    floor = median_ms(FLOOR_CODE, args.runs)
+    print(f"interpreter startup   {interpreter_startup(args.runs):>8.1f} ms (not counted)")
+    print(f"prompt_toolkit floor  {floor:>8.1f} ms (not counted)")
+    print(f"to first prompt       {median:>8.1f} ms median, {times[0]:.1f} ms best, {times[-1]:.1f} ms worst")
+    print(f"over the floor        {median - floor:>8.1f} ms")
+    if args.imports:
+        for cumulative, name in slowest_imports(8):
+            print(f"  {name:<30} {cumulative / 1000:>8.1f} ms")
+    if median - floor > args.target:
+        print(f"⚠️ Over the {args.target:.0f} ms target")
+        sys.exit(1)
+    print(f"✅ Within the {args.target:.0f} ms target")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,120 @@
+"""Micro-benchmark for the SSE parsing and terminal rendering pipeline.
+
+Replays a recorded (or synthesized) chat completion stream through the old
+line-by-line parser and the current SSEDecoder + StreamRenderer, and reports
+tokens/sec for each. Rendering goes to an in-memory sink so the terminal does
+not skew the numbers.
+
+    python benchmarks/bench_stream.py
+    python benchmarks/bench_stream.py --file capture.sse --chunk-size 512
+"""
+import argparse
+import io
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+
+import main  # noqa: E402
+
+
+def record_stream(tokens, reasoning_ratio=0.5):
+    """Build raw SSE bytes shaped like an OpenRouter reasoning stream."""
+    events = []
+    reasoning_tokens = int(tokens * reasoning_ratio)
+    for i in range(tokens):
+        key = "reasoning" if i < reasoning_tokens else "content"
+        text = f"tok{i} " if i % 12 else f"line {i}\n"
+        events.append({"id": "gen-1", "choices": [{"index": 0, "delta": {key: text}}]})
+    body = "".join(f"data: {json.dumps(event)}\n\n" for event in events)
+    return (body + "data: [DONE]\n\n").encode("utf-8")
+
+
+def split_chunks(raw, chunk_size):
+    return [raw[i:i + chunk_size] for i in range(0, len(raw), chunk_size)]
+
+
+def legacy_pipeline(chunks, sink):
+    """The original requests.iter_lines / json.loads / += / print loop."""
+    full_response = ""
+    full_reasoning = ""
+    tokens = 0
+    for line in b"".join(chunks).split(b"\n"):
+        if not line:
+            continue
+        line = line.decode("utf-8")
+        if not line.startswith("data: "):
+            continue
+        if line == "data: [DONE]":
+            break
+        delta = json.loads(line[6:]).get("choices", [{}])[0].get("delta", {})
+        if delta.get("reasoning") is not None:
+            print(delta["reasoning"], end="", file=sink, flush=True)
+            full_reasoning += delta["reasoning"]
+        elif delta.get("content") is not None:
+            print(delta["content"], end="", file=sink, flush=True)
+            full_response += delta["content"]
+        tokens += 1
+    return tokens
+
+
+def current_pipeline(chunks, sink):
+    decoder = main.SSEDecoder()
+    renderer = main.StreamRenderer(stream=sink)
+    content_parts, reasoning_parts = [], []
+    tokens = 0
+    for data in chunks:
+        for event in decoder.feed(data):
+            delta = event.get("choices", [{}])[0].get("delta", {})
+            if delta.get("reasoning") is not None:
+                renderer.write(delta["reasoning"], main.Fore.CYAN)
+                reasoning_parts.append(delta["reasoning"])
+            elif delta.get("content") is not None:
+                renderer.write(delta["content"])
+                content_parts.append(delta["content"])
+            tokens += 1
+        if decoder.done:
+            break
+    renderer.close()
+    "".join(content_parts)
+    "".join(reasoning_parts)
+    return tokens
+
+
+def run(name, pipeline, chunks, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        sink = io.StringIO()
+        start = time.perf_counter()
+        tokens = pipeline(chunks, sink)
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<10} {tokens:>8} tokens  {best * 1000:>9.2f} ms  {tokens / best:>12,.0f} tokens/sec")
+    return tokens / best
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--file", help="Raw SSE capture to replay instead of a synthetic stream")
+    parser.add_argument("--tokens", type=int, default=50000, help="Tokens in the synthetic stream")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="Bytes per network read")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.file:
+        with open(args.file, "rb") as f:
+            raw = f.read()
+    else:
+        raw = record_stream(args.tokens)
+    chunks = split_chunks(raw, args.chunk_size)
+
+    print(f"json backend: {main.json_loads.__module__}, {len(raw):,} bytes in {len(chunks):,} chunks")
+    legacy = run("legacy", legacy_pipeline, chunks, args.repeat)
+    current = run("current", current_pipeline, chunks, args.repeat)
+    print(f"speedup    {current / legacy:.2f}x")
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,185 @@
+"""Local stand-in for an OpenAI-compatible chat completions endpoint.
+
+Streams SSE responses shaped like OpenRouter's, so the streaming, editing and
+batch code paths can be exercised without network access. A response is
+either a recorded raw SSE capture replayed as is, or synthesized from a text
+with a configurable share of reasoning tokens. Writes are split into
+chunk_size byte pieces with an optional delay before the first token and
+between tokens.
+
+    python -m benchmarks.mock_server --port 8765 --tokens 2000 --delay-ms 5
+    python -m benchmarks.mock_server --port 8766 --first-token-ms 800
+    OPENROUTER_BASE_URL=http://127.0.0.1:8765 python main.py
+"""
+import argparse
+import asyncio
+import json
+import re
+
+
+def synthesize_events(text=None, tokens=2000, reasoning_ratio=0.5, usage=True):
+    """SSE events for a reply: reasoning deltas first, then content deltas.
+
+    With text, the content is that text split into ~4 character tokens and
+    reasoning_ratio adds that share of extra reasoning tokens in front.
+    """
+    if text is None:
+        pieces = [f"tok{i} " if i % 12 else f"line {i}\n" for i in range(int(tokens * (1 - reasoning_ratio)))]
+    else:
+        pieces = re.findall(r"\s*\S{1,4}|\s+", text, re.DOTALL) or [text]
+    reasoning_tokens = int(len(pieces) * reasoning_ratio / (1 - reasoning_ratio)) if reasoning_ratio < 1 else tokens
+    events = [
+        {"id": "gen-mock", "choices": [{"index": 0, "delta": {"reasoning": f"think{i} "}}]}
+        for i in range(reasoning_tokens)
+    ]
+    events += [{"id": "gen-mock", "choices": [{"index": 0, "delta": {"content": piece}}]} for piece in pieces]
+    if usage:
+        events.append({
+            "id": "gen-mock",
+            "choices": [],
+            "usage": {
+                "prompt_tokens": 1000,
+                "completion_tokens": len(events),
+                "completion_tokens_details": {"reasoning_tokens": reasoning_tokens},
+                "prompt_tokens_details": {"cached_tokens": 0},
+            },
+        })
+    return events
+
+
+def encode_events(events):
+    return [f"data: {json.dumps(event)}\n\n".encode("utf-8") for event in events] + [b"data: [DONE]\n\n"]
+
+
+class MockServer:
+    """An asyncio HTTP/1.1 server answering POST /chat/completions with SSE.
+
+    respond(payload) may be set to choose the reply per request; it returns
+    the text to stream, or None for the default synthetic reply. capture is a
+    raw SSE recording replayed byte for byte instead.
+    """
+
+    def __init__(self, host="127.0.0.1", port=0, tokens=2000, reasoning_ratio=0.5,
+                 chunk_size=1024, delay_ms=0.0, capture=None, respond=None, first_token_ms=0.0):
+        self.host = host
+        self.port = port
+        self.tokens = tokens
+        self.reasoning_ratio = reasoning_ratio
+        self.chunk_size = chunk_size
+        self.delay = delay_ms / 1000
+        self.first_token_delay = first_token_ms / 1000
+        self.capture = capture
+        self.respond = respond
+        self.requests = 0
+        self.server = None
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}"
+
+    async def __aenter__(self):
+        self.server = await asyncio.start_server(self.handle, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1]
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.server.close()
+        await self.server.wait_closed()
+
+    def reply_pieces(self, payload):
+        if self.capture is not None:
+            return [self.capture]
+        text = self.respond(payload) if self.respond else None
+        ratio = 0.0 if text is not None else self.reasoning_ratio
+        return encode_events(synthesize_events(text, self.tokens, ratio))
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+                self.requests += 1
+                method, path, _ = request_line.decode("latin-1").split(" ", 2)
+                if method != "POST" or not path.endswith("/chat/completions"):
+                    writer.write(b"HTTP/1.1 404 Not Found\r\ncontent-length: 0\r\n\r\n")
+                    await writer.drain()
+                    continue
+                await self.stream_reply(writer, json.loads(body or b"{}"))
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass  # The client hung up, or the server is shutting down
+        finally:
+            writer.close()
+
+    async def stream_reply(self, writer, payload):
+        writer.write(
+            b"HTTP/1.1 200 OK\r\ncontent-type: text/event-stream\r\ntransfer-encoding: chunked\r\n\r\n"
+        )
+        await writer.drain()
+        if self.first_token_delay:
+            await asyncio.sleep(self.first_token_delay)
+        pending = b""
+        for piece in self.reply_pieces(payload):
+            if writer.is_closing():
+                return  # The client cancelled the request
+            pending += piece
+            while len(pending) >= self.chunk_size:
+                self.write_chunk(writer, pending[:self.chunk_size])
+                pending = pending[self.chunk_size:]
+            if self.delay:
+                await writer.drain()
+                await asyncio.sleep(self.delay)
+        if pending:
+            self.write_chunk(writer, pending)
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    @staticmethod
+    def write_chunk(writer, data):
+        writer.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+
+async def serve(args):
+    capture = None
+    if args.capture:
+        with open(args.capture, "rb") as f:
+            capture = f.read()
+    async with MockServer(
+        port=args.port,
+        tokens=args.tokens,
+        reasoning_ratio=args.reasoning_ratio,
+        chunk_size=args.chunk_size,
+        delay_ms=args.delay_ms,
+        first_token_ms=args.first_token_ms,
+        capture=capture,
+    ) as server:
+        print(f"Mock chat completions endpoint on {server.base_url} (Ctrl+C to stop)")
+        await asyncio.Event().wait()
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tokens", type=int, default=2000, help="Tokens per synthetic reply")
+    parser.add_argument("--reasoning-ratio", type=float, default=0.5, help="Share of reasoning tokens")
+    parser.add_argument("--chunk-size", type=int, default=1024, help="Bytes per network write")
+    parser.add_argument("--delay-ms", type=float, default=0.0, help="Delay between tokens")
+    parser.add_argument("--first-token-ms", type=float, default=0.0, help="Delay before the first token")
+    parser.add_argument("--capture", help="Raw SSE capture to replay for every request")
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main_cli()
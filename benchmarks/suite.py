@@ -0,0 +1,244 @@
+"""Benchmark the hot paths of main.py against a local mock server.
+
+Runs each benchmark a few times and keeps the best time, then once more under
+tracemalloc for peak memory. Each run is paired with a fixed calibration loop
+timed just before it, and scores are throughputs divided by the calibration
+speed, so they carry over between machines and across load changes. Scores and peak memory are compared against the stored baselines in
+benchmarks/baselines.json, and the exit code is 1 when a benchmark got slower
+or hungrier than its baseline allows.
+
+    python -m benchmarks
+    python -m benchmarks --only sse,diff --repeat 5
+    python -m benchmarks --save-baseline
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("OPENROUTER_API_KEY", "benchmark")
+
+import main  # noqa: E402
+from benchmarks.bench_diff import edit_file, generate_file  # noqa: E402
+from benchmarks.mock_server import MockServer  # noqa: E402
+
+BASELINES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+
+async def use_server(server):
+    """Point main's API client at the mock server."""
+    await main.close_http_client()
+    main.OPENROUTER_BASE_URL = server.base_url
+
+
+@contextlib.asynccontextmanager
+async def bench_sse(scratch):
+    """Chat replies through get_streaming_response: SSE parsing and rendering."""
+    async with MockServer(tokens=20000, reasoning_ratio=0.5, chunk_size=1024) as server:
+        await use_server(server)
+        messages = [{"role": "system", "content": main.SYSTEM_PROMPT}, {"role": "user", "content": "hi"}]
+
+        async def run():
+            await main.get_streaming_response(messages, main.DEFAULT_MODEL)
+            return server.tokens
+
+        yield "tokens/s", run, lambda: {"ttft_ms": round(main.metrics.records[-1]["ttft"] * 1000, 2)}
+
+
+@contextlib.asynccontextmanager
+async def bench_edit(scratch):
+    """Full-file editor streaming: line reassembly in stream_file_edit."""
+    lines = generate_file(5000)
+    content = "\n".join(lines)
+    edited = "\n".join(edit_file(lines, 50))
+    async with MockServer(respond=lambda payload: edited, chunk_size=1024) as server:
+        await use_server(server)
+        messages = [{"role": "system", "content": main.EDITOR_PROMPT}, {"role": "user", "content": "edit"}]
+
+        async def run():
+            result = await main.stream_file_edit(content, messages)
+            assert result.split("\n")[:len(edited.split("\n"))] == edited.split("\n")
+            return len(lines)
+
+        yield "lines/s", run, None
+
+
+@contextlib.asynccontextmanager
+async def bench_add(scratch):
+    """/add of a folder: walking, ignore rules, binary sniffing and reading."""
+    root = os.path.join(scratch, "tree")
+    rng = random.Random(0)
+    for package in range(40):
+        directory = os.path.join(root, f"pkg{package}", "sub")
+        os.makedirs(directory, exist_ok=True)
+        for module in range(50):
+            with open(os.path.join(directory, f"mod{module}.py"), "w") as f:
+                f.write("\n".join(f"def f{i}(x):\n    return x + {i}" for i in range(40)))
+        with open(os.path.join(directory, "blob.bin"), "wb") as f:
+            f.write(bytes(rng.randrange(256) for _ in range(4096)))
+    with open(os.path.join(root, ".gitignore"), "w") as f:
+        f.write("*.bin\n")
+
+    async def run():
+        return len(await main.ingest_directory(root))
+
+    yield "files/s", run, None
+
+
+@contextlib.asynccontextmanager
+async def bench_diff(scratch):
+    """display_diff on a 20,000-line file with scattered edits."""
+    original = "\n".join(generate_file(20000))
+    edited = "\n".join(edit_file(original.split("\n"), 200))
+
+    async def run():
+        main.display_diff(original, edited)
+        return 20000
+
+    yield "lines/s", run, None
+
+
+@contextlib.asynccontextmanager
+async def bench_image(scratch):
+    """/image encoding of a large local photo, without the on-disk cache."""
+    from PIL import Image
+
+    path = os.path.join(scratch, "photo.png")
+    Image.effect_noise((4000, 3000), 64).convert("RGB").save(path)
+    main.IMAGE_CACHE_DIR = os.path.join(scratch, "image-cache")
+
+    async def run():
+        # A fresh cache directory each time, so every run decodes and encodes
+        main.IMAGE_CACHE_DIR = tempfile.mkdtemp(dir=scratch)
+        main.prepare_image(path)
+        return 12  # Megapixels
+
+    yield "MP/s", run, None
+
+
+BENCHMARKS = {
+    "sse": bench_sse,
+    "edit": bench_edit,
+    "add": bench_add,
+    "diff": bench_diff,
+    "image": bench_image,
+}
+
+
+def calibrate(repeat=3):
+    """Millions of operations per second of a fixed pure-Python loop on this machine."""
+    words = [f"word{index}" for index in range(1000)]
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        counts = {}
+        for _ in range(100):
+            for word in words:
+                counts[word] = counts.get(word, 0) + len(word.upper())
+            "\n".join(words).split("\n")
+        best = min(best, time.perf_counter() - start)
+    return 100 * len(words) / best / 1e6
+
+
+async def measure(name, bench, repeat, scratch):
+    sink = io.StringIO()
+    async with bench(scratch) as (unit, run, extra):
+        with contextlib.redirect_stdout(sink):
+            best, score = float("inf"), 0
+            for _ in range(repeat):
+                speed = calibrate()
+                start = time.perf_counter()
+                work = await run()
+                elapsed = time.perf_counter() - start
+                best = min(best, elapsed)
+                score = max(score, work / elapsed / speed)
+            details = extra() if extra else {}
+            tracemalloc.start()
+            await run()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+    await main.close_http_client()
+    return {
+        "unit": unit,
+        "seconds": round(best, 4),
+        "throughput": round(work / best, 1),
+        "score": round(score, 2),  # Throughput per calibration Mop/s
+        "peak_mb": round(peak / 1024 / 1024, 2),
+        **details,
+    }
+
+
+def compare(result, baseline, tolerance):
+    """Return the regressions of result against its baseline."""
+    if not baseline:
+        return []
+    problems = []
+    if result["score"] < baseline["score"] * (1 - tolerance):
+        problems.append(f"score {result['score']:,.2f} < baseline {baseline['score']:,.2f}")
+    if result["peak_mb"] > baseline["peak_mb"] * (1 + tolerance) + 1:
+        problems.append(f"peak memory {result['peak_mb']} MB > baseline {baseline['peak_mb']} MB")
+    return problems
+
+
+async def run_suite(names, repeat, tolerance, save_baseline):
+    try:
+        with open(BASELINES_PATH) as f:
+            baselines = json.load(f)
+    except FileNotFoundError:
+        baselines = {}
+
+    results, regressions = {}, []
+    print(f"{'benchmark':<10} {'throughput':>16} {'score':>12} {'best':>10} {'peak':>10}  vs baseline")
+    with tempfile.TemporaryDirectory() as scratch:
+        for name in names:
+            result = await measure(name, BENCHMARKS[name], repeat, scratch)
+            results[name] = result
+            baseline = baselines.get(name)
+            if baseline and "score" not in baseline:
+                baseline = None  # Saved before scores, not comparable
+            problems = compare(result, baseline, tolerance)
+            regressions.extend(f"{name}: {problem}" for problem in problems)
+            change = f"{result['score'] / baseline['score'] - 1:+.0%}" if baseline else "no baseline"
+            print(
+                f"{name:<10} {result['throughput']:>10,.0f} {result['unit']:<5} {result['score']:>12,.2f} "
+                f"{result['seconds'] * 1000:>8.1f}ms "
+                f"{result['peak_mb']:>7.1f} MB  {change}{'  ⚠️' if problems else ''}"
+            )
+
+    if save_baseline:
+        baselines.update(results)
+        with open(BASELINES_PATH, "w") as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Saved baselines for {', '.join(results)} to {BASELINES_PATH}")
+        return 0
+    for regression in regressions:
+        print(f"⚠️ {regression}")
+    return 1 if regressions else 0
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--only", help=f"Comma-separated benchmarks to run, from {', '.join(BENCHMARKS)}")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--tolerance", type=float, default=0.3, help="Allowed slowdown or memory growth, as a fraction")
+    parser.add_argument("--save-baseline", action="store_true", help="Store these results as the new baselines")
+    args = parser.parse_args()
+
+    names = args.only.split(",") if args.only else list(BENCHMARKS)
+    unknown = [name for name in names if name not in BENCHMARKS]
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(unknown)}")
+    sys.exit(asyncio.run(run_suite(names, args.repeat, args.tolerance, args.save_baseline)))
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -1,37 +1,204 @@
 import os
-from openai import OpenAI
 import sys
+import argparse
 from dotenv import load_dotenv
 from colorama import init, Fore, Back, Style
 import difflib
 import asyncio
-from duckduckgo_search import DDGS
 import json
-from pygments import highlight
-from pygments.lexers import get_lexer_by_name
-from pygments.formatters import TerminalFormatter
-from rich.console import Console
-from rich.table import Table
+import random
+import re
+import time
 import base64
+import gzip
+import zlib
+from datetime import datetime
+import hashlib
+import bisect
+import importlib
+import math
+import functools
+import sqlite3
+import mmap
+import shutil
+import contextvars
+import contextlib
+from collections import Counter, OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-import requests
-from PIL import Image
-from io import BytesIO
+from io import BytesIO, StringIO
 from prompt_toolkit import PromptSession
 from prompt_toolkit.history import FileHistory
 from prompt_toolkit.auto_suggest import AutoSuggestFromHistory
 from prompt_toolkit.formatted_text import HTML
 from prompt_toolkit.completion import WordCompleter
 from prompt_toolkit.application.current import get_app
+from prompt_toolkit.application import run_in_terminal
+
+class LazyImport:
+    """A module, or a name in a module, imported the first time it is used.
+
+    Keeps heavy dependencies that only some commands need (the HTTP client,
+    image decoding, search, highlighting, tables) out of startup.
+    """
+
+    def __init__(self, module, name=None):
+        self.module = module
+        self.name = name
+        self.target = None
+
+    def resolve(self):
+        if self.target is None:
+            module = importlib.import_module(self.module)
+            self.target = getattr(module, self.name) if self.name else module
+        return self.target
+
+    def __getattr__(self, attr):
+        return getattr(self.resolve(), attr)
+
+    def __call__(self, *args, **kwargs):
+        return self.resolve()(*args, **kwargs)
+
+httpx = LazyImport("httpx")
+Image = LazyImport("PIL.Image")
+DDGS = LazyImport("duckduckgo_search", "DDGS")
+highlight = LazyImport("pygments", "highlight")
+get_lexer_by_name = LazyImport("pygments.lexers", "get_lexer_by_name")
+guess_lexer_for_filename = LazyImport("pygments.lexers", "guess_lexer_for_filename")
+TerminalFormatter = LazyImport("pygments.formatters", "TerminalFormatter")
+Console = LazyImport("rich.console", "Console")
+Table = LazyImport("rich.table", "Table")
+Progress = LazyImport("rich.progress", "Progress")
+TextColumn = LazyImport("rich.progress", "TextColumn")
+BarColumn = LazyImport("rich.progress", "BarColumn")
+MofNCompleteColumn = LazyImport("rich.progress", "MofNCompleteColumn")
+TimeElapsedColumn = LazyImport("rich.progress", "TimeElapsedColumn")
+
+try:
+    import orjson  # Optional, much faster JSON decoding for SSE chunks
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
 
 is_diff_on = True
+is_live_diff_on = False  # /diff live: show hunks while the editor streams
+is_quiet_on = False
+is_rag_on = False
+is_response_cache_on = os.getenv("RESPONSE_CACHE", "false").lower() in ("1", "true", "yes")
 
 init(autoreset=True)
 load_dotenv()
-client = OpenAI(
-    base_url="https://openrouter.ai/api/v1",
-    api_key=os.getenv("OPENROUTER_API_KEY"),
-)
+
+# Any OpenAI-compatible endpoint works here, e.g. a local stand-in server
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+# Maximum number of files the editor model works on at once during /edit
+EDIT_CONCURRENCY = int(os.getenv("EDIT_CONCURRENCY", "4"))
+# Optional router for chat and planner requests over comma-separated "model" or
+# "model@base_url" routes: the fastest healthy one is used, measured over the
+# last ROUTER_WINDOW requests. ROUTER_HEDGE_MS > 0 also sends a request to the
+# next route when no token arrived in that time; failing routes sit out
+# ROUTER_COOLDOWN seconds
+MODEL_ROUTES = [route.strip() for route in os.getenv("MODEL_ROUTES", "").split(",") if route.strip()]
+ROUTER_WINDOW = int(os.getenv("ROUTER_WINDOW", "20"))
+ROUTER_HEDGE_MS = float(os.getenv("ROUTER_HEDGE_MS", "0"))
+ROUTER_COOLDOWN = float(os.getenv("ROUTER_COOLDOWN", "30"))
+# Per-call metrics shown by /stats: how many are kept in memory, and optional
+# exports as JSONL (appended) or a Prometheus textfile (rewritten)
+METRICS_BUFFER = int(os.getenv("METRICS_BUFFER", "1000"))
+METRICS_JSONL = os.getenv("METRICS_JSONL", "")
+METRICS_PROM = os.getenv("METRICS_PROM", "")
+# Where /stats export writes each format when no path is given
+METRICS_EXPORT_PATHS = {"jsonl": "omni_metrics.jsonl", "prom": "omni_metrics.prom"}
+# Headless batch mode (python main.py --batch jobs.jsonl): jobs run at once,
+# retries per model call, and the base and cap of the retry backoff in seconds
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_RETRIES = int(os.getenv("BATCH_RETRIES", "4"))
+BATCH_BACKOFF = float(os.getenv("BATCH_BACKOFF", "1"))
+BATCH_BACKOFF_MAX = float(os.getenv("BATCH_BACKOFF_MAX", "60"))
+BATCH_REPORT_PATH = "batch_report.jsonl"  # Default for --report
+# Opt-in on-disk cache of model responses, see /cache
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH", ".omni_cache.sqlite")
+RESPONSE_CACHE_MAX_MB = float(os.getenv("RESPONSE_CACHE_MAX_MB", "200"))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", str(7 * 24 * 3600)))
+# Provider prompt caching: "auto" marks cache breakpoints for models that need
+# them (Anthropic and Gemini via OpenRouter), "on" for every model, "off" never
+PROMPT_CACHE = os.getenv("PROMPT_CACHE", "auto").lower()
+PROMPT_CACHE_MODELS = ("anthropic/", "google/gemini")
+PROMPT_CACHE_MIN_TOKENS = int(os.getenv("PROMPT_CACHE_MIN_TOKENS", "1024"))
+PROMPT_CACHE_BREAKPOINTS = 4  # Most a request may carry on Anthropic
+# /search: results fetched and shown per query, and how long they are cached on disk
+SEARCH_RESULTS = int(os.getenv("SEARCH_RESULTS", "8"))
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "100"))
+SEARCH_CACHE_PATH = os.getenv("SEARCH_CACHE_PATH", ".omni_search_cache.sqlite")
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL", str(24 * 3600)))
+# Optional "module:function" async search backend, e.g. a local fake for benchmarks
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "")
+# /image: local images are downscaled and recompressed before being sent
+IMAGE_MAX_DIMENSION = int(os.getenv("IMAGE_MAX_DIMENSION", "1568"))
+IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "webp").lower()
+IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", ".omni_image_cache")
+# Image URLs are checked in parallel with small HEAD/Range requests
+IMAGE_URL_CONCURRENCY = int(os.getenv("IMAGE_URL_CONCURRENCY", "8"))
+IMAGE_URL_TIMEOUT = float(os.getenv("IMAGE_URL_TIMEOUT", "10"))
+IMAGE_URL_CACHE_TTL = 300
+# Sessions are journaled here as they happen, see /save and /load
+SESSIONS_DIR = os.getenv("SESSIONS_DIR", ".omni_sessions")
+SESSION_BLOB_THRESHOLD = int(os.getenv("SESSION_BLOB_THRESHOLD", "2048"))
+# How many blobs of a resumed session are kept decoded in memory
+SESSION_BLOB_CACHE = int(os.getenv("SESSION_BLOB_CACHE", "16"))
+# Undo/redo patches are kept on disk, with at most UNDO_CACHE_MB of them cached in memory
+UNDO_DIR = os.getenv("UNDO_DIR", ".omni_undo")
+UNDO_CACHE_MB = float(os.getenv("UNDO_CACHE_MB", "8"))
+# Prompt token budget per model family, CONTEXT_BUDGET overrides it for every model
+MODEL_CONTEXT_BUDGETS = {
+    "anthropic": 150000,
+    "google": 800000,
+    "openai": 100000,
+}
+DEFAULT_CONTEXT_BUDGET = 100000
+CONTEXT_BUDGET = int(os.getenv("CONTEXT_BUDGET", "0"))
+# Summarize evicted turns with the editor model instead of dropping them
+CONTEXT_SUMMARIZE = os.getenv("CONTEXT_SUMMARIZE", "false").lower() in ("1", "true", "yes")
+CONTEXT_SUMMARY_TOKENS = 1000
+CONTEXT_SUMMARY_CACHE = 64  # Summaries of evicted turns kept for reuse
+IMAGE_TOKEN_ESTIMATE = 1500
+# "replace" resends changed /add-ed files in full, "diff" sends a diff against the version the model saw
+FILE_REFRESH_MODE = os.getenv("FILE_REFRESH_MODE", "replace")
+# Limits for adding whole folders with /add
+ADD_MAX_FILE_SIZE = int(os.getenv("ADD_MAX_FILE_SIZE", str(1024 * 1024)))
+ADD_WORKERS = int(os.getenv("ADD_WORKERS", "16"))
+ALWAYS_IGNORED_DIRS = {".git", ".hg", ".svn"}
+COMMAND_HISTORY_PATH = ".aiconsole_history.txt"
+# Local BM25 code index used by /rag to attach relevant chunks to each prompt
+INDEX_PATH = os.getenv("INDEX_PATH", ".omni_index.sqlite")
+INDEX_CHUNK_LINES = int(os.getenv("INDEX_CHUNK_LINES", "40"))
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "8"))
+# "full" regenerates whole files, "patch" asks the editor for SEARCH/REPLACE blocks,
+# "region" sends only the line ranges the instructions refer to
+EDIT_MODE = os.getenv("EDIT_MODE", "full")
+EDIT_MODES = ["full", "patch", "region"]
+# Minimum similarity for a SEARCH block to match lines that differ slightly
+PATCH_FUZZ_THRESHOLD = float(os.getenv("PATCH_FUZZ_THRESHOLD", "0.85"))
+# Lines of context around each region, and the share of the file above which
+# region mode just regenerates the whole file
+REGION_CONTEXT_LINES = int(os.getenv("REGION_CONTEXT_LINES", "5"))
+REGION_MAX_FRACTION = float(os.getenv("REGION_MAX_FRACTION", "0.6"))
+REGION_MAX_BLOCK_LINES = int(os.getenv("REGION_MAX_BLOCK_LINES", "200"))
+# What earlier edits the editor model sees: "none" edits each file in an isolated
+# call, "file" adds the last EDITOR_CONTEXT_EDITS edits of the same file, "all"
+# resends every earlier edit of the session
+EDITOR_CONTEXT = os.getenv("EDITOR_CONTEXT", "none")
+EDITOR_CONTEXTS = ["none", "file", "all"]
+EDITOR_CONTEXT_EDITS = int(os.getenv("EDITOR_CONTEXT_EDITS", "2"))
+# /show pages through files; 0 fits a page to the terminal height
+SHOW_PAGE_LINES = int(os.getenv("SHOW_PAGE_LINES", "0"))
+SHOW_HIGHLIGHT = os.getenv("SHOW_HIGHLIGHT", "true").lower() in ("1", "true", "yes")
+# How many times per second streamed text is flushed to the terminal
+RENDER_FPS = int(os.getenv("RENDER_FPS", "30"))
+http_clients = {}  # One pooled client per API endpoint
+fetch_client = None
 
 DEFAULT_MODEL = "anthropic/claude-3.7-sonnet:thinking"
 EDITOR_MODEL = "google/gemini-2.0-flash-001"
@@ -68,68 +235,189 @@ ULTRA IMPORTANT:
 - Never change imports or function definitions unless explicitly instructed
 - If you spot potential issues in the instructions, fix them!"""
 
-added_files = []
+PATCH_EDITOR_PROMPT = """You are a code-editing AI. Your mission:
+
+- Execute the edit instructions safely
+- Output ONLY SEARCH/REPLACE blocks, never the whole file
+- Each block has this exact format:
+<<<<<<< SEARCH
+lines copied exactly from the original code
+=======
+the new lines that replace them
+>>>>>>> REPLACE
+- The SEARCH part must match the original code exactly, including indentation
+- Include just enough lines in SEARCH to make the match unique
+- Use an empty SEARCH part to append lines at the end of the file
+- Use several small blocks rather than one large block
+- If nothing needs to change, output nothing
+- NEVER!!! wrap the blocks in ``` fences or add explanations
+- If you spot potential issues in the instructions, fix them!"""
+
+REGION_EDITOR_PROMPT = """You are a code-editing AI. Your mission:
+
+- You get only some regions of a file, each between a "### REGION n" line and a "### END" line
+- Execute the edit instructions safely on those regions
+- Output every region you change in the same format, rewritten in full:
+### REGION n
+the complete new lines of region n
+### END
+- Leave out regions that don't need to change
+- To add lines at the end of the file, use "### APPEND" instead of "### REGION n"
+- Keep the indentation of the original code
+- NEVER!!! wrap the regions in ``` fences or add explanations
+- If you spot potential issues in the instructions, fix them!"""
+
 stored_searches = {}
 file_templates = {
     "python": "def main():\n    pass\n\nif __name__ == \"__main__\":\n    main()",
     "html": "<!DOCTYPE html>\n<html lang=\"en\">\n<head>\n    <meta charset=\"UTF-8\">\n    <meta name=\"viewport\" content=\"width=device-width, initial-scale=1.0\">\n    <title>Document</title>\n</head>\n<body>\n    \n</body>\n</html>",
     "javascript": "// Your JavaScript code here"
 }
-undo_history = {}
 stored_images = {}
-command_history = FileHistory('.aiconsole_history.txt')
-commands = WordCompleter(['/add', '/edit', '/new', '/search', '/image', '/clear', '/reset', '/diff', '/history', '/save', '/load', '/undo', '/help', '/model', '/change_model', '/show', 'exit'], ignore_case=True)
-session = PromptSession(history=command_history)
+command_history = FileHistory(COMMAND_HISTORY_PATH)
+commands = WordCompleter(['/add', '/edit', '/new', '/search', '/image', '/index', '/rag', '/cache', '/stats', '/clear', '/reset', '/diff', '/quiet', '/edit_mode', '/editor_context', '/history', '/context', '/pin', '/unpin', '/save', '/load', '/undo', '/redo', '/help', '/model', '/change_model', '/show', '/bg', '/jobs', '/wait', '/cancel', 'exit'], ignore_case=True)
+session = None
+
+def get_prompt_session():
+    """Return the one prompt session, with its history and completion, creating it on first use."""
+    global session
+    if session is None:
+        session = PromptSession(
+            history=command_history,
+            auto_suggest=AutoSuggestFromHistory(),
+            completer=commands,
+            refresh_interval=0.5,
+        )
+    return session
 
 async def get_input_async(message):
-    session = PromptSession()
-    result = await session.prompt_async(HTML(f"<ansired>{message}</ansired> "),
-        auto_suggest=AutoSuggestFromHistory(),
-        completer=commands,
-        refresh_interval=0.5)
+    result = await get_prompt_session().prompt_async(HTML(f"<ansired>{message}</ansired> "))
     return result.strip()
 
-def encode_image(image_path):
-    """Turn a local image into base64."""
+def prepare_image(image_path):
+    """Decode a local image once, downscale and recompress it, and return a data URI.
+
+    Results are cached on disk by content hash and settings, so re-adding the
+    same image skips decoding. Returns (data_uri, original_size).
+    """
+    with open(image_path, "rb") as image_file:
+        data = image_file.read()
+
+    digest = hashlib.sha256(data).hexdigest()
+    cache_key = f"{digest}-{IMAGE_MAX_DIMENSION}-{IMAGE_FORMAT}-{IMAGE_QUALITY}"
+    cache_path = os.path.join(IMAGE_CACHE_DIR, cache_key + ".txt")
     try:
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
-    except FileNotFoundError:
-        return None
+        with open(cache_path, "r") as f:
+            return f.read(), len(data)
     except IOError:
-        return None
+        pass
+
+    with Image.open(BytesIO(data)) as img:
+        img_format = img.format.lower() if img.format else None
+        if img_format not in ['jpeg', 'jpg', 'png', 'webp', 'gif']:
+            raise ValueError(f"Unsupported image format: {img_format}")
 
-def validate_image_url(url, timeout=10):
+        if max(img.size) <= IMAGE_MAX_DIMENSION and len(data) <= 256 * 1024:
+            # Already small, recompressing would only lose quality
+            encoded, mime = data, img_format
+        else:
+            img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+            output_format = "jpeg" if IMAGE_FORMAT in ("jpg", "jpeg") else "webp"
+            has_alpha = img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info)
+            if output_format == "jpeg" or not has_alpha:
+                img = img.convert("RGB")
+            elif img.mode != "RGBA":
+                img = img.convert("RGBA")
+            buffer = BytesIO()
+            img.save(buffer, format=output_format.upper(), quality=IMAGE_QUALITY)
+            encoded, mime = buffer.getvalue(), output_format
+            if len(encoded) >= len(data):
+                encoded, mime = data, img_format
+
+    data_uri = f"data:image/{mime};base64,{base64.b64encode(encoded).decode('utf-8')}"
     try:
-        response = requests.get(
-            url,
-            stream=True,
-            timeout=timeout,
-            headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.28 Safari/537.36'}
+        os.makedirs(IMAGE_CACHE_DIR, exist_ok=True)
+        with open(cache_path, "w") as f:
+            f.write(data_uri)
+    except IOError:
+        pass  # The cache is only an optimization
+    return data_uri, len(data)
+
+def get_fetch_client():
+    """Pooled client for third-party URLs, kept apart so the API key is never sent there."""
+    global fetch_client
+    if fetch_client is None:
+        fetch_client = httpx.AsyncClient(
+            http2=True,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=IMAGE_URL_CONCURRENCY),
+            headers={'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.28 Safari/537.36'},
         )
-        response.raise_for_status()
+    return fetch_client
+
+def sniff_image(data):
+    """Recognize PNG, JPEG, GIF and WebP files from their first bytes."""
+    return (
+        data.startswith((b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff", b"GIF87a", b"GIF89a"))
+        or (data[:4] == b"RIFF" and data[8:12] == b"WEBP")
+    )
+
+validated_image_urls = {}
 
+async def validate_image_url(url, timeout=None):
+    """Check that a URL serves an image without downloading the whole body."""
+    cached = validated_image_urls.get(url)
+    if cached and time.monotonic() - cached[0] < IMAGE_URL_CACHE_TTL:
+        return cached[1]
+
+    client = get_fetch_client()
+    timeout = timeout or IMAGE_URL_TIMEOUT
+    started = time.perf_counter()
+    try:
+        valid = False
+        response = await client.head(url, timeout=timeout)
         # Check Content-Type
         content_type = response.headers.get('Content-Type', '').lower()
-        if content_type.startswith(('image/', 'application/octet-stream')):
-            return True
-
-        # Force load it as an image
-        image = Image.open(BytesIO(response.content))
-        image.verify()
+        if response.is_success and content_type.startswith(('image/', 'application/octet-stream')):
+            valid = True
+        else:
+            # Some servers reject HEAD or mislabel images, so sniff the first bytes
+            async with client.stream(
+                "GET", url, headers={"Range": "bytes=0-1023"}, timeout=timeout
+            ) as response:
+                response.raise_for_status()
+                head = b""
+                async for data in response.aiter_bytes():
+                    head += data
+                    if len(head) >= 16:
+                        break
+            valid = sniff_image(head)
+            if not valid:
+                print_colored(f"The URL doesn't point to a valid image.", Fore.RED)
 
-        return True
+        validated_image_urls[url] = (time.monotonic(), valid)
+        metrics.record("image", "url", time.perf_counter() - started, valid=valid)
+        return valid
 
-    except requests.exceptions.RequestException as e:
+    except httpx.HTTPError as e:
+        metrics.record("image", "url", time.perf_counter() - started, status="error")
         print_colored(f"Network error: {e}", Fore.RED)
         return False
-    except Image.UnidentifiedImageError:
-        print_colored(f"The URL doesn't point to a valid image.", Fore.RED)
-        return False
     except Exception as e:
         print_colored(f"Unexpected error: {e}", Fore.RED)
         return False
 
+async def validate_image_urls(urls):
+    """Validate several URLs concurrently, at most IMAGE_URL_CONCURRENCY at a time."""
+    semaphore = asyncio.Semaphore(IMAGE_URL_CONCURRENCY)
+
+    async def validate(url):
+        async with semaphore:
+            return await validate_image_url(url)
+
+    results = await asyncio.gather(*(validate(url) for url in urls))
+    return dict(zip(urls, results))
+
 def is_url(string):
     """Check if a string is a valid URL."""
     try:
@@ -146,11 +434,12 @@ async def handle_image_command(filepaths_or_urls, default_chat_history):
 
     processed_images = 0
     success_images = 0
+    valid_urls = await validate_image_urls([path for path in filepaths_or_urls if is_url(path)])
 
     for idx, image_path in enumerate(filepaths_or_urls, 1):
         try:
             if is_url(image_path):  # URL-based
-                if validate_image_url(image_path):
+                if valid_urls[image_path]:
                     stored_images[f"image_{len(stored_images) + 1}"] = {
                         "type": "image",
                         "source": "url",
@@ -166,35 +455,38 @@ async def handle_image_command(filepaths_or_urls, default_chat_history):
                     print_colored(f"❌ {image_path} isn't a valid image URL. Skipping.", Fore.RED)
 
             else:  # Local filepath
-                image_content = encode_image(image_path)
-                if image_content:
-                    try:
-                        # Detect if it's actually an image
-                        with Image.open(image_path) as img:
-                            img_format = img.format.lower() if img.format else None
-                            if img_format not in ['jpeg', 'jpg', 'png', 'webp', 'gif']:
-                                raise ValueError(f"Unsupported image format: {img_format}")
-
-                            data_uri = f"data:image/{img_format};base64,{image_content}"
-
-                            stored_images[f"image_{len(stored_images) + 1}"] = {
-                                "type": "image",
-                                "source": "local",
-                                "content": data_uri
-                            }
-                            default_chat_history.append({
-                                "role": "user",
-                                "content": [{
-                                    "type": "image_url",
-                                    "image_url": {"url": data_uri}
-                                }]
-                            })
-                            print_colored(f"✅ Local image {idx} added successfully!", Fore.GREEN)
-                            success_images += 1
-                    except (IOError, ValueError) as e:
-                        print_colored(f"❌ {image_path} isn't a valid image. Error: {e}. Skipping.", Fore.RED)
-                else:
+                try:
+                    started = time.perf_counter()
+                    data_uri, original_size = await asyncio.get_running_loop().run_in_executor(
+                        None, prepare_image, image_path
+                    )
+                    metrics.record(
+                        "image", "local", time.perf_counter() - started,
+                        original_bytes=original_size, payload_bytes=len(data_uri),
+                    )
+                except FileNotFoundError:
                     print_colored(f"❌ Failed loading: {image_path}", Fore.RED)
+                except (IOError, ValueError) as e:
+                    print_colored(f"❌ {image_path} isn't a valid image. Error: {e}. Skipping.", Fore.RED)
+                else:
+                    stored_images[f"image_{len(stored_images) + 1}"] = {
+                        "type": "image",
+                        "source": "local",
+                        "content": data_uri
+                    }
+                    default_chat_history.append({
+                        "role": "user",
+                        "content": [{
+                            "type": "image_url",
+                            "image_url": {"url": data_uri}
+                        }]
+                    })
+                    print_colored(
+                        f"✅ Local image {idx} added successfully! "
+                        f"({original_size / 1024:,.0f} KB → {len(data_uri) / 1024:,.0f} KB encoded)",
+                        Fore.GREEN,
+                    )
+                    success_images += 1
 
         except Exception as e:
             print_colored(f"❌ Unexpected error processing {image_path}: {e}. Skipping.", Fore.RED)
@@ -205,103 +497,1185 @@ async def handle_image_command(filepaths_or_urls, default_chat_history):
 
     return default_chat_history
 
-async def aget_results(word):
-    results = await DDGS(proxy=None).atext(word, max_results=100)
+async def duckduckgo_search(query, max_results):
+    ddgs = DDGS(proxy=None)
+    if hasattr(ddgs, "atext"):
+        return await ddgs.atext(query, max_results=max_results)
+    # Newer duckduckgo_search releases only ship the blocking client
+    return await asyncio.get_running_loop().run_in_executor(
+        None, lambda: ddgs.text(query, max_results=max_results)
+    )
+
+def load_search_backend():
+    """Return the configured search backend: async (query, max_results) -> [{title, body, href}]."""
+    if not SEARCH_BACKEND:
+        return duckduckgo_search
+    module_name, _, function_name = SEARCH_BACKEND.partition(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+search_backend = load_search_backend()
+
+def normalize_query(query):
+    """Lowercase and drop punctuation and extra spaces so near-repeat queries share a key."""
+    return " ".join(re.sub(r"[^\w\s]", " ", query.lower()).split())
+
+class SearchCache:
+    """On-disk search results keyed by normalized query, expiring after SEARCH_CACHE_TTL."""
+
+    def __init__(self, path=SEARCH_CACHE_PATH):
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS searches (key TEXT PRIMARY KEY, created REAL, results TEXT)"
+        )
+
+    @staticmethod
+    def key(query, max_results):
+        backend = f"{search_backend.__module__}.{search_backend.__name__}"
+        return f"{backend}|{max_results}|{normalize_query(query)}"
+
+    def get(self, query, max_results):
+        row = self.db.execute(
+            "SELECT created, results FROM searches WHERE key = ?", (self.key(query, max_results),)
+        ).fetchone()
+        if row is None or time.time() - row[0] > SEARCH_CACHE_TTL:
+            return None
+        return json.loads(row[1])
+
+    def put(self, query, max_results, results):
+        with self.db:
+            self.db.execute("DELETE FROM searches WHERE created < ?", (time.time() - SEARCH_CACHE_TTL,))
+            self.db.execute(
+                "INSERT OR REPLACE INTO searches VALUES (?, ?, ?)",
+                (self.key(query, max_results), time.time(), json.dumps(results)),
+            )
+
+search_cache = None
+
+async def aget_results(query, max_results=None):
+    """Search with the configured backend, serving repeat queries from the cache."""
+    global search_cache
+    max_results = max_results or SEARCH_RESULTS
+    if search_cache is None:
+        search_cache = SearchCache()
+    started = time.perf_counter()
+    results = search_cache.get(query, max_results)
+    if results is not None:
+        metrics.record("search", "cache", time.perf_counter() - started, results=len(results))
+        return results
+    try:
+        results = list(await search_backend(query, max_results))[:max_results]
+    except Exception:
+        metrics.record("search", SEARCH_BACKEND or "duckduckgo", time.perf_counter() - started, status="error")
+        raise
+    metrics.record("search", SEARCH_BACKEND or "duckduckgo", time.perf_counter() - started, results=len(results))
+    search_cache.put(query, max_results, results)
     return results
 
 def clear_console():
-    os.system('cls' if os.name == 'nt' else 'clear')
+    if os.name == 'nt':
+        os.system('cls')
+    else:
+        print("\033[2J\033[H", end="", flush=True)  # No subprocess needed
 
 def print_colored(text, color=Fore.WHITE, style=Style.NORMAL, end='\n'):
     print(f"{style}{color}{text}{Style.RESET_ALL}", end=end)
 
-def get_streaming_response(messages, model):
+def get_http_client(base_url=None):
+    """Return the shared pooled HTTP/2 client for an endpoint, creating it on first use."""
+    base_url = base_url or OPENROUTER_BASE_URL
+    http_client = http_clients.get(base_url)
+    if http_client is None:
+        http_client = http_clients[base_url] = httpx.AsyncClient(
+            base_url=base_url,
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=HTTP_POOL_SIZE,
+                max_keepalive_connections=HTTP_POOL_SIZE,
+            ),
+            timeout=httpx.Timeout(120.0, connect=10.0),
+            headers={
+                "Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}",
+                "Content-Type": "application/json"
+            },
+        )
+    return http_client
+
+async def close_http_client():
+    global fetch_client
+    for http_client in http_clients.values():
+        await http_client.aclose()
+    http_clients.clear()
+    if fetch_client is not None:
+        await fetch_client.aclose()
+        fetch_client = None
+
+class SSEDecoder:
+    """Incrementally split raw SSE bytes into decoded JSON events."""
+
+    def __init__(self):
+        self.pending = b""
+        self.done = False
+
+    def feed(self, data):
+        """Return the events completed by this chunk of bytes."""
+        lines = (self.pending + data).split(b"\n")
+        self.pending = lines.pop()  # Keep the partial last line for the next chunk
+        events = []
+        for line in lines:
+            if not line.startswith(b"data: "):
+                continue
+            payload = line[6:].rstrip(b"\r")
+            if payload == b"[DONE]":
+                self.done = True
+                break
+            try:
+                events.append(json_loads(payload))
+            except ValueError:
+                continue
+        return events
+
+class StreamRenderer:
+    """Buffer streamed text and flush it to the terminal at a capped frame rate."""
+
+    def __init__(self, fps=None, stream=None):
+        self.interval = 1 / (fps or RENDER_FPS)
+        self.stream = stream or sys.stdout
+        self.pending = []
+        self.color = None
+        self.last_flush = 0.0
+        self.scheduled = None
+
+    def write(self, text, color=Fore.WHITE):
+        if color != self.color:
+            self.pending.append(color)
+            self.color = color
+        self.pending.append(text)
+
+        wait = self.interval - (time.monotonic() - self.last_flush)
+        if wait <= 0:
+            self.flush()
+        elif self.scheduled is None:
+            # Make sure text shows up even if the stream stalls after this token
+            try:
+                self.scheduled = asyncio.get_running_loop().call_later(wait, self.flush)
+            except RuntimeError:
+                pass
+
+    def flush(self):
+        if self.scheduled is not None:
+            self.scheduled.cancel()
+            self.scheduled = None
+        if self.pending:
+            self.stream.write("".join(self.pending) + Style.RESET_ALL)
+            self.stream.flush()
+            self.pending.clear()
+            self.color = None  # Colors were reset, re-emit on next write
+        self.last_flush = time.monotonic()
+
+    def close(self, end="\n"):
+        self.flush()
+        self.stream.write(end)
+        self.stream.flush()
+
+class ResponseCache:
+    """On-disk LRU cache of completed responses keyed by a hash of the request.
+
+    Entries expire after RESPONSE_CACHE_TTL seconds, and the least recently
+    used ones are evicted once the cache grows past RESPONSE_CACHE_MAX_MB.
+    """
+
+    def __init__(self, path=RESPONSE_CACHE_PATH):
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY, model TEXT, created REAL, accessed REAL,
+                size INTEGER, content TEXT, reasoning TEXT
+            )
+        """)
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(payload):
+        """Stable hash of model, messages, reasoning config and max_tokens."""
+        request = {name: value for name, value in payload.items() if name != "stream"}
+        encoded = json.dumps(request, sort_keys=True, ensure_ascii=False, separators=(",", ":"))
+        return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        row = self.db.execute(
+            "SELECT created, content, reasoning FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        now = time.time()
+        if row is None or now - row[0] > RESPONSE_CACHE_TTL:
+            if row is not None:
+                with self.db:
+                    self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            self.misses += 1
+            return None
+        with self.db:
+            self.db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+        self.hits += 1
+        return {"content": row[1], "reasoning": row[2]}
+
+    def put(self, key, model, content, reasoning):
+        now = time.time()
+        size = len(content.encode("utf-8")) + len(reasoning.encode("utf-8"))
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, model, now, now, size, content, reasoning),
+            )
+            self.evict()
+
+    def evict(self):
+        self.db.execute("DELETE FROM responses WHERE created < ?", (time.time() - RESPONSE_CACHE_TTL,))
+        limit = RESPONSE_CACHE_MAX_MB * 1024 * 1024
+        total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= limit:
+            return
+        for key, size in self.db.execute("SELECT key, size FROM responses ORDER BY accessed").fetchall():
+            self.db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+            if total <= limit:
+                break
+
+    def stats(self):
+        entries, size = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        return entries, size
+
+    def clear(self):
+        with self.db:
+            self.db.execute("DELETE FROM responses")
+        self.db.execute("VACUUM")
+        self.hits = self.misses = 0
+
+response_cache = None
+
+def get_response_cache():
+    global response_cache
+    if response_cache is None:
+        response_cache = ResponseCache()
+    return response_cache
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not values:
+        return None
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+class MetricsRecorder:
+    """Per-call metrics for model requests, searches and image fetches.
+
+    The latest METRICS_BUFFER records are kept in memory for /stats. When
+    METRICS_JSONL is set every record is appended there, and METRICS_PROM
+    is rewritten as a Prometheus textfile after each record.
+    """
+
+    def __init__(self, size=METRICS_BUFFER):
+        self.records = deque(maxlen=size)
+        self.totals = defaultdict(lambda: defaultdict(float))  # Lifetime counters for Prometheus
+
+    def record(self, kind, model, seconds, **fields):
+        entry = {"time": round(time.time(), 3), "kind": kind, "model": model, "seconds": round(seconds, 4)}
+        entry.update(fields)
+        entry.setdefault("status", "ok")
+        self.records.append(entry)
+        totals = self.totals[(kind, model)]
+        totals["calls"] += 1
+        totals["errors"] += entry["status"] != "ok"
+        totals["seconds"] += seconds
+        for field in ("prompt_tokens", "completion_tokens", "reasoning_tokens", "cached_tokens", "payload_bytes"):
+            totals[field] += entry.get(field) or 0
+        self.export(entry)
+        return entry
+
+    def export(self, entry):
+        try:
+            if METRICS_JSONL:
+                with open(METRICS_JSONL, 'a', encoding='utf-8') as jsonl:
+                    jsonl.write(json.dumps(entry) + "\n")
+            if METRICS_PROM:
+                temporary = METRICS_PROM + ".tmp"
+                with open(temporary, 'w', encoding='utf-8') as prom:
+                    prom.write(self.prometheus())
+                os.replace(temporary, METRICS_PROM)  # Collectors never see a half-written file
+        except OSError as e:
+            print_colored(f"⚠️ Couldn't export metrics: {e}", Fore.YELLOW)
+
+    def summary(self):
+        """Per (kind, model): call count, errors, and sorted samples of each timing."""
+        groups = {}
+        for entry in self.records:
+            group = groups.setdefault((entry["kind"], entry["model"]), {
+                "calls": 0, "errors": 0, "seconds": [], "ttft": [], "tokens_per_second": [],
+                "prompt_tokens": 0, "completion_tokens": 0, "cached_tokens": 0,
+            })
+            group["calls"] += 1
+            if entry["status"] != "ok":
+                group["errors"] += 1
+                continue
+            for field in ("seconds", "ttft", "tokens_per_second"):
+                if entry.get(field) is not None:
+                    group[field].append(entry[field])
+            for field in ("prompt_tokens", "completion_tokens", "cached_tokens"):
+                group[field] += entry.get(field) or 0
+        for group in groups.values():
+            for field in ("seconds", "ttft", "tokens_per_second"):
+                group[field].sort()
+        return groups
+
+    def prometheus(self):
+        lines = []
+
+        def labels(kind, model, **extra):
+            pairs = {"kind": kind, "model": model, **extra}
+            return ",".join(f'{key}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for key, value in pairs.items())
+
+        lines.append("# TYPE omni_request_seconds summary")
+        for (kind, model), group in sorted(self.summary().items()):
+            for quantile in (0.5, 0.95):
+                value = percentile(group["seconds"], quantile)
+                if value is not None:
+                    lines.append(f"omni_request_seconds{{{labels(kind, model, quantile=quantile)}}} {value}")
+            totals = self.totals[(kind, model)]
+            lines.append(f"omni_request_seconds_sum{{{labels(kind, model)}}} {totals['seconds']:.4f}")
+            lines.append(f"omni_request_seconds_count{{{labels(kind, model)}}} {int(totals['calls'])}")
+        lines.append("# TYPE omni_time_to_first_token_seconds gauge")
+        for (kind, model), group in sorted(self.summary().items()):
+            for quantile in (0.5, 0.95):
+                value = percentile(group["ttft"], quantile)
+                if value is not None:
+                    lines.append(f"omni_time_to_first_token_seconds{{{labels(kind, model, quantile=quantile)}}} {value}")
+        lines.append("# TYPE omni_request_errors_total counter")
+        lines.append("# TYPE omni_tokens_total counter")
+        lines.append("# TYPE omni_payload_bytes_total counter")
+        for (kind, model), totals in sorted(self.totals.items()):
+            lines.append(f"omni_request_errors_total{{{labels(kind, model)}}} {int(totals['errors'])}")
+            for field in ("prompt", "completion", "reasoning", "cached"):
+                lines.append(f"omni_tokens_total{{{labels(kind, model, type=field)}}} {int(totals[field + '_tokens'])}")
+            lines.append(f"omni_payload_bytes_total{{{labels(kind, model)}}} {int(totals['payload_bytes'])}")
+        return "\n".join(lines) + "\n"
+
+    def clear(self):
+        self.records.clear()
+
+metrics = MetricsRecorder()
+
+def usage_fields(usage):
+    """Flatten a provider usage object into metric fields."""
+    if not usage:
+        return {}
+    prompt_details = usage.get("prompt_tokens_details") or {}
+    completion_details = usage.get("completion_tokens_details") or {}
+    return {
+        "prompt_tokens": usage.get("prompt_tokens"),
+        "completion_tokens": usage.get("completion_tokens"),
+        "reasoning_tokens": completion_details.get("reasoning_tokens"),
+        "cached_tokens": prompt_details.get("cached_tokens") or usage.get("cache_read_input_tokens"),
+        "cost": usage.get("cost"),
+    }
+
+async def stream_chat_completion(payload, kind="chat", base_url=None):
+    """Yield parsed SSE chunks from the chat completions endpoint.
+
+    With the response cache on, a cached response is replayed as chunks and
+    fresh responses are recorded once they finished without an error event
+    and with some content. Every request made is recorded in
+    metrics under kind (chat, plan, edit, summary). base_url picks another
+    endpoint than OPENROUTER_BASE_URL.
+    """
+    cache = get_response_cache() if is_response_cache_on else None
+    if cache:
+        key = cache.key(payload)
+        cached = cache.get(key)
+        if cached is not None:
+            if cached["reasoning"]:
+                yield {"choices": [{"delta": {"reasoning": cached["reasoning"]}}]}
+            yield {"choices": [{"delta": {"content": cached["content"]}}]}
+            return
+    content_parts, reasoning_parts = [], []
+
+    body = json.dumps(payload).encode("utf-8")  # Serialized once, and measured
+    started = time.perf_counter()
+    first_token = None
+    usage = None
+    status = "error"
+    finished_reply = False  # [DONE] or a finish_reason arrived
+    error_event = None
     try:
-        url = "https://openrouter.ai/api/v1/chat/completions"
-        headers = {
-            "Authorization": f"Bearer {os.getenv('OPENROUTER_API_KEY')}",
-            "Content-Type": "application/json"
-        }
-        
-        # Configure model-specific reasoning settings
-        reasoning_config = None
-        if "anthropic" in model:
-            reasoning_config = {
-                "max_tokens": 8000  # For Anthropic models
-            }
-        elif "openai" in model:
-            reasoning_config = {
-                "effort": "high"  # For OpenAI models
+        async with get_http_client(base_url).stream("POST", "/chat/completions", content=body) as response:
+            response.raise_for_status()
+            decoder = SSEDecoder()
+            async for data in response.aiter_bytes():
+                for event in decoder.feed(data):
+                    if event.get('usage'):
+                        usage = event['usage']
+                    if event.get('error'):
+                        error_event = event['error']
+                    choice = (event.get('choices') or [{}])[0]
+                    if choice.get('finish_reason'):
+                        finished_reply = True
+                    delta = choice.get('delta', {})
+                    if delta.get('reasoning'):
+                        reasoning_parts.append(delta['reasoning'])
+                    if delta.get('content'):
+                        content_parts.append(delta['content'])
+                    if first_token is None and (delta.get('content') or delta.get('reasoning')):
+                        first_token = time.perf_counter()
+                    yield event
+                if decoder.done:
+                    finished_reply = True
+                    break
+        status = "ok" if error_event is None else "error"
+    except (GeneratorExit, asyncio.CancelledError):
+        status = "cancelled"
+        raise
+    finally:
+        finished = time.perf_counter()
+        fields = usage_fields(usage)
+        content_chars = sum(map(len, content_parts))
+        reasoning_chars = sum(map(len, reasoning_parts))
+        generated = fields.get("completion_tokens") or (content_chars + reasoning_chars + 3) // 4
+        streaming = finished - first_token if first_token else 0
+        metrics.record(
+            kind,
+            payload.get("model") if base_url is None else f"{payload.get('model')}@{base_url}",
+            finished - started,
+            status=status,
+            ttft=round(first_token - started, 4) if first_token else None,
+            tokens_per_second=round(generated / streaming, 1) if streaming > 0 else None,
+            content_chars=content_chars,
+            reasoning_chars=reasoning_chars,
+            payload_bytes=len(body),
+            **fields,
+        )
+
+    if cache and finished_reply and error_event is None and content_parts:
+        cache.put(key, payload.get("model"), "".join(content_parts), "".join(reasoning_parts))
+
+async def handle_cache_command(argument):
+    global is_response_cache_on
+    action = argument.strip().lower() or "stats"
+    if action in ("on", "off"):
+        is_response_cache_on = action == "on"
+        print_colored(f"Response cache is now {action}.", Fore.YELLOW)
+    elif action == "clear":
+        get_response_cache().clear()
+        print_colored("✅ Response cache cleared.", Fore.GREEN)
+    elif action == "stats":
+        cache = get_response_cache()
+        entries, size = cache.stats()
+        status = "on" if is_response_cache_on else "off"
+        print_colored(
+            f"🗄️ Response cache is {status}: {entries} entries, {size / 1024 / 1024:.1f} of "
+            f"{RESPONSE_CACHE_MAX_MB:.0f} MB, {cache.hits} hits / {cache.misses} misses this session.",
+            Fore.CYAN,
+        )
+        if prompt_cache_usage["prompt"]:
+            print_colored(
+                f"💾 Prompt cache: {prompt_cache_usage['cached']:,} of {prompt_cache_usage['prompt']:,} input tokens "
+                f"cached over {prompt_cache_usage['turns']} turns "
+                f"({prompt_cache_usage['cached'] / prompt_cache_usage['prompt']:.0%} hit).",
+                Fore.CYAN,
+            )
+    else:
+        print_colored("❌ Usage: /cache on|off|stats|clear", Fore.RED)
+
+def parse_route(spec):
+    """"model" or "model@base_url" to a (model, base_url) route; None is OPENROUTER_BASE_URL."""
+    model, _, base_url = spec.partition("@")
+    return model.strip(), base_url.strip().rstrip("/") or None
+
+def route_label(route):
+    model, base_url = route
+    return model if base_url is None else f"{model}@{urlparse(base_url).netloc}"
+
+class ModelRouter:
+    """Send chat and planner requests to the fastest healthy route.
+
+    A route is a model on an endpoint. Each keeps a moving window of time to
+    first token and tokens/sec, and routes are ranked by the time a typical
+    reply would take; routes without samples are tried first. A route that
+    fails is skipped for ROUTER_COOLDOWN seconds. With ROUTER_HEDGE_MS set,
+    a request still waiting for its first token after that delay is also
+    sent to the next route; whichever streams first is kept and the other
+    is cancelled.
+
+    Routes can serve models with different context budgets and prompt cache
+    layouts, so the context is rebuilt for each routed model from the
+    messages the payload was built from. Without those, only routes whose
+    budget is at least that of the payload's model are used.
+    """
+
+    EXPECTED_REPLY_TOKENS = 500
+
+    def __init__(self, routes, window=None, hedge_ms=None, cooldown=None):
+        self.routes = [parse_route(route) for route in routes]
+        window = window or ROUTER_WINDOW
+        self.hedge_delay = (ROUTER_HEDGE_MS if hedge_ms is None else hedge_ms) / 1000
+        self.cooldown = ROUTER_COOLDOWN if cooldown is None else cooldown
+        self.stats = {
+            route: {
+                "ttft": deque(maxlen=window), "tokens_per_second": deque(maxlen=window),
+                "down_until": 0.0, "requests": 0, "wins": 0, "failures": 0, "hedges": 0,
             }
-        
-        payload = {
-            "model": model,
-            "messages": messages,
-            "max_tokens": 10000,
-            "stream": True
+            for route in self.routes
         }
-        
-        # Only add reasoning if we have a configuration
+
+    def score(self, route):
+        """Expected seconds for a typical reply on route."""
+        stats = self.stats[route]
+        if not stats["ttft"]:
+            return 0.0
+        ttft = percentile(sorted(stats["ttft"]), 0.5)
+        tokens_per_second = percentile(sorted(stats["tokens_per_second"]), 0.5)
+        return ttft + (self.EXPECTED_REPLY_TOKENS / tokens_per_second if tokens_per_second else 0)
+
+    def ranked(self):
+        """Healthy routes fastest first, then routes in cooldown as a last resort."""
+        now = time.monotonic()
+        healthy = [route for route in self.routes if self.stats[route]["down_until"] <= now]
+        down = [route for route in self.routes if self.stats[route]["down_until"] > now]
+        return sorted(healthy, key=self.score) + sorted(down, key=lambda route: self.stats[route]["down_until"])
+
+    async def route_payload(self, payload, model, messages=None, extra_messages=None):
+        """payload for model, with its context rebuilt for that model when the messages are known."""
+        if model == payload["model"]:
+            return payload
+        routed = dict(payload, model=model)
+        if messages is not None:
+            routed["messages"] = await build_context(messages, model, extra_messages)
+        reasoning_config = get_reasoning_config(model)
         if reasoning_config:
-            payload["reasoning"] = reasoning_config
-        
-        # Make the direct API call
-        response = requests.post(url, json=payload, headers=headers, stream=True)
-        response.raise_for_status()
+            routed["reasoning"] = reasoning_config
+        else:
+            routed.pop("reasoning", None)
+        return routed
+
+    async def pump(self, racer, payload, kind, messages, extra_messages):
+        """Run one route's request, queueing its events for whoever wins the race."""
+        route, events = racer["route"], racer["events"]
+        stats = self.stats[route]
+        stats["requests"] += 1
+        started = time.perf_counter()
+        first_token = None
+        characters = 0
+        try:
+            routed = await self.route_payload(payload, route[0], messages, extra_messages)
+            async for event in stream_chat_completion(routed, kind, route[1]):
+                delta = (event.get('choices') or [{}])[0].get('delta', {})
+                text = (delta.get('content') or "") + (delta.get('reasoning') or "")
+                if text:
+                    characters += len(text)
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                        stats["ttft"].append(first_token - started)
+                        racer["first"].set()
+                events.put_nowait(event)
+        except asyncio.CancelledError:
+            if first_token is None:  # Lost a hedge race: it took at least this long
+                stats["ttft"].append(time.perf_counter() - started)
+            raise
+        except Exception as e:
+            stats["failures"] += 1
+            stats["down_until"] = time.monotonic() + self.cooldown
+            racer["error"] = e
+            events.put_nowait(e)
+        else:
+            events.put_nowait(None)
+            streaming = time.perf_counter() - first_token if first_token else 0
+            if streaming > 0:
+                stats["tokens_per_second"].append(characters / 4 / streaming)
+        finally:
+            racer["first"].set()  # Finished, failed or cancelled: stop waiting on it
+
+    async def stream(self, payload, kind="chat", messages=None, extra_messages=None):
+        """Yield the SSE events of the first route to start streaming.
+
+        messages and extra_messages are what payload's context was built from.
+        """
+        order = self.ranked()
+        if messages is None:
+            budget = get_context_budget(payload["model"])
+            order = [route for route in order if get_context_budget(route[0]) >= budget]
+            if not order:
+                raise ValueError(f"No model route has the context budget of {payload['model']}")
+        racers = []
+        started = time.monotonic()
+
+        def launch():
+            racer = {"route": order[len(racers)], "events": asyncio.Queue(), "first": asyncio.Event(), "error": None}
+            racer["task"] = asyncio.create_task(self.pump(racer, payload, kind, messages, extra_messages))
+            racers.append(racer)
+
+        launch()
+        winner = None
+        try:
+            while winner is None:
+                active = [racer for racer in racers if racer["error"] is None]
+                if not active:
+                    if len(racers) == len(order):
+                        raise racers[-1]["error"]
+                    launch()  # Fail over to the next route
+                    continue
+                timeout = None
+                if self.hedge_delay and len(racers) == 1 and len(order) > 1:
+                    timeout = max(0.0, self.hedge_delay - (time.monotonic() - started))
+                waiters = {asyncio.ensure_future(racer["first"].wait()): racer for racer in active}
+                done, pending = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                for waiter in pending:
+                    waiter.cancel()
+                if not done:
+                    self.stats[racers[0]["route"]]["hedges"] += 1
+                    launch()  # Hedge: race the next route too
+                    continue
+                for waiter in done:
+                    racer = waiters[waiter]
+                    if racer["error"] is None and winner is None:
+                        winner = racer
+
+            self.stats[winner["route"]]["wins"] += 1
+            for racer in racers:
+                if racer is not winner:
+                    racer["task"].cancel()
+            while True:
+                event = await winner["events"].get()
+                if event is None:
+                    break
+                if isinstance(event, Exception):
+                    raise event
+                yield event
+        finally:
+            for racer in racers:
+                racer["task"].cancel()
+
+model_router = None
+
+def get_model_router():
+    """The router over MODEL_ROUTES, or None when fewer than two routes are configured."""
+    global model_router
+    if model_router is None and len(MODEL_ROUTES) > 1:
+        model_router = ModelRouter(MODEL_ROUTES)
+    return model_router
+
+def open_chat_stream(payload, kind="chat", messages=None, extra_messages=None):
+    """Stream a chat or planner request, through the model router when one is set up.
+
+    messages and extra_messages, as given to build_chat_payload, let the
+    router rebuild the context for whichever model it picks.
+    """
+    router = get_model_router()
+    if router and payload.get("model") == DEFAULT_MODEL:
+        return router.stream(payload, kind, messages, extra_messages)
+    return stream_chat_completion(payload, kind)
+
+def print_router_status(router):
+    table = Table(title="Model routes, fastest first")
+    table.add_column("Route")
+    table.add_column("Requests", justify="right")
+    table.add_column("Wins", justify="right")
+    table.add_column("Hedged", justify="right")
+    table.add_column("TTFT p50", justify="right")
+    table.add_column("Tok/s p50", justify="right")
+    table.add_column("Status")
+    now = time.monotonic()
+    for route in router.ranked():
+        stats = router.stats[route]
+        ttft = percentile(sorted(stats["ttft"]), 0.5)
+        tokens_per_second = percentile(sorted(stats["tokens_per_second"]), 0.5)
+        down = stats["down_until"] - now
+        table.add_row(
+            route_label(route),
+            str(stats["requests"]),
+            str(stats["wins"]),
+            str(stats["hedges"]),
+            "-" if ttft is None else f"{ttft:.2f}s",
+            "-" if tokens_per_second is None else f"{tokens_per_second:,.0f}",
+            f"[red]cooling down {down:.0f}s[/red]" if down > 0 else "[green]healthy[/green]",
+        )
+    Console().print(table)
+
+def handle_stats_command(argument):
+    action, _, path = argument.strip().partition(" ")
+    action = action.lower()
+    if action == "clear":
+        metrics.clear()
+        print_colored("✅ Metrics cleared.", Fore.GREEN)
+        return
+    if action == "export":
+        export_format, _, path = path.strip().partition(" ")
+        export_format = export_format.lower() or "jsonl"
+        if export_format not in METRICS_EXPORT_PATHS:
+            print_colored("❌ Usage: /stats export [jsonl|prom] [path]", Fore.RED)
+            return
+        # Never the METRICS_JSONL log: a rewrite would replace its history with the in-memory records
+        path = path.strip() or METRICS_EXPORT_PATHS[export_format]
+        try:
+            with open(path, 'w', encoding='utf-8') as export:
+                if export_format == "prom":
+                    export.write(metrics.prometheus())
+                else:
+                    export.writelines(json.dumps(entry) + "\n" for entry in metrics.records)
+        except OSError as e:
+            print_colored(f"❌ Couldn't export metrics: {e}", Fore.RED)
+            return
+        print_colored(f"✅ Exported {len(metrics.records)} records to {path}", Fore.GREEN)
+        return
+    if action:
+        print_colored("❌ Usage: /stats [clear|export [jsonl|prom] [path]]", Fore.RED)
+        return
+
+    groups = metrics.summary()
+    if not groups:
+        print_colored("No requests recorded yet.", Fore.YELLOW)
+        return
+
+    def seconds(value):
+        return "-" if value is None else f"{value:.2f}s"
+
+    table = Table(title=f"Last {len(metrics.records)} calls")
+    table.add_column("Kind")
+    table.add_column("Model")
+    table.add_column("Calls", justify="right")
+    table.add_column("p50", justify="right")
+    table.add_column("p95", justify="right")
+    table.add_column("TTFT p50", justify="right")
+    table.add_column("TTFT p95", justify="right")
+    table.add_column("Tok/s p50", justify="right")
+    table.add_column("Tokens in/cached/out", justify="right")
+    for (kind, model), group in sorted(groups.items()):
+        tokens_per_second = percentile(group["tokens_per_second"], 0.5)
+        calls = f"{group['calls']}" + (f" [red]({group['errors']} failed)[/red]" if group["errors"] else "")
+        table.add_row(
+            kind,
+            model or "-",
+            calls,
+            seconds(percentile(group["seconds"], 0.5)),
+            seconds(percentile(group["seconds"], 0.95)),
+            seconds(percentile(group["ttft"], 0.5)),
+            seconds(percentile(group["ttft"], 0.95)),
+            "-" if tokens_per_second is None else f"{tokens_per_second:,.0f}",
+            f"{group['prompt_tokens']:,}/{group['cached_tokens']:,}/{group['completion_tokens']:,}"
+            if group["prompt_tokens"] or group["completion_tokens"] else "-",
+        )
+    Console().print(table)
+
+context_summaries = OrderedDict()  # Hash of a run of evicted messages -> its summary, oldest first
+
+@functools.lru_cache(maxsize=SESSION_BLOB_CACHE)
+def read_blob(path):
+    with open(path, "rb") as f:
+        return gzip.decompress(f.read()).decode("utf-8")
+
+class BlobRef:
+    """Text in the session blob store, read only when it's used.
+
+    A resumed session holds these instead of its long strings. len() is
+    known from the journal without reading the blob; str() reads it.
+    """
+
+    def __init__(self, path, digest, length=None):
+        self.path = path
+        self.digest = digest
+        self.length = length
+
+    def __str__(self):
+        return read_blob(self.path)
+
+    def __len__(self):
+        if self.length is None:
+            self.length = len(str(self))
+        return self.length
+
+    def __getitem__(self, index):
+        return str(self)[index]
+
+def resolve_blobs(value):
+    """Replace BlobRefs in a message with their text, just before it is sent."""
+    if isinstance(value, BlobRef):
+        return str(value)
+    if isinstance(value, dict):
+        return {key: resolve_blobs(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve_blobs(item) for item in value]
+    return value
+
+def estimate_text_tokens(text):
+    """Cheap local token estimate (~4 characters per token)."""
+    return (len(text) + 3) // 4
+
+def estimate_tokens(message):
+    content = message.get("content") or ""
+    tokens = 4  # Per-message overhead for role and separators
+    if isinstance(content, (str, BlobRef)):
+        return tokens + estimate_text_tokens(content)
+    for part in content:
+        if part.get("type") == "image_url":
+            tokens += IMAGE_TOKEN_ESTIMATE
+        else:
+            tokens += estimate_text_tokens(part.get("text", ""))
+    return tokens
+
+def get_context_budget(model):
+    if CONTEXT_BUDGET:
+        return CONTEXT_BUDGET
+    for family, budget in MODEL_CONTEXT_BUDGETS.items():
+        if family in model:
+            return budget
+    return DEFAULT_CONTEXT_BUDGET
+
+def plan_context(messages, model):
+    """Decide which messages fit the model's budget.
+
+    System and pinned messages are always kept, as is the latest message.
+    Otherwise the newest turns are kept and everything older is evicted.
+    Returns (kept indexes, evicted indexes, per-message token counts).
+    """
+    budget = get_context_budget(model)
+    counts = [estimate_tokens(message) for message in messages]
+    if sum(counts) <= budget:
+        return list(range(len(messages))), [], counts
+
+    always = {
+        idx for idx, message in enumerate(messages)
+        if message["role"] == "system" or message.get("pinned")
+    }
+    always.add(len(messages) - 1)
+    reserve = min(CONTEXT_SUMMARY_TOKENS, budget // 10)  # Room for the summary note
+    available = budget - reserve - sum(counts[idx] for idx in always)
+
+    cut = len(messages) - 1
+    for idx in range(len(messages) - 2, -1, -1):
+        if idx in always:
+            continue
+        if counts[idx] > available:
+            break
+        available -= counts[idx]
+        cut = idx
+    # Don't start the kept turns on an assistant reply
+    while cut < len(messages) - 1 and messages[cut]["role"] == "assistant" and cut not in always:
+        cut += 1
+
+    kept = [idx for idx in range(len(messages)) if idx in always or idx >= cut]
+    evicted = [idx for idx in range(cut) if idx not in always]
+    return kept, evicted, counts
+
+def summary_line(message):
+    content = message['content']
+    return f"{message['role']}: {content if isinstance(content, str) else '[image]'}"
+
+async def request_summary(previous, transcript):
+    instructions = (
+        f"in under {CONTEXT_SUMMARY_TOKENS // 2} words. Keep file names, decisions and open questions."
+    )
+    if previous:
+        prompt = (
+            f"Update this summary of a conversation between a developer and an assistant with the turns "
+            f"that follow it, {instructions}\n\nSummary:\n{previous}\n\nFollowing turns:\n{transcript}"
+        )
+    else:
+        prompt = f"Summarize this conversation between a developer and an assistant {instructions}\n\n{transcript}"
+    parts = []
+    async for chunk in stream_chat_completion({
+        "model": EDITOR_MODEL,
+        "messages": [{"role": "user", "content": prompt}],
+        "stream": True,
+    }, kind="summary"):
+        content = (chunk.get('choices') or [{}])[0].get('delta', {}).get('content')
+        if content:
+            parts.append(content)
+    return "".join(parts)
+
+async def summarize_messages(messages):
+    """Summarize evicted turns with the editor model, incrementally.
+
+    Turns are evicted oldest first, so each call mostly repeats the last
+    one's messages with a few more. Summaries are kept per run of messages
+    from the first, and only the messages past the longest run already
+    summarized are sent, with that summary, in pieces that fit the editor
+    model's budget.
+    """
+    keys, digest = [], b""
+    for message in messages:
+        digest = hashlib.sha256(digest + summary_line(message).encode("utf-8")).digest()
+        keys.append(digest)
+    start, summary = 0, ""
+    for index in range(len(keys) - 1, -1, -1):
+        if keys[index] in context_summaries:
+            context_summaries.move_to_end(keys[index])
+            start, summary = index + 1, context_summaries[keys[index]]
+            break
+
+    # Room for the instructions, the previous summary and the reply
+    budget = max(CONTEXT_SUMMARY_TOKENS, get_context_budget(EDITOR_MODEL) - 3 * CONTEXT_SUMMARY_TOKENS)
+    while start < len(messages):
+        lines, used, end = [], 0, start
+        while end < len(messages):
+            line = summary_line(messages[end])
+            tokens = estimate_text_tokens(line)
+            if lines and used + tokens > budget:
+                break
+            lines.append(line[:budget * 4])  # A single message over the budget is cut
+            used += tokens
+            end += 1
+        summary = await request_summary(summary, "\n\n".join(lines))
+        context_summaries[keys[end - 1]] = summary
+        if len(context_summaries) > CONTEXT_SUMMARY_CACHE:
+            context_summaries.popitem(last=False)
+        start = end
+    return summary
+
+INTERNAL_MESSAGE_KEYS = ("pinned", "file_context", "search")
+prompt_cache_usage = {"turns": 0, "prompt": 0, "cached": 0, "written": 0}
+
+def prompt_cache_enabled(model):
+    if PROMPT_CACHE in ("on", "true", "1"):
+        return True
+    if PROMPT_CACHE == "auto":
+        return any(family in model for family in PROMPT_CACHE_MODELS)
+    return False
+
+def is_stable_message(message):
+    return message["role"] == "system" or message.get("pinned") or message.get("search")
+
+def stable_prefix_first(messages):
+    """Move the system prompt, /add-ed files, pinned messages and search results
+    to the front, in history order, so every request starts with the same prefix.
+
+    The latest message stays last. Returns (messages, length of the prefix).
+    """
+    earlier, latest = messages[:-1], messages[-1:]
+    stable = [message for message in earlier if is_stable_message(message)]
+    rest = [message for message in earlier if not is_stable_message(message)]
+    return stable + rest + latest, len(stable)
+
+def with_cache_control(message):
+    content = message.get("content") or ""
+    if isinstance(content, str):
+        parts = [{"type": "text", "text": content}]
+    else:
+        parts = list(content)
+    parts[-1] = dict(parts[-1], cache_control={"type": "ephemeral"})
+    return dict(message, content=parts)
+
+def mark_cache_breakpoints(outgoing, boundaries):
+    """Add cache_control to the messages ending each prefix worth caching.
+
+    Prefixes shorter than PROMPT_CACHE_MIN_TOKENS can't be cached by the
+    provider, so they get no breakpoint. Later boundaries win when there are
+    more than PROMPT_CACHE_BREAKPOINTS.
+    """
+    prefix_tokens, total = [], 0
+    for message in outgoing:
+        total += estimate_tokens(message)
+        prefix_tokens.append(total)
+    positions = sorted({
+        position for position in boundaries
+        if 0 <= position < len(outgoing) and prefix_tokens[position] >= PROMPT_CACHE_MIN_TOKENS
+    })
+    for position in positions[-PROMPT_CACHE_BREAKPOINTS:]:
+        outgoing[position] = with_cache_control(outgoing[position])
+    return outgoing
+
+def report_prompt_cache_usage(usage):
+    """Print how much of this turn's prompt was read from the provider cache."""
+    prompt = usage.get("prompt_tokens") or usage.get("input_tokens") or 0
+    if not prompt:
+        return
+    details = usage.get("prompt_tokens_details") or {}
+    cached = details.get("cached_tokens") or usage.get("cache_read_input_tokens") or 0
+    written = details.get("cache_write_tokens") or usage.get("cache_creation_input_tokens") or 0
+    prompt_cache_usage["turns"] += 1
+    prompt_cache_usage["prompt"] += prompt
+    prompt_cache_usage["cached"] += cached
+    prompt_cache_usage["written"] += written
+    print_colored(
+        f"💾 Prompt cache: {cached:,} of {prompt:,} input tokens cached ({cached / prompt:.0%} hit), "
+        f"{written:,} written.",
+        Fore.CYAN,
+    )
+
+async def build_context(messages, model, extra_messages=None):
+    """Return the messages to send to the model, fitted to its token budget.
+
+    extra_messages are sent just before the latest message for this request
+    only, without being stored in the history.
+    """
+    messages = with_file_context(messages)
+    caching = prompt_cache_enabled(model)
+    stable_count = 0
+    if caching and messages:
+        messages, stable_count = stable_prefix_first(messages)
+    if extra_messages:
+        messages = messages[:-1] + [dict(message, pinned=True) for message in extra_messages] + messages[-1:]
+    kept, evicted, counts = plan_context(messages, model)
+    outgoing = [
+        resolve_blobs({key: value for key, value in messages[idx].items() if key not in INTERNAL_MESSAGE_KEYS})
+        for idx in kept
+    ]
+    stable_kept = sum(1 for idx in kept if idx < stable_count)
+    if evicted:
+        if CONTEXT_SUMMARIZE:
+            summary = await summarize_messages([resolve_blobs(messages[idx]) for idx in evicted])
+            note = f"Summary of {len(evicted)} earlier messages:\n{summary}"
+        else:
+            note = f"[{len(evicted)} earlier messages were omitted to fit the context window]"
+        if caching:
+            insert_at = stable_kept  # Keep the cached prefix intact
+        else:
+            insert_at = 1 if outgoing and outgoing[0]["role"] == "system" else 0
+        outgoing.insert(insert_at, {"role": "user", "content": note})
+    if caching and outgoing:
+        # Cache the system prompt, the files, the whole stable prefix and the conversation so far
+        boundaries = [
+            position for position, idx in enumerate(kept[:stable_kept])
+            if messages[idx]["role"] == "system" or messages[idx].get("file_context")
+        ]
+        boundaries += [stable_kept - 1, len(outgoing) - 1]
+        mark_cache_breakpoints(outgoing, boundaries)
+    return outgoing
+
+def handle_context_command(chat_history, model):
+    messages = with_file_context(chat_history)
+    kept, evicted, counts = plan_context(messages, model)
+    kept_set = set(kept)
+    offset = 0  # Keep numbering in line with /history and /pin
+
+    table = Table(title=f"Context for {model}")
+    table.add_column("#", justify="right")
+    table.add_column("Role")
+    table.add_column("Tokens", justify="right")
+    table.add_column("Status")
+    table.add_column("Preview")
+
+    for idx, message in enumerate(messages):
+        number = str(idx - offset)
+        if message.get("file_context"):
+            number, status = "-", f"[magenta]{len(file_context)} files[/magenta]"
+            offset = 1
+        elif message["role"] == "system":
+            status = "[cyan]system[/cyan]"
+        elif message.get("pinned"):
+            status = "[magenta]pinned[/magenta]"
+        elif idx in kept_set:
+            status = "[green]sent[/green]"
+        else:
+            status = "[red]summarized[/red]" if CONTEXT_SUMMARIZE else "[red]evicted[/red]"
+        content = message.get("content") or ""
+        preview = str(content) if isinstance(content, (str, BlobRef)) else "[image]"
+        preview = preview.replace("\n", " ")[:60]
+        table.add_row(number, message["role"], f"{counts[idx]:,}", status, preview)
+
+    Console().print(table)
+    sent_tokens = sum(counts[idx] for idx in kept)
+    print_colored(
+        f"📦 Sending {len(kept)}/{len(messages)} messages, ~{sent_tokens:,} of {get_context_budget(model):,} tokens.",
+        Fore.CYAN,
+    )
+
+def handle_pin_command(chat_history, argument, pinned=True):
+    try:
+        idx = int(argument)
+        if idx < 1:
+            raise IndexError
+        message = chat_history[idx]
+    except (ValueError, IndexError):
+        print_colored("❌ Give a message number from /history or /context.", Fore.RED)
+        return
+    if pinned:
+        message["pinned"] = True
+        print_colored(f"📌 Message {idx} pinned, it will always be sent.", Fore.GREEN)
+    else:
+        message.pop("pinned", None)
+        print_colored(f"✅ Message {idx} unpinned.", Fore.GREEN)
+
+def get_reasoning_config(model):
+    # Configure model-specific reasoning settings
+    if "anthropic" in model:
+        return {
+            "max_tokens": 8000  # For Anthropic models
+        }
+    if "openai" in model:
+        return {
+            "effort": "high"  # For OpenAI models
+        }
+    return None
+
+async def build_chat_payload(messages, model, extra_messages=None):
+    reasoning_config = get_reasoning_config(model)
+
+    payload = {
+        "model": model,
+        "messages": await build_context(messages, model, extra_messages),
+        "max_tokens": 10000,
+        "stream": True,
+        "stream_options": {"include_usage": True},  # Usage arrives in the last chunk
+    }
+
+    # Only add reasoning if we have a configuration
+    if reasoning_config:
+        payload["reasoning"] = reasoning_config
+    return payload
+
+async def get_streaming_response(messages, model, extra_messages=None, kind="chat"):
+    renderer = StreamRenderer()
+    try:
+        payload = await build_chat_payload(messages, model, extra_messages)
         
-        full_response = ""
-        full_reasoning = ""
+        content_parts = []
+        reasoning_parts = []
         current_mode = None  # Track if we're in reasoning or content mode
         
-        # Process the SSE stream
-        for line in response.iter_lines():
-            if line:
-                line = line.decode('utf-8')
-                if line.startswith('data: '):
-                    if line == 'data: [DONE]':
-                        break
+        # Process the SSE stream over the pooled connection
+        usage = None
+        async for chunk in open_chat_stream(payload, kind, messages, extra_messages):
+            if chunk.get('usage'):
+                usage = chunk['usage']
+            try:
+                delta = (chunk.get('choices') or [{}])[0].get('delta', {})
+                
+                # Check for reasoning tokens
+                if 'reasoning' in delta and delta['reasoning'] is not None:
+                    # Check if we need to transition from content to reasoning
+                    if current_mode != "reasoning":
+                        current_mode = "reasoning"
                     
-                    line = line[6:]  # Remove 'data: ' prefix
-                    try:
-                        chunk = json.loads(line)
-                        delta = chunk.get('choices', [{}])[0].get('delta', {})
-                        
-                        # Check for reasoning tokens
-                        if 'reasoning' in delta and delta['reasoning'] is not None:
-                            # Check if we need to transition from content to reasoning
-                            if current_mode != "reasoning":
-                                current_mode = "reasoning"
-                            
-                            # Print reasoning in cyan, no prefix
-                            print_colored(delta['reasoning'], Fore.CYAN, end="")
-                            full_reasoning += delta['reasoning']
-                        
-                        # Check for content tokens
-                        elif 'content' in delta and delta['content'] is not None:
-                            # Check if we need to transition from reasoning to content
-                            if current_mode == "reasoning":
-                                print("\n\n")  # Add spacing between reasoning and content
-                                current_mode = "content"
-                            elif current_mode is None:
-                                current_mode = "content"
-                            
-                            # Print content in white, no prefix
-                            print_colored(delta['content'], Fore.WHITE, end="")
-                            full_response += delta['content']
-                            
-                    except json.JSONDecodeError:
-                        continue
-                    except Exception as e:
-                        # Just continue on parse errors
-                        continue
+                    # Print reasoning in cyan, no prefix
+                    renderer.write(delta['reasoning'], Fore.CYAN)
+                    reasoning_parts.append(delta['reasoning'])
+                
+                # Check for content tokens
+                elif 'content' in delta and delta['content'] is not None:
+                    # Check if we need to transition from reasoning to content
+                    if current_mode == "reasoning":
+                        renderer.write("\n\n\n")  # Add spacing between reasoning and content
+                        current_mode = "content"
+                    elif current_mode is None:
+                        current_mode = "content"
+                    
+                    # Print content in white, no prefix
+                    renderer.write(delta['content'], Fore.WHITE)
+                    content_parts.append(delta['content'])
+                    
+            except Exception as e:
+                # Just continue on parse errors
+                continue
         
         # Ensure newline at end
-        print()
+        renderer.close()
+        if usage:
+            report_prompt_cache_usage(usage)
         
         return {
-            "content": full_response,
-            "reasoning": full_reasoning
+            "content": "".join(content_parts),
+            "reasoning": "".join(reasoning_parts)
         }
+    except asyncio.CancelledError:
+        renderer.close()  # Keep what streamed before a /cancel
+        raise
     except Exception as e:
         print_colored(f"Error in streaming response: {e}", Fore.RED)
         return {"content": "", "reasoning": ""}
@@ -323,63 +1697,528 @@ def write_file_content(filepath, content):
     except IOError:
         return False
 
-def is_text_file(file_path, sample_size=8192, text_characters=set(bytes(range(32,127)) + b'\n\r\t\b')):
+TEXT_CHARACTERS = bytes(range(32, 127)) + b'\n\r\t\b'
+
+def is_text_sample(chunk):
+    """Check a byte sample for text, deleting text bytes in C via bytes.translate."""
+    if not chunk:  # Empty files are considered text
+        return True
+
+    if b'\x00' in chunk:  # Null bytes usually indicate binary
+        return False
+
+    # If >30% of chars are non-text, probably binary
+    non_text = len(chunk.translate(None, TEXT_CHARACTERS))
+    return non_text / len(chunk) < 0.3
+
+def is_text_file(file_path, sample_size=8192):
     """Determine whether a file is text or binary."""
     try:
         with open(file_path, 'rb') as f:
-            chunk = f.read(sample_size)
+            return is_text_sample(f.read(sample_size))
+    except IOError:
+        return False
+
+def compile_gitignore(gitignore_path):
+    """Turn a .gitignore file into a list of (regex, negate, dir_only) rules."""
+    rules = []
+    try:
+        with open(gitignore_path, 'r', encoding='utf-8', errors='ignore') as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return rules
 
-        if not chunk:  # Empty files are considered text
-            return True
+    for line in lines:
+        line = line.rstrip()
+        if not line or line.startswith('#'):
+            continue
+        negate = line.startswith('!')
+        if negate:
+            line = line[1:]
+        dir_only = line.endswith('/')
+        line = line.rstrip('/')
+        # Patterns with a slash are relative to the .gitignore, others match at any depth
+        anchored = '/' in line
+        line = line.lstrip('/')
 
-        if b'\x00' in chunk:  # Null bytes usually indicate binary
-            return False
+        regex = ""
+        for idx, part in enumerate(line.split('**')):
+            if idx:
+                if part.startswith('/'):
+                    regex += '(?:.*/)?'
+                    part = part[1:]
+                else:
+                    regex += '.*'
+            regex += translate_glob(part)
+        prefix = "" if anchored else "(?:.*/)?"
+        rules.append((re.compile(f"^{prefix}{regex}$"), negate, dir_only))
+    return rules
 
-        # If >30% of chars are non-text, probably binary
-        text_chars = sum(byte in text_characters for byte in chunk)
-        return text_chars / len(chunk) > 0.7
+def translate_glob(pattern):
+    """Translate a glob without "**" into a regex where wildcards stop at "/"."""
+    regex = ""
+    idx = 0
+    while idx < len(pattern):
+        char = pattern[idx]
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[' and pattern.find(']', idx + 1) != -1:
+            end = pattern.find(']', idx + 1)
+            body = pattern[idx + 1:end]
+            if body.startswith('!'):
+                body = '^' + body[1:]
+            regex += f"[{body}]"
+            idx = end
+        elif char == '\\' and idx + 1 < len(pattern):
+            idx += 1
+            regex += re.escape(pattern[idx])
+        else:
+            regex += re.escape(char)
+        idx += 1
+    return regex
+
+def is_ignored(path, is_dir, ignore_rules):
+    """Apply gitignore rules from the root down, the last matching rule wins."""
+    ignored = False
+    for base, rules in ignore_rules:
+        relative = path[len(base):].lstrip(os.sep).replace(os.sep, '/')
+        for regex, negate, dir_only in rules:
+            if dir_only and not is_dir:
+                continue
+            if regex.match(relative):
+                ignored = not negate
+    return ignored
 
+def tool_state_paths():
+    """Absolute paths of the console's own caches, journals, history, metrics and reports.
+
+    Paths are prefixes, so -wal, -journal and .tmp files next to them match
+    too. Unset paths are skipped: an empty one would match everything.
+    """
+    return tuple(os.path.abspath(path) for path in (
+        IMAGE_CACHE_DIR, SESSIONS_DIR, UNDO_DIR, RESPONSE_CACHE_PATH, SEARCH_CACHE_PATH, INDEX_PATH,
+        COMMAND_HISTORY_PATH, METRICS_JSONL, METRICS_PROM, *METRICS_EXPORT_PATHS.values(), BATCH_REPORT_PATH,
+    ) if path)
+
+def walk_text_candidates(root):
+    """Recursively list files under root that aren't gitignored or too large.
+
+    The console's own state (image cache, sessions, undo history, caches and
+    indexes) is never listed. Returns (candidates, skipped) where candidates
+    is a sorted list of paths and skipped counts files left out by reason.
+    """
+    state_paths = tool_state_paths()
+    candidates = []
+    skipped = {"ignored": 0, "too large": 0}
+    stack = [(root, [])]
+    while stack:
+        directory, ignore_rules = stack.pop()
+        gitignore = os.path.join(directory, '.gitignore')
+        if os.path.isfile(gitignore):
+            ignore_rules = ignore_rules + [(directory, compile_gitignore(gitignore))]
+        try:
+            with os.scandir(directory) as entries:
+                entries = sorted(entries, key=lambda entry: entry.name)
+        except OSError:
+            continue
+
+        subdirs = []
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name in ALWAYS_IGNORED_DIRS or os.path.abspath(entry.path) in state_paths:
+                        continue
+                    if is_ignored(entry.path, True, ignore_rules):
+                        continue
+                    subdirs.append((entry.path, ignore_rules))
+                elif entry.is_file():
+                    if os.path.abspath(entry.path).startswith(state_paths):
+                        continue
+                    if is_ignored(entry.path, False, ignore_rules):
+                        skipped["ignored"] += 1
+                    elif entry.stat().st_size > ADD_MAX_FILE_SIZE:
+                        skipped["too large"] += 1
+                    else:
+                        candidates.append(entry.path)
+            except OSError:
+                continue
+        stack.extend(reversed(subdirs))
+    return sorted(candidates), skipped
+
+def load_text_file(path):
+    """Read a file in one go if it's text. Returns its content or None."""
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
     except IOError:
-        return False
+        return None
+    if not is_text_sample(data[:8192]):
+        return None
+    try:
+        return data.decode('utf-8')
+    except UnicodeDecodeError:
+        return None
+
+async def ingest_directory(root):
+    """Load every text file under root on a thread pool, with progress and totals."""
+    loop = asyncio.get_running_loop()
+    start = time.perf_counter()
+    candidates, skipped = await loop.run_in_executor(None, walk_text_candidates, root)
+    skipped["binary"] = 0
+
+    with ThreadPoolExecutor(max_workers=ADD_WORKERS) as executor, Progress(
+        TextColumn("{task.description}"),
+        BarColumn(),
+        MofNCompleteColumn(),
+        TimeElapsedColumn(),
+        transient=True,
+    ) as progress:
+        task = progress.add_task(f"📁 Reading {root}", total=len(candidates))
+        futures = {loop.run_in_executor(executor, load_text_file, path): path for path in candidates}
+        for future in asyncio.as_completed(futures):
+            content = await future
+            progress.advance(task)
+            if content is None:
+                skipped["binary"] += 1
+        # Keep a deterministic order regardless of which read finished first
+        results = []
+        for future, path in futures.items():
+            content = future.result()
+            if content is not None:
+                results.append((path, content))
+
+    total_bytes = sum(len(content) for _, content in results)
+    skipped_summary = ", ".join(f"{count} {reason}" for reason, count in skipped.items() if count)
+    print_colored(
+        f"📁 {root}: read {len(results)} text files ({total_bytes / 1024:,.0f} KB) in {time.perf_counter() - start:.2f}s"
+        + (f", skipped {skipped_summary}" if skipped_summary else ""),
+        Fore.CYAN,
+    )
+    return results
+
+class FileContextStore:
+    """Files added with /add, keyed by path and content hash.
+
+    Each request sends the current version of every file once. Files are
+    re-read only when their mtime or size changes on disk.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.rendered_key = None
+        self.rendered = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, path):
+        return os.path.abspath(path) in self.entries
+
+    def paths(self):
+        return [entry["path"] for entry in self.entries.values()]
+
+    def add(self, path, content):
+        """Store a file's content. Returns "added", "updated" or "unchanged"."""
+        key = os.path.abspath(path)
+        digest = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        entry = self.entries.get(key)
+        stat = os.stat(path)
+        if entry and entry["hash"] == digest:
+            entry["mtime"], entry["size"] = stat.st_mtime_ns, stat.st_size
+            return "unchanged"
+
+        if entry is None:
+            entry = self.entries[key] = {"path": path, "base": content, "base_hash": digest}
+            status = "added"
+        else:
+            status = "updated"
+        entry.update(hash=digest, content=content, mtime=stat.st_mtime_ns, size=stat.st_size)
+        if FILE_REFRESH_MODE != "diff":
+            entry["base"], entry["base_hash"] = content, digest
+        return status
+
+    def refresh(self):
+        """Pick up files changed on disk, e.g. by /edit. Returns the changed paths."""
+        changed = []
+        for key, entry in list(self.entries.items()):
+            try:
+                stat = os.stat(key)
+            except OSError:
+                del self.entries[key]  # Deleted files drop out of context
+                changed.append(entry["path"])
+                continue
+            if (stat.st_mtime_ns, stat.st_size) == (entry["mtime"], entry["size"]):
+                continue
+            content = read_file_content(key)
+            if not content.startswith("❌") and self.add(entry["path"], content) == "updated":
+                changed.append(entry["path"])
+        return changed
+
+    def clear(self):
+        self.entries.clear()
+        self.rendered_key = self.rendered = None
+
+    def key(self):
+        """What the files are: changes whenever a file is added, updated or dropped."""
+        return tuple((key, entry["hash"], entry["base_hash"]) for key, entry in self.entries.items())
+
+    def restore(self, entries):
+        """Replace the files with entries from a session journal, keyed by absolute path."""
+        self.clear()
+        self.entries.update(entries)
+
+    def render_entry(self, entry):
+        if entry["base_hash"] == entry["hash"]:
+            return f"The following file has been added: {entry['path']}:\n\n{entry['content']}\n\n"
+
+        diff = "\n".join(unified_diff(str(entry["base"]).splitlines(), str(entry["content"]).splitlines(), n=2))
+        if len(diff) > len(entry["content"]) // 2:
+            # The diff is no longer compact, send the new version instead
+            entry["base"], entry["base_hash"] = entry["content"], entry["hash"]
+            return self.render_entry(entry)
+        return (
+            f"The following file has been added: {entry['path']}:\n\n{entry['base']}\n\n"
+            f"It has changed since then. Current differences:\n{diff}\n\n"
+        )
+
+    def render(self):
+        """Return the chat message carrying the current files, or None."""
+        self.refresh()
+        if not self.entries:
+            return None
+        key = tuple((entry["path"], entry["hash"], entry["base_hash"]) for entry in self.entries.values())
+        if key != self.rendered_key:
+            # Reuse the same string while nothing changes so token counts stay cached
+            self.rendered = "".join(self.render_entry(entry) for entry in self.entries.values())
+            self.rendered_key = key
+        return {"role": "user", "content": self.rendered, "pinned": True, "file_context": True}
+
+file_context = FileContextStore()
+
+def with_file_context(messages):
+    """Insert the current /add-ed files right after the system prompt."""
+    file_message = file_context.render()
+    if file_message is None:
+        return messages
+    insert_at = 1 if messages and messages[0]["role"] == "system" else 0
+    return messages[:insert_at] + [file_message] + messages[insert_at:]
+
+IDENTIFIER_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]*|[0-9]+")
+CAMEL_CASE_PATTERN = re.compile(r"[A-Z]+(?=[A-Z][a-z])|[A-Z]?[a-z]+|[A-Z]+|[0-9]+")
+
+@functools.lru_cache(maxsize=65536)
+def identifier_terms(identifier):
+    """Lowercase terms for one identifier, plus its snake_case and camelCase parts."""
+    lowered = identifier.lower()
+    terms = [lowered] if len(lowered) > 1 else []
+    parts = [part for word in identifier.split('_') for part in CAMEL_CASE_PATTERN.findall(word)]
+    if len(parts) > 1:
+        terms.extend(part.lower() for part in parts if len(part) > 1)
+    return tuple(terms)
+
+def tokenize_code(text):
+    """Count the identifier-aware terms in text."""
+    terms = Counter()
+    for identifier, count in Counter(IDENTIFIER_PATTERN.findall(text)).items():
+        for term in identifier_terms(identifier):
+            terms[term] += count
+    return terms
+
+class CodeIndex:
+    """Persistent BM25 inverted index over fixed-size line chunks of the working tree.
+
+    Postings live in SQLite so the index survives restarts, and only files
+    whose mtime or size changed are re-indexed on update.
+    """
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, path=INDEX_PATH, root="."):
+        self.root = root
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime INTEGER, size INTEGER);
+            CREATE TABLE IF NOT EXISTS chunks (
+                id INTEGER PRIMARY KEY, path TEXT, start_line INTEGER, end_line INTEGER,
+                length INTEGER, text TEXT
+            );
+            CREATE TABLE IF NOT EXISTS postings (term TEXT, chunk_id INTEGER, tf INTEGER);
+            CREATE INDEX IF NOT EXISTS postings_term ON postings (term);
+            CREATE INDEX IF NOT EXISTS postings_chunk ON postings (chunk_id);
+            CREATE INDEX IF NOT EXISTS chunks_path ON chunks (path);
+        """)
+
+    def update(self):
+        """Re-index changed files and drop deleted ones. Returns (indexed, removed)."""
+        candidates, _ = walk_text_candidates(self.root)
+        index_files = os.path.abspath(self.path)  # In case it isn't at INDEX_PATH
+        candidates = [path for path in candidates if not os.path.abspath(path).startswith(index_files)]
+        known = {path: (mtime, size) for path, mtime, size in self.db.execute("SELECT path, mtime, size FROM files")}
+        changed = []
+        for path in candidates:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if known.pop(path, None) != (stat.st_mtime_ns, stat.st_size):
+                changed.append((path, stat))
+
+        with ThreadPoolExecutor(max_workers=ADD_WORKERS) as executor:
+            contents = list(executor.map(lambda item: load_text_file(item[0]), changed))
+
+        with self.db:
+            for path in list(known) + [path for path, _ in changed]:
+                self.remove_file(path)
+            for (path, stat), content in zip(changed, contents):
+                self.db.execute(
+                    "INSERT INTO files VALUES (?, ?, ?)", (path, stat.st_mtime_ns, stat.st_size)
+                )
+                if content is not None:
+                    self.add_chunks(path, content)
+        return len(changed), len(known)
+
+    def remove_file(self, path):
+        self.db.execute(
+            "DELETE FROM postings WHERE chunk_id IN (SELECT id FROM chunks WHERE path = ?)", (path,)
+        )
+        self.db.execute("DELETE FROM chunks WHERE path = ?", (path,))
+        self.db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+    def add_chunks(self, path, content):
+        lines = content.split('\n')
+        for start in range(0, len(lines), INDEX_CHUNK_LINES):
+            text = '\n'.join(lines[start:start + INDEX_CHUNK_LINES])
+            terms = tokenize_code(text)
+            if not terms:
+                continue
+            chunk_id = self.db.execute(
+                "INSERT INTO chunks (path, start_line, end_line, length, text) VALUES (?, ?, ?, ?, ?)",
+                (path, start + 1, min(start + INDEX_CHUNK_LINES, len(lines)), sum(terms.values()), text),
+            ).lastrowid
+            self.db.executemany(
+                "INSERT INTO postings VALUES (?, ?, ?)",
+                [(term, chunk_id, tf) for term, tf in terms.items()],
+            )
+
+    def stats(self):
+        files, = self.db.execute("SELECT COUNT(*) FROM files").fetchone()
+        chunks, = self.db.execute("SELECT COUNT(*) FROM chunks").fetchone()
+        terms, = self.db.execute("SELECT COUNT(DISTINCT term) FROM postings").fetchone()
+        return files, chunks, terms
+
+    def search(self, query, top_k=RAG_TOP_K):
+        """Return the top_k (score, path, start_line, end_line, text) chunks for query."""
+        terms = sorted(tokenize_code(query))
+        total, avg_length = self.db.execute("SELECT COUNT(*), AVG(length) FROM chunks").fetchone()
+        if not terms or not total:
+            return []
+
+        placeholders = ",".join("?" * len(terms))
+        rows = self.db.execute(
+            f"SELECT p.term, p.chunk_id, p.tf, c.length FROM postings p "
+            f"JOIN chunks c ON c.id = p.chunk_id WHERE p.term IN ({placeholders})",
+            terms,
+        ).fetchall()
+        document_frequency = Counter(term for term, _, _, _ in rows)
+
+        scores = defaultdict(float)
+        for term, chunk_id, tf, length in rows:
+            df = document_frequency[term]
+            idf = math.log(1 + (total - df + 0.5) / (df + 0.5))
+            norm = tf + self.K1 * (1 - self.B + self.B * length / avg_length)
+            scores[chunk_id] += idf * tf * (self.K1 + 1) / norm
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+        results = []
+        for chunk_id, score in best:
+            path, start, end, text = self.db.execute(
+                "SELECT path, start_line, end_line, text FROM chunks WHERE id = ?", (chunk_id,)
+            ).fetchone()
+            results.append((score, path, start, end, text))
+        return results
+
+code_index = None
+
+def get_code_index():
+    global code_index
+    if code_index is None:
+        code_index = CodeIndex()
+    return code_index
+
+async def handle_index_command():
+    index = get_code_index()
+    start = time.perf_counter()
+    indexed, removed = await asyncio.get_running_loop().run_in_executor(None, index.update)
+    files, chunks, terms = index.stats()
+    print_colored(
+        f"🗂️ Index updated in {time.perf_counter() - start:.2f}s: {indexed} files re-indexed, {removed} removed. "
+        f"{files} files, {chunks} chunks, {terms} terms.",
+        Fore.GREEN,
+    )
+
+async def retrieve_context(query):
+    """Update the index and return a message with the chunks most relevant to query."""
+    index = get_code_index()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, index.update)
+    results = await loop.run_in_executor(None, index.search, query)
+    if not results:
+        return None
+
+    print_colored(
+        f"🔎 Attached {len(results)} relevant chunks: "
+        + ", ".join(f"{path}:{start}-{end}" for _, path, start, end, _ in results),
+        Fore.CYAN,
+    )
+    content = "Relevant code from the project:\n\n" + "\n".join(
+        f"File: {path} (lines {start}-{end})\n```\n{text}\n```\n"
+        for _, path, start, end, text in results
+    )
+    return {"role": "user", "content": content}
+
+def toggle_rag():
+    global is_rag_on
+    is_rag_on = not is_rag_on
+    status = "on" if is_rag_on else "off"
+    print_colored(
+        f"Retrieval mode is now {status} 🔎" if is_rag_on else f"Retrieval mode is now {status} 🚫",
+        Fore.YELLOW,
+    )
 
 async def handle_add_command(chat_history, *paths):
-    global added_files
     contents = []
-    new_context = ""
 
     for path in paths:
         if os.path.isfile(path):  # File handling
             content = read_file_content(path)
             if not content.startswith("❌"):
                 contents.append((path, content))
-                added_files.append(path)
 
         elif os.path.isdir(path):  # Directory handling
             print_colored(f"📁 Processing folder: {path}", Fore.CYAN)
-            for item in os.listdir(path):
-                item_path = os.path.join(path, item)
-                if os.path.isfile(item_path) and is_text_file(item_path):
-                    content = read_file_content(item_path)
-                    if not content.startswith("❌"):
-                        contents.append((item_path, content))
-                        added_files.append(item_path)
+            contents.extend(await ingest_directory(path))
 
         else:
             print_colored(f"❌ '{path}' is neither a valid file nor folder.", Fore.RED)
 
     if contents:
-        for fp, content in contents:
-            new_context += f"""The following file has been added: {fp}:
-\n{content}\n\n"""
-
-        chat_history.append({"role": "user", "content": new_context})
-        print_colored(f"✅ Added {len(contents)} files to knowledge!", Fore.GREEN)
+        statuses = [file_context.add(fp, content) for fp, content in contents]
+        added = statuses.count("added") + statuses.count("updated")
+        unchanged = statuses.count("unchanged")
+        if added:
+            print_colored(f"✅ Added {added} files to knowledge!", Fore.GREEN)
+        if unchanged:
+            print_colored(f"ℹ️ {unchanged} files were already in knowledge and unchanged.", Fore.YELLOW)
     else:
         print_colored("❌ No valid files were added to knowledge.", Fore.YELLOW)
 
     return chat_history
 
-async def handle_edit_command(default_chat_history, editor_chat_history, filepaths):
+async def handle_edit_command(default_chat_history, editor_chat_history, filepaths, user_request=None):
     all_contents = [read_file_content(fp) for fp in filepaths]
     valid_files, valid_contents = [], []
 
@@ -394,82 +2233,484 @@ async def handle_edit_command(default_chat_history, editor_chat_history, filepat
         print_colored("❌ No valid files to edit.", Fore.YELLOW)
         return default_chat_history, editor_chat_history
 
-    user_request = await get_input_async(f"What would you like to change in {', '.join(valid_files)}?")
-
-    instructions_prompt = "For these files:\n"
-    instructions_prompt += "\n".join([f"File: {fp}\n```\n{content}\n```\n" for fp, content in zip(valid_files, valid_contents)])
-    instructions_prompt += f"User wants: {user_request}\nProvide LINE-BY-LINE edit instructions for ALL files. Number each instruction and specify which file it applies to.\n"
+    if user_request is None:
+        user_request = await get_input_async(f"What would you like to change in {', '.join(valid_files)}?")
 
+    instructions_prompt = build_plan_prompt(valid_files, valid_contents, user_request)
     default_chat_history.append({"role": "user", "content": instructions_prompt})
-    default_instructions = get_streaming_response(default_chat_history, DEFAULT_MODEL)
+    default_instructions = (await get_streaming_response(default_chat_history, DEFAULT_MODEL, kind="plan"))["content"]
     default_chat_history.append({"role": "assistant", "content": default_instructions})
 
     print_colored("\n" + "=" * 50, Fore.MAGENTA)
+    transaction = get_undo_store().begin()  # One /undo reverts every file of this edit
 
-    for idx, (filepath, content) in enumerate(zip(valid_files, valid_contents), 1):
+    if EDIT_CONCURRENCY > 1 and len(valid_files) > 1:
+        editor_chat_history = await apply_edits_concurrently(
+            editor_chat_history, valid_files, default_instructions, transaction
+        )
+        return default_chat_history, editor_chat_history
+
+    for idx, filepath in enumerate(valid_files, 1):
         try:
             print_colored(f"📝 EDITING {filepath} ({idx}/{len(valid_files)}):", Fore.BLUE)
 
-            edit_message = f"""
+            current_content = read_file_content(filepath)  # Read fresh
+            if current_content.startswith("❌"):
+                return default_chat_history, editor_chat_history
+
+            renderer = StreamRenderer()
+            live_diff = None
+            if is_diff_on and is_live_diff_on and EDIT_MODE == "full":
+                live_diff = IncrementalDiff(current_content.split('\n'))
+
+            def echo_line(line_index, line, is_new):
+                if live_diff:
+                    live_diff.feed(line)
+                    return
+                if is_quiet_on:
+                    return
+                renderer.flush()
+                if is_new:
+                    print_colored(f"➕ NEW Line {line_index+1}: {line[:50]}...", Fore.YELLOW)
+                else:
+                    print_colored(f"✏️ Updated Line {line_index+1}: {line[:50]}...", Fore.CYAN)
+
+            edit_message, reply, result = await run_editor(
+                filepath,
+                current_content,
+                default_instructions,
+                editor_chat_history,
+                on_text=None if live_diff else renderer.write,
+                on_line=echo_line,
+            )
+            renderer.close()
+            if live_diff:
+                live_diff.finish()
+                print_colored("-" * 50, Fore.MAGENTA)
+            record_editor_turn(editor_chat_history, filepath, edit_message, reply)
+            apply_file_edit(filepath, current_content, result, transaction)
+
+            print_colored("=" * 50, Fore.MAGENTA)
+        except Exception as e:
+            print_colored(f"❌ Error editing {filepath}: {e}", Fore.RED)
+
+    return default_chat_history, editor_chat_history
+
+def build_plan_prompt(filepaths, contents, user_request):
+    """The planner message asking for edit instructions for every file."""
+    instructions_prompt = "For these files:\n"
+    if EDIT_MODE == "region":
+        # Line numbers let the instructions point at the regions to send the editor
+        contents = [number_lines(content) for content in contents]
+    instructions_prompt += "\n".join([f"File: {fp}\n```\n{content}\n```\n" for fp, content in zip(filepaths, contents)])
+    instructions_prompt += f"User wants: {user_request}\nProvide LINE-BY-LINE edit instructions for ALL files. Number each instruction and specify which file it applies to.\n"
+    if EDIT_MODE == "region":
+        instructions_prompt += "Refer to the line numbers and to function or class names in `backticks`.\n"
+    return instructions_prompt
+
+async def run_editor(filepath, current_content, instructions, editor_chat_history, on_text=None, on_line=None):
+    """Get the edited file from the editor model in the current EDIT_MODE.
+
+    Returns the user message and assistant reply to record in the editor
+    history, plus the new file content.
+    """
+    context = editor_context(editor_chat_history, filepath)
+    if EDIT_MODE == "region":
+        regions = find_edit_regions(current_content, instructions_for_file(instructions, filepath))
+        if regions:
+            edit_message = build_region_message(current_content, regions, instructions, filepath)
+            messages = [{"role": "system", "content": REGION_EDITOR_PROMPT}] + context
+            reply = await stream_editor_reply(messages + [{"role": "user", "content": edit_message}], on_text)
+            try:
+                result = apply_region_edits(current_content, regions, reply)
+                return edit_message, reply, result
+            except PatchApplyError as e:
+                print_colored(f"\n⚠️ {filepath}: {e}. Falling back to full regeneration.", Fore.YELLOW)
+
+    if EDIT_MODE == "patch":
+        edit_message = build_patch_message(current_content, instructions, filepath)
+        messages = [{"role": "system", "content": PATCH_EDITOR_PROMPT}] + context
+        reply = await stream_editor_reply(messages + [{"role": "user", "content": edit_message}], on_text)
+        try:
+            result = apply_search_replace(current_content, parse_search_replace_blocks(reply))
+            return edit_message, reply, result
+        except PatchApplyError as e:
+            print_colored(f"\n⚠️ {filepath}: {e}. Falling back to full regeneration.", Fore.YELLOW)
+
+    edit_message = build_edit_message(current_content, instructions, filepath)
+    result = await stream_file_edit(
+        current_content,
+        editor_chat_history[:1] + context + [{"role": "user", "content": edit_message}],
+        on_text=on_text,
+        on_line=on_line,
+    )
+    return edit_message, result, result
+
+def editor_context(editor_chat_history, filepath):
+    """The earlier editor turns to resend for an edit of filepath, per EDITOR_CONTEXT."""
+    if EDITOR_CONTEXT == "none":
+        return []
+    turns = editor_chat_history[1:]
+    if EDITOR_CONTEXT == "file":
+        turns = [message for message in turns if message.get("file") == filepath]
+        turns = turns[-2 * EDITOR_CONTEXT_EDITS:] if EDITOR_CONTEXT_EDITS > 0 else []
+    return [{"role": message["role"], "content": message["content"]} for message in turns]
+
+def record_editor_turn(editor_chat_history, filepath, edit_message, reply):
+    """Keep an edit in the editor history, unless the editor context never resends it."""
+    if EDITOR_CONTEXT == "none":
+        return
+    editor_chat_history.append({"role": "user", "content": edit_message, "file": filepath})
+    editor_chat_history.append({"role": "assistant", "content": reply, "file": filepath})
+
+def build_edit_message(content, instructions, filepath):
+    return f"""
             Original code:
 
             {content}
 
-            Instructions: {default_instructions}
+            Instructions: {instructions}
 
             Follow only instructions applicable to {filepath}. Output ONLY the new code. No explanations. DO NOT ADD ANYTHING ELSE. no type of file at the beginning of the file like ```python etq. no ``` at the end of the file.
             """
 
-            editor_chat_history.append({"role": "user", "content": edit_message})
+async def stream_file_edit(current_content, messages, on_text=None, on_line=None):
+    """Stream one editor completion and overlay its lines onto the current content."""
+    buffer = []  # Chunks of the line currently being streamed
+    edited_lines = current_content.split('\n')  # Store edited lines over the original ones
+    line_index = 0
+
+    def place_line(line):
+        nonlocal line_index
+        is_new = line_index >= len(edited_lines)
+        if is_new:
+            edited_lines.append(line)
+        else:
+            edited_lines[line_index] = line
+        if on_line:
+            on_line(line_index, line, is_new)
+        line_index += 1
+
+    async for chunk in stream_chat_completion({
+        "model": EDITOR_MODEL,
+        "messages": messages,
+        "stream": True,
+    }, kind="edit"):
+        content = (chunk.get('choices') or [{}])[0].get('delta', {}).get('content')
+        if content:
+            if on_text:
+                on_text(content)
+            buffer.append(content)
+            if '\n' not in content:
+                continue
+
+            *complete_lines, rest = "".join(buffer).split('\n')
+            buffer = [rest]
+            for line in complete_lines:
+                place_line(line)
+
+    # The last line usually has no trailing newline
+    rest = "".join(buffer)
+    if rest:
+        place_line(rest)
+
+    return '\n'.join(edited_lines)
+
+def build_patch_message(content, instructions, filepath):
+    return f"""
+            Original code of {filepath}:
+
+            {content}
+
+            Instructions: {instructions}
+
+            Follow only instructions applicable to {filepath}. Output ONLY SEARCH/REPLACE blocks. No explanations.
+            """
+
+async def stream_editor_reply(messages, on_text=None):
+    """Stream an editor completion and return its full text."""
+    parts = []
+    async for chunk in stream_chat_completion({
+        "model": EDITOR_MODEL,
+        "messages": messages,
+        "stream": True,
+    }, kind="edit"):
+        content = (chunk.get('choices') or [{}])[0].get('delta', {}).get('content')
+        if content:
+            if on_text:
+                on_text(content)
+            parts.append(content)
+    return "".join(parts)
+
+class PatchApplyError(Exception):
+    """Raised when editor edit blocks can't be applied to a file."""
+
+SEARCH_REPLACE_PATTERN = re.compile(
+    r"^<{5,}[ \t]*SEARCH[^\n]*\n(.*?)^={5,}[ \t]*\n(.*?)^>{5,}[ \t]*REPLACE[^\n]*$",
+    re.MULTILINE | re.DOTALL,
+)
+
+def parse_search_replace_blocks(reply):
+    """Extract (search, replace) pairs from an editor reply."""
+    blocks = [
+        (search[:-1] if search.endswith('\n') else search,
+         replace[:-1] if replace.endswith('\n') else replace)
+        for search, replace in SEARCH_REPLACE_PATTERN.findall(reply)
+    ]
+    if not blocks and reply.strip():
+        raise PatchApplyError("no SEARCH/REPLACE blocks in editor reply")
+    return blocks
+
+def find_anchor(lines, search_lines, start=0):
+    """Find where search_lines occur in lines: exactly, ignoring whitespace, or fuzzily."""
+    size = len(search_lines)
+    candidates = list(range(start, len(lines) - size + 1)) + list(range(0, min(start, len(lines) - size + 1)))
+
+    for idx in candidates:
+        if lines[idx:idx + size] == search_lines:
+            return idx
+
+    stripped = [line.strip() for line in search_lines]
+    for idx in candidates:
+        if [line.strip() for line in lines[idx:idx + size]] == stripped:
+            return idx
+
+    # Fuzzy match for blocks the model copied with small mistakes
+    target = "\n".join(stripped)
+    matcher = difflib.SequenceMatcher(None, autojunk=False)
+    matcher.set_seq2(target)
+    best_idx, best_ratio = None, PATCH_FUZZ_THRESHOLD
+    for idx in candidates:
+        matcher.set_seq1("\n".join(line.strip() for line in lines[idx:idx + size]))
+        if matcher.real_quick_ratio() < best_ratio or matcher.quick_ratio() < best_ratio:
+            continue
+        ratio = matcher.ratio()
+        if ratio > best_ratio:
+            best_idx, best_ratio = idx, ratio
+    return best_idx
+
+def apply_search_replace(content, blocks):
+    """Apply SEARCH/REPLACE blocks to content, raising PatchApplyError on a miss."""
+    lines = content.split('\n')
+    position = 0
+    for number, (search, replace) in enumerate(blocks, 1):
+        replace_lines = replace.split('\n') if replace else []
+        if not search.strip():
+            # Empty SEARCH appends to the end of the file
+            if lines and lines[-1] == "":
+                lines[-1:] = replace_lines + [""]
+            else:
+                lines.extend(replace_lines)
+            continue
+
+        search_lines = search.split('\n')
+        idx = find_anchor(lines, search_lines, position)
+        if idx is None:
+            raise PatchApplyError(f"block {number} doesn't match the file")
+        lines[idx:idx + len(search_lines)] = replace_lines
+        position = idx + len(replace_lines)
+    return '\n'.join(lines)
+
+def apply_file_edit(filepath, current_content, result, transaction):
+    if is_diff_on:
+        display_diff(current_content, result)  # Show final diff if it's on
+
+    # Write the changes to the file only after the entire editing process
+    if write_file_content(filepath, result):
+        get_undo_store().record(transaction, filepath, current_content, result)  # Store undo
+        print_colored(f"✅ {filepath} successfully edited and saved!", Fore.GREEN)
+    else:
+        print_colored(f"❌ Failed to save changes to {filepath}", Fore.RED)
+
+# "line 5", "lines 5-9", "lines 5, 12 and 40 to 44": ranges use -, –, to or
+# through, while commas and "and" separate a list of lines or ranges
+LINE_RANGE_PATTERN = re.compile(r"(\d+)(?:\s*(?:-|–|\bto\b|\bthrough\b)\s*(\d+))?", re.IGNORECASE)
+LINE_REFERENCE_PATTERN = re.compile(
+    rf"\blines?\s+{LINE_RANGE_PATTERN.pattern}(?:\s*(?:,\s*(?:and\b)?|\band\b)\s*{LINE_RANGE_PATTERN.pattern})*",
+    re.IGNORECASE,
+)
+SYMBOL_REFERENCE_PATTERN = re.compile(r"`([A-Za-z_][\w.]*)(?:\(\))?`")
+DEFINITION_KEYWORDS = r"(?:async\s+)?(?:def|class|function|func|fn|struct|interface|enum|type|const|let|var)"
+IMPORT_LINE_PATTERN = re.compile(r"^\s*(?:import\b|from\s+\S+\s+import\b|#include\b|using\b|require\b|use\b|package\b)")
+INSTRUCTION_START_PATTERN = re.compile(r"^\s*(?:\d+[.)]|[-*])\s")
+
+def number_lines(content):
+    return "\n".join(f"{number:>5} | {line}" for number, line in enumerate(content.split('\n'), 1))
+
+def instructions_for_file(instructions, filepath):
+    """Keep the numbered planner instructions that mention filepath.
+
+    Returns all instructions when none of them name the file, so a plan that
+    only ever talks about "the file" still works.
+    """
+    items, current = [], []
+    for line in instructions.split('\n'):
+        if INSTRUCTION_START_PATTERN.match(line) and current:
+            items.append("\n".join(current))
+            current = []
+        current.append(line)
+    if current:
+        items.append("\n".join(current))
+    names = {filepath, os.path.basename(filepath)}
+    relevant = [item for item in items if any(name in item for name in names)]
+    return "\n".join(relevant) if relevant else instructions
+
+def block_end(lines, start):
+    """Last line of the indented block (or brace block) that starts at start."""
+    indent = len(lines[start]) - len(lines[start].lstrip())
+    end = start
+    for index in range(start + 1, min(len(lines), start + REGION_MAX_BLOCK_LINES)):
+        line = lines[index]
+        if not line.strip():
+            continue
+        line_indent = len(line) - len(line.lstrip())
+        if line_indent <= indent:
+            if line.strip()[0] in ")]}":
+                end = index  # Closing brace of a C-style block
+            break
+        end = index
+    return end
+
+def find_edit_regions(content, instructions):
+    """Line ranges (start, end), 0-based and inclusive, that the instructions refer to.
+
+    Returns None when nothing can be located or the regions would cover most
+    of the file, in which case regenerating the whole file is as cheap.
+    """
+    lines = content.split('\n')
+    spans = []
+    for reference in LINE_REFERENCE_PATTERN.finditer(instructions):
+        for match in LINE_RANGE_PATTERN.finditer(reference.group(0)):
+            first, last = sorted((int(match.group(1)), int(match.group(2) or match.group(1))))
+            if not 1 <= first <= len(lines):
+                continue
+            start, end = first - 1, min(last, len(lines)) - 1
+            if first == last:
+                end = block_end(lines, start)  # A single line may be a def or class header
+            spans.append((start, end))
+
+    for symbol in set(SYMBOL_REFERENCE_PATTERN.findall(instructions)):
+        name = re.escape(symbol.split('.')[-1])
+        definition = re.compile(rf"^\s*(?:export\s+)?(?:pub\s+)?{DEFINITION_KEYWORDS}\s+{name}\b")
+        found = [index for index, line in enumerate(lines) if definition.match(line)]
+        if not found:
+            usage = re.compile(rf"\b{name}\b")
+            found = [index for index, line in enumerate(lines) if usage.search(line)][:3]
+        spans.extend((index, block_end(lines, index)) for index in found)
+
+    if re.search(r"\bimports?\b", instructions, re.IGNORECASE):
+        header = [index for index, line in enumerate(lines[:200]) if IMPORT_LINE_PATTERN.match(line)]
+        spans.append((0, header[-1] if header else 0))
+
+    if not spans:
+        return None
+    regions = []
+    for start, end in sorted(spans):
+        start = max(0, start - REGION_CONTEXT_LINES)
+        end = min(len(lines) - 1, end + REGION_CONTEXT_LINES)
+        if regions and start <= regions[-1][1] + 1:
+            regions[-1] = (regions[-1][0], max(regions[-1][1], end))
+        else:
+            regions.append((start, end))
+    covered = sum(end - start + 1 for start, end in regions)
+    if covered > REGION_MAX_FRACTION * len(lines):
+        return None
+    return regions
+
+def build_region_message(content, regions, instructions, filepath):
+    lines = content.split('\n')
+    parts = [f"Regions of {filepath} ({len(lines)} lines in total):\n"]
+    for number, (start, end) in enumerate(regions, 1):
+        parts.append(f"### REGION {number} (lines {start + 1}-{end + 1})")
+        parts.extend(lines[start:end + 1])
+        parts.append("### END\n")
+    parts.append(f"Instructions: {instructions}\n")
+    parts.append(f"Follow only instructions applicable to {filepath}. Output ONLY the changed regions. No explanations.")
+    return "\n".join(parts)
+
+REGION_REPLY_PATTERN = re.compile(
+    r"^###[ \t]*(REGION[ \t]+(\d+)|APPEND)[^\n]*\n(.*?)^###[ \t]*END[ \t]*$",
+    re.MULTILINE | re.DOTALL,
+)
+
+def apply_region_edits(content, regions, reply):
+    """Splice the regions rewritten in reply back into content."""
+    lines = content.split('\n')
+    replacements, appended = {}, []
+    for match in REGION_REPLY_PATTERN.finditer(reply):
+        body = match.group(3)[:-1] if match.group(3).endswith('\n') else match.group(3)
+        if match.group(2) is None:
+            appended.extend(body.split('\n'))
+            continue
+        number = int(match.group(2))
+        if not 1 <= number <= len(regions):
+            raise PatchApplyError(f"the editor returned unknown region {number}")
+        replacements[number - 1] = body.split('\n') if body else []
+
+    if not replacements and not appended and reply.strip():
+        raise PatchApplyError("no regions found in the editor reply")
+
+    # Splice from the bottom so earlier line numbers stay valid
+    for index in sorted(replacements, reverse=True):
+        start, end = regions[index]
+        lines[start:end + 1] = replacements[index]
+    if appended:
+        if lines and not lines[-1]:
+            lines[-1:] = appended + ['']  # Keep the trailing newline
+        else:
+            lines.extend(appended)
+    return '\n'.join(lines)
+
+async def apply_edits_concurrently(editor_chat_history, filepaths, instructions, transaction):
+    """Run the editor on every file in parallel, then apply the results in order."""
+    semaphore = asyncio.Semaphore(EDIT_CONCURRENCY)
+    print_colored(
+        f"📝 EDITING {len(filepaths)} files (up to {EDIT_CONCURRENCY} at a time):", Fore.BLUE
+    )
+
+    with Progress(
+        TextColumn("{task.description}"),
+        BarColumn(),
+        MofNCompleteColumn(),
+        TimeElapsedColumn(),
+    ) as progress:
 
+        async def edit_one(filepath):
             current_content = read_file_content(filepath)  # Read fresh
             if current_content.startswith("❌"):
-                return default_chat_history, editor_chat_history
+                raise IOError(current_content)
+            total_lines = current_content.count('\n') + 1
+            task = progress.add_task(f"⏳ {filepath}", total=total_lines)
+            async with semaphore:
+                progress.update(task, description=f"📝 {filepath}")
+                edit_message, reply, result = await run_editor(
+                    filepath,
+                    current_content,
+                    instructions,
+                    editor_chat_history,
+                    on_line=lambda line_index, line, is_new: progress.update(
+                        task, completed=line_index + 1
+                    ),
+                )
+            progress.update(task, completed=total_lines, description=f"✅ {filepath}")
+            return edit_message, reply, current_content, result
 
-            lines = current_content.split('\n')
-            buffer = ""
-            edited_lines = lines.copy()  # Create a copy to store edited lines
-            line_index = 0
-
-            for chunk in client.chat.completions.create(
-                model=EDITOR_MODEL,
-                messages=editor_chat_history,
-                stream=True,
-            ):
-                if chunk.choices[0].delta.content:
-                    content = chunk.choices[0].delta.content
-                    print_colored(content, end="")
-                    buffer += content
-
-                    while '\n' in buffer:
-                        line, buffer = buffer.split('\n', 1)
-                        if line_index < len(edited_lines):
-                            edited_lines[line_index] = line
-                            print_colored(f"✏️ Updated Line {line_index+1}: {line[:50]}...", Fore.CYAN)
-                            line_index += 1
-                        else:
-                            edited_lines.append(line)
-                            print_colored(f"➕ NEW Line {line_index+1}: {line[:50]}...", Fore.YELLOW)
-                            line_index += 1
-
-            result = '\n'.join(edited_lines)
-            undo_history[filepath] = current_content   # Store undo
-            editor_chat_history.append({"role": "assistant", "content": result})
-
-            if is_diff_on:
-                display_diff(current_content, result)  # Show final diff if it's on
-
-            # Write the changes to the file only after the entire editing process
-            if write_file_content(filepath, result):
-                print_colored(f"✅ {filepath} successfully edited and saved!", Fore.GREEN)
-            else:
-                print_colored(f"❌ Failed to save changes to {filepath}", Fore.RED)
+        outcomes = await asyncio.gather(
+            *(edit_one(fp) for fp in filepaths), return_exceptions=True
+        )
 
-            print_colored("=" * 50, Fore.MAGENTA)
-        except Exception as e:
-            print_colored(f"❌ Error editing {filepath}: {e}", Fore.RED)
+    # Apply diffs and writes in the order the files were given
+    for filepath, outcome in zip(filepaths, outcomes):
+        if isinstance(outcome, BaseException):
+            print_colored(f"❌ Error editing {filepath}: {outcome}", Fore.RED)
+            continue
+        edit_message, reply, current_content, result = outcome
+        print_colored(f"📝 {filepath}:", Fore.BLUE)
+        record_editor_turn(editor_chat_history, filepath, edit_message, reply)
+        apply_file_edit(filepath, current_content, result, transaction)
+        print_colored("=" * 50, Fore.MAGENTA)
 
-    return default_chat_history, editor_chat_history
+    return editor_chat_history
 
 async def handle_new_command(default_chat_history, editor_chat_history, filepaths):
     if not filepaths:
@@ -502,11 +2743,11 @@ async def handle_new_command(default_chat_history, editor_chat_history, filepath
     return default_chat_history, editor_chat_history
 
 async def handle_clear_command():
-    global added_files, stored_searches, stored_images
+    global stored_searches, stored_images
     cleared_something = False
 
-    if added_files:
-        added_files.clear()
+    if file_context:
+        file_context.clear()
         cleared_something = True
         print_colored("✅ Cleared memory of added files.", Fore.GREEN)
 
@@ -526,10 +2767,10 @@ async def handle_clear_command():
 
 async def handle_reset_command(default_chat_history, editor_chat_history):
     """Clears all chat history and added files memory."""
-    global added_files, stored_searches, stored_images
+    global stored_searches, stored_images
     default_chat_history.clear()
     editor_chat_history.clear()
-    added_files.clear()
+    file_context.clear()
     stored_searches.clear()
     stored_images.clear()
 
@@ -544,8 +2785,13 @@ async def handle_reset_command(default_chat_history, editor_chat_history):
 
     return default_chat_history, editor_chat_history  # Return the resetted histories
 
-def toggle_diff():
-    global is_diff_on
+def toggle_diff(argument=""):
+    global is_diff_on, is_live_diff_on
+    if argument.strip().lower() == "live":
+        is_live_diff_on = not is_live_diff_on
+        is_diff_on = is_diff_on or is_live_diff_on
+        print_colored(f"Live diff is now {'on 🚀' if is_live_diff_on else 'off 🚫'}", Fore.YELLOW)
+        return
     is_diff_on = not is_diff_on
     status = "on" if is_diff_on else "off"
     print_colored(
@@ -553,6 +2799,37 @@ def toggle_diff():
         Fore.YELLOW,
     )
 
+async def change_edit_mode(mode):
+    global EDIT_MODE
+    if not mode:
+        mode = await get_input_async(f"Enter the edit mode ({'/'.join(EDIT_MODES)}): ")
+    mode = mode.strip().lower()
+    if mode not in EDIT_MODES:
+        print_colored(f"❌ Unknown edit mode '{mode}'. Choose one of: {', '.join(EDIT_MODES)}", Fore.RED)
+        return
+    EDIT_MODE = mode
+    print_colored(f"Edit mode changed to: {EDIT_MODE}", Fore.GREEN)
+
+async def change_editor_context(policy):
+    global EDITOR_CONTEXT
+    if not policy:
+        policy = await get_input_async(f"Enter the editor context ({'/'.join(EDITOR_CONTEXTS)}): ")
+    policy = policy.strip().lower()
+    if policy not in EDITOR_CONTEXTS:
+        print_colored(f"❌ Unknown editor context '{policy}'. Choose one of: {', '.join(EDITOR_CONTEXTS)}", Fore.RED)
+        return
+    EDITOR_CONTEXT = policy
+    print_colored(f"Editor context changed to: {EDITOR_CONTEXT}", Fore.GREEN)
+
+def toggle_quiet():
+    global is_quiet_on
+    is_quiet_on = not is_quiet_on
+    status = "on" if is_quiet_on else "off"
+    print_colored(
+        f"Quiet mode is now {status} 🤫" if is_quiet_on else f"Quiet mode is now {status} 📣",
+        Fore.YELLOW,
+    )
+
 def handle_history_command(chat_history):
     print_colored("\n📜 Chat History:", Fore.BLUE)
     for idx, message in enumerate(chat_history[1:], 1):  # Skip system message
@@ -560,74 +2837,443 @@ def handle_history_command(chat_history):
         content = message['content'][:100] + "..." if len(message['content']) > 100 else message['content']
         print_colored(f"{idx}. {role}: {content}", Fore.CYAN)
 
-async def handle_save_command(chat_history):
-    filename = await get_input_async("Enter filename to save chat history:")
+class SessionJournal:
+    """Append-only, gzip-compressed JSONL journal of the chat history.
+
+    Every message is written as soon as it lands in the history, one gzip
+    member per record so a crash only loses the record being written. Long
+    strings such as file bodies and image data URIs are stored once in a
+    content-addressed blob store shared by all sessions.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.path = os.path.join(SESSIONS_DIR, f"{name}.jsonl.gz")
+        self.blob_dir = os.path.join(SESSIONS_DIR, "blobs")
+        self.written = []  # (message, pinned) for each journaled index
+        self.files_key = None  # file_context.key() when the files were last journaled
+
+    @staticmethod
+    def list_sessions():
+        try:
+            names = [name[:-len(".jsonl.gz")] for name in os.listdir(SESSIONS_DIR) if name.endswith(".jsonl.gz")]
+        except OSError:
+            return []
+        return sorted(names)
+
+    def blob_path(self, digest):
+        return os.path.join(self.blob_dir, digest[:2], digest + ".gz")
+
+    def store_blobs(self, value):
+        """Replace long strings in a message with {"$blob": sha256, "length": n} references."""
+        if isinstance(value, BlobRef):
+            return {"$blob": value.digest, "length": len(value)}  # Already stored
+        if isinstance(value, str):
+            if len(value) < SESSION_BLOB_THRESHOLD:
+                return value
+            data = value.encode("utf-8")
+            digest = hashlib.sha256(data).hexdigest()
+            path = self.blob_path(digest)
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                with open(temp_path, "wb") as f:
+                    f.write(gzip.compress(data, compresslevel=6))
+                os.replace(temp_path, path)
+            return {"$blob": digest, "length": len(value)}
+        if isinstance(value, dict):
+            return {key: self.store_blobs(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.store_blobs(item) for item in value]
+        return value
+
+    def load_blobs(self, value):
+        """Turn blob references into BlobRefs, without reading the blobs."""
+        if isinstance(value, dict):
+            if "$blob" in value and set(value) <= {"$blob", "length"}:
+                return BlobRef(self.blob_path(value["$blob"]), value["$blob"], value.get("length"))
+            return {key: self.load_blobs(item) for key, item in value.items()}
+        if isinstance(value, list):
+            return [self.load_blobs(item) for item in value]
+        return value
+
+    def write(self, records):
+        os.makedirs(SESSIONS_DIR, exist_ok=True)
+        with open(self.path, "ab") as f:
+            for record in records:
+                line = json.dumps(record, ensure_ascii=False) + "\n"
+                f.write(gzip.compress(line.encode("utf-8"), compresslevel=6))
+            f.flush()
+            os.fsync(f.fileno())
+
+    def sync(self, history):
+        """Journal whatever changed in history since the last sync."""
+        common = 0
+        for (message, pinned), current in zip(self.written, history):
+            if message is not current or pinned != bool(current.get("pinned")):
+                break
+            common += 1
+
+        records = []
+        if common < len(self.written):
+            records.append({"op": "truncate", "length": common})
+            del self.written[common:]
+        for message in history[common:]:
+            records.append({"op": "append", "message": self.store_blobs(message)})
+            self.written.append((message, bool(message.get("pinned"))))
+        files_key = file_context.key()
+        if files_key != self.files_key:
+            files = [dict(self.store_blobs(entry), key=key) for key, entry in file_context.entries.items()]
+            records.append({"op": "files", "files": files})
+            self.files_key = files_key
+        if records:
+            try:
+                self.write(records)
+            except OSError as e:
+                print_colored(f"⚠️ Couldn't journal the session: {e}", Fore.YELLOW)
+
+    def load(self):
+        """Rebuild the history and /add-ed files by streaming the journal.
+
+        Long strings stay in the blob store as BlobRefs until they're sent.
+        Stops at a torn final record. Returns (history, file context entries).
+        """
+        history = []
+        files = {}
+        try:
+            with gzip.open(self.path, "rt", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    if record["op"] == "truncate":
+                        del history[record["length"]:]
+                    elif record["op"] == "append":
+                        history.append(self.load_blobs(record["message"]))
+                    elif record["op"] == "files":
+                        files = {entry.pop("key"): self.load_blobs(entry) for entry in record["files"]}
+        except (EOFError, gzip.BadGzipFile, zlib.error):
+            print_colored(f"⚠️ {self.name} ends with an incomplete record, recovered {len(history)} messages.", Fore.YELLOW)
+        self.written = [(message, bool(message.get("pinned"))) for message in history]
+        self.files_key = tuple((key, entry["hash"], entry["base_hash"]) for key, entry in files.items())
+        return history, files
+
+session_journal = SessionJournal(datetime.now().strftime("session-%Y%m%d-%H%M%S"))
+
+async def handle_save_command(chat_history, name=""):
+    """Continue journaling the current chat under a new name."""
+    global session_journal
+    name = name.strip() or await get_input_async("Enter a name to save the session as:")
+    if not name:
+        print_colored("❌ No session name given.", Fore.RED)
+        return
     try:
-        with open(filename, 'w') as f:
-            json.dump(chat_history, f)
-        print_colored(f"✅ Chat history saved to {filename}", Fore.GREEN)
+        journal = SessionJournal(name)
+        if os.path.exists(journal.path):
+            os.remove(journal.path)
+        journal.sync(chat_history)
+        session_journal = journal
+        print_colored(f"✅ Session saved as {name} ({journal.path})", Fore.GREEN)
     except IOError as e:
         print_colored(f"❌ Error saving chat history: {e}", Fore.RED)
 
-async def handle_load_command():
-    filename = await get_input_async("Enter filename to load chat history:")
+async def handle_load_command(name=""):
+    global session_journal
+    sessions = SessionJournal.list_sessions()
+    if not name.strip() and sessions:
+        print_colored(f"💾 Saved sessions: {', '.join(sessions)}", Fore.CYAN)
+    name = name.strip() or await get_input_async("Enter the session (or .json file) to load:")
     try:
-        with open(filename, 'r') as f:
-            loaded_history = json.load(f)
-        print_colored(f"✅ Chat history loaded from {filename}", Fore.GREEN)
+        if name.endswith(".json") and os.path.isfile(name):
+            # Chat histories saved by older versions
+            with open(name, 'r') as f:
+                loaded_history = json.load(f)
+            session_journal = SessionJournal(os.path.splitext(os.path.basename(name))[0])
+            session_journal.sync(loaded_history)
+        else:
+            journal = SessionJournal(name)
+            if not os.path.exists(journal.path):
+                raise IOError(f"No saved session named {name}")
+            loaded_history, files = journal.load()
+            file_context.restore(files)
+            session_journal = journal
+        print_colored(f"✅ Chat history loaded from {name} ({len(loaded_history)} messages)", Fore.GREEN)
+        if file_context:
+            print_colored(f"📂 Restored {len(file_context)} added files: {', '.join(file_context.paths())}", Fore.GREEN)
         return loaded_history
     except IOError as e:
         print_colored(f"❌ Error loading chat history: {e}", Fore.RED)
         return None
 
-async def handle_undo_command(filepath):
-    if not filepath:
-        print_colored("❌ No filepath provided for undo operation.", Fore.RED)
-        return
-    if filepath in undo_history:
-        content = undo_history[filepath]
-        if write_file_content(filepath, content):
-            print_colored(f"✅ Undid last edit for {filepath}", Fore.GREEN)
-            del undo_history[filepath]  # Remove the used undo history
+def make_patch(source, target):
+    """Line operations that turn source into target: [start, end, replacement lines]."""
+    source_lines = source.splitlines(keepends=True)
+    target_lines = target.splitlines(keepends=True)
+    return [
+        [i1, i2, target_lines[j1:j2]]
+        for tag, i1, i2, j1, j2 in diff_opcodes(source_lines, target_lines)
+        if tag != 'equal'
+    ]
+
+def apply_patch(source, patch):
+    lines = source.splitlines(keepends=True)
+    for start, end, replacement in reversed(patch):
+        lines[start:end] = replacement
+    return "".join(lines)
+
+def content_hash(content):
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+class UndoStore:
+    """Per-file undo/redo stacks of compressed reverse patches, kept on disk.
+
+    Each edit is recorded as a patch from the new content back to the old
+    one, so a stack costs roughly the size of the changes rather than whole
+    copies of the file. Entries carry the transaction of the /edit that made
+    them, so one /undo can revert every file that edit touched.
+    """
+
+    def __init__(self, directory=UNDO_DIR):
+        self.directory = directory
+        self.index_path = os.path.join(directory, "index.json")
+        self.index = {"next_transaction": 1, "next_entry": 1, "undo": {}, "redo": {}}
+        try:
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        except (IOError, ValueError):
+            pass
+        self.cache = OrderedDict()
+        self.cache_bytes = 0
+
+    def begin(self):
+        transaction = self.index["next_transaction"]
+        self.index["next_transaction"] += 1
+        return transaction
+
+    def save_index(self):
+        os.makedirs(self.directory, exist_ok=True)
+        temp_path = self.index_path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(temp_path, self.index_path)
+
+    def patch_path(self, entry_id):
+        return os.path.join(self.directory, f"{entry_id}.patch")
+
+    def save_patch(self, patch):
+        entry_id = self.index["next_entry"]
+        self.index["next_entry"] += 1
+        data = zlib.compress(json.dumps(patch).encode("utf-8"))
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.patch_path(entry_id), "wb") as f:
+            f.write(data)
+        self.remember(entry_id, data)
+        return entry_id
+
+    def remember(self, entry_id, data):
+        self.cache[entry_id] = data
+        self.cache_bytes += len(data)
+        while self.cache_bytes > UNDO_CACHE_MB * 1024 * 1024 and len(self.cache) > 1:
+            _, evicted = self.cache.popitem(last=False)
+            self.cache_bytes -= len(evicted)
+
+    def load_patch(self, entry_id):
+        data = self.cache.pop(entry_id, None)
+        if data is None:
+            with open(self.patch_path(entry_id), "rb") as f:
+                data = f.read()
         else:
-            print_colored(f"❌ Failed to undo edit for {filepath}", Fore.RED)
+            self.cache_bytes -= len(data)
+        return json.loads(zlib.decompress(data))
+
+    def drop_entry(self, entry):
+        data = self.cache.pop(entry["id"], None)
+        if data is not None:
+            self.cache_bytes -= len(data)
+        try:
+            os.remove(self.patch_path(entry["id"]))
+        except OSError:
+            pass
+
+    def push(self, stack, path, transaction, patch, expects):
+        self.index[stack].setdefault(path, []).append({
+            "transaction": transaction,
+            "id": self.save_patch(patch),
+            "expects": expects,
+            "order": self.index["next_entry"],
+        })
+
+    def record(self, transaction, filepath, before, after):
+        if before == after:
+            return
+        path = os.path.abspath(filepath)
+        for entry in self.index["redo"].pop(path, []):  # A new edit invalidates redo
+            self.drop_entry(entry)
+        self.push("undo", path, transaction, make_patch(after, before), content_hash(after))
+        self.save_index()
+
+    def step(self, path, source, target):
+        """Move the newest entry for path from the source stack to the target stack."""
+        entry = self.index[source][path][-1]
+        current = read_file_content(path)
+        if current.startswith("❌") or content_hash(current) != entry["expects"]:
+            raise ValueError(f"{path} has changed since that edit, not touching it")
+        restored = apply_patch(current, self.load_patch(entry["id"]))
+        if not write_file_content(path, restored):
+            raise IOError(f"Failed to write {path}")
+        self.index[source][path].pop()
+        if not self.index[source][path]:
+            del self.index[source][path]
+        self.drop_entry(entry)
+        self.push(target, path, entry["transaction"], make_patch(restored, current), content_hash(restored))
+
+    def latest_transaction(self, stack):
+        tops = [entries[-1] for entries in self.index[stack].values() if entries]
+        if not tops:
+            return None
+        return max(tops, key=lambda entry: entry["order"])["transaction"]
+
+    def move(self, stack, filepath=None, count=1):
+        """Undo (stack="undo") or redo (stack="redo") edits. Returns the paths changed."""
+        target = "redo" if stack == "undo" else "undo"
+        changed = []
+        try:
+            for _ in range(count):
+                if filepath:
+                    path = os.path.abspath(filepath)
+                    if not self.index[stack].get(path):
+                        break
+                    self.step(path, stack, target)
+                    changed.append(path)
+                else:
+                    transaction = self.latest_transaction(stack)
+                    if transaction is None:
+                        break
+                    for path, entries in list(self.index[stack].items()):
+                        if entries and entries[-1]["transaction"] == transaction:
+                            self.step(path, stack, target)
+                            changed.append(path)
+        finally:
+            self.save_index()
+        return changed
+
+    def depth(self, filepath):
+        path = os.path.abspath(filepath)
+        return len(self.index["undo"].get(path, [])), len(self.index["redo"].get(path, []))
+
+undo_store = None
+
+def get_undo_store():
+    global undo_store
+    if undo_store is None:
+        undo_store = UndoStore()
+    return undo_store
+
+def parse_undo_arguments(argument):
+    """Split "[file] [n]" into (filepath or None, count)."""
+    parts = argument.split()
+    count = 1
+    if parts and parts[-1].isdigit():
+        count = int(parts.pop())
+    return (" ".join(parts) or None), count
+
+async def handle_undo_command(argument, redo=False):
+    """Undo or redo the last n edits of a file, or the whole last /edit without a file."""
+    filepath, count = parse_undo_arguments(argument)
+    store = get_undo_store()
+    action = "Redid" if redo else "Undid"
+    try:
+        changed = store.move("redo" if redo else "undo", filepath, count)
+    except (IOError, ValueError) as e:
+        print_colored(f"❌ {e}", Fore.RED)
+        return
+
+    if not changed:
+        target = filepath or "any file"
+        print_colored(f"❌ No {'redo' if redo else 'undo'} history for {target}", Fore.RED)
+    elif filepath:
+        undo_depth, redo_depth = store.depth(filepath)
+        print_colored(
+            f"✅ {action} {len(changed)} edit(s) for {filepath} ({undo_depth} undo, {redo_depth} redo left)",
+            Fore.GREEN,
+        )
     else:
-        print_colored(f"❌ No undo history for {filepath}", Fore.RED)
+        files = ", ".join(sorted({os.path.relpath(path) for path in changed}))
+        print_colored(f"✅ {action} last edit of {files}", Fore.GREEN)
+
+terminal_formatter = None
+lexer_cache = {}
+
+def syntax_highlight(code, lexer):
+    """Highlight code for the terminal; lexer is a pygments lexer or a language name."""
+    global terminal_formatter
+    if isinstance(lexer, str):
+        lexer = get_lexer_by_name(lexer, stripnl=False)
+    if terminal_formatter is None:
+        terminal_formatter = TerminalFormatter()
+    return highlight(code, lexer, terminal_formatter)
 
-def syntax_highlight(code, language):
-    lexer = get_lexer_by_name(language)
-    return highlight(code, lexer, TerminalFormatter())
+def lexer_for_file(filepath, sample):
+    """Guess the lexer for a file once, from its name and first bytes, or None for plain text."""
+    key = os.path.abspath(filepath)
+    if key not in lexer_cache:
+        lexer = None
+        if b"\0" not in sample:  # Binary files are shown as they are
+            try:
+                lexer = guess_lexer_for_filename(
+                    filepath, sample.decode("utf-8", errors="replace"), stripnl=False
+                )
+            except Exception:
+                pass
+            if lexer is not None and lexer.name == "Text only":
+                lexer = None
+        lexer_cache[key] = lexer
+    return lexer_cache[key]
 
 def print_welcome_message():
     print_colored(
         "🔮 Welcome to the Assistant Developer Console! 🔮", Fore.MAGENTA, Style.BRIGHT
     )
 
-    console = Console()
-    table = Table()
-
-    table.add_column("Command", style="cyan", no_wrap=True)
-    table.add_column("Description")
-
-    table.add_row("/add", "Add files to AI's knowledge base")
-    table.add_row("/edit", "Edit existing files")
-    table.add_row("/new", "Create new files")
-    table.add_row("/search", "Perform a DuckDuckGo search")
-    table.add_row("/image", "Add image(s) to AI's knowledge base")
-    table.add_row("/clear", "Clear added files, searches, and images from AI's memory")
-    table.add_row("/reset", "Reset entire chat and file memory")
-    table.add_row("/diff", "Toggle display of diffs")
-    table.add_row("/history", "View chat history")
-    table.add_row("/save", "Save chat history to a file")
-    table.add_row("/load", "Load chat history from a file")
-    table.add_row("/undo", "Undo last edit for a specific file")
-    table.add_row("/help", "Show this help message")
-    table.add_row("/model", "Show current AI model")
-    table.add_row("/change_model", "Change the AI model")
-    table.add_row("/show", "Show content of a file")
-    table.add_row("exit", "Exit the application")
-
-    console.print(table)
+    # Plain colored columns: importing rich for this table alone would double the time to the first prompt
+    commands = [
+        ("/add", "Add files to AI's knowledge base"),
+        ("/edit", "Edit existing files"),
+        ("/new", "Create new files"),
+        ("/search", "Perform a DuckDuckGo search"),
+        ("/image", "Add image(s) to AI's knowledge base"),
+        ("/index", "Build or update the local code search index"),
+        ("/rag", "Toggle attaching relevant indexed code to each prompt"),
+        ("/cache", "Response cache: on, off, stats or clear"),
+        ("/stats", "Latency, TTFT and token percentiles per kind and model (clear, export [jsonl|prom] [path])"),
+        ("/clear", "Clear added files, searches, and images from AI's memory"),
+        ("/reset", "Reset entire chat and file memory"),
+        ("/diff", "Toggle display of diffs (/diff live: show hunks while editing)"),
+        ("/quiet", "Toggle per-line output while editing"),
+        ("/edit_mode", "Switch between full-file, patch and region editing"),
+        ("/editor_context", "What earlier edits the editor sees: none, file or all"),
+        ("/history", "View chat history"),
+        ("/context", "Show what will be sent to the model and its token cost"),
+        ("/pin", "Always send a message, even when the context is full"),
+        ("/unpin", "Let a pinned message be evicted again"),
+        ("/save", "Name the current session (it is saved as you go)"),
+        ("/load", "Resume a saved session"),
+        ("/undo", "Undo the last /edit, or '/undo <file> [n]' for n edits of one file"),
+        ("/redo", "Redo what /undo reverted, same arguments"),
+        ("/help", "Show this help message"),
+        ("/model", "Show current AI model"),
+        ("/change_model", "Change the AI model"),
+        ("/bg", "Run /edit, /search or a chat message as a background job"),
+        ("/jobs", "List background jobs"),
+        ("/wait", "Wait for a background job (or all of them) and show its output"),
+        ("/cancel", "Cancel a background job, keeping its output so far"),
+        ("/show", "Page through a file: /show <file> [line], then n, p, <line>, /regex, G, q"),
+        ("exit", "Exit the application"),
+    ]
+    width = max(len(command) for command, _ in commands)
+    for command, description in commands:
+        print(f"  {Fore.CYAN}{command:<{width}}{Style.RESET_ALL}  {description}")
 
     print_colored(
         "For any other input, the AI will respond to your query or command.",
@@ -639,8 +3285,8 @@ def print_welcome_message():
     )
 
 def print_files_and_searches_in_memory():
-    if added_files:
-        file_list = ', '.join(added_files)
+    if file_context:
+        file_list = ', '.join(file_context.paths())
         print_colored(
             f"📂 Files currently in memory: {file_list}", Fore.CYAN, Style.BRIGHT
         )
@@ -650,20 +3296,337 @@ def print_files_and_searches_in_memory():
             f"🔍 Searches currently in memory: {search_list}", Fore.CYAN, Style.BRIGHT
         )
 
+def diff_opcodes(a, b):
+    """Opcodes like SequenceMatcher.get_opcodes(), from a patience diff over interned lines.
+
+    Lines are mapped to integers once, common prefixes and suffixes are
+    trimmed, and lines unique to both sides anchor the alignment. Regions
+    without unique lines fall back to a bounded Myers diff. When that gets
+    too costly, runs of consecutive lines unique to both sides anchor the
+    region instead, and as a last resort lines are matched greedily, so a
+    small edit never turns into replacing the whole region.
+    """
+    ids = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+
+    matches = []
+    stack = [("region", 0, len(a_ids), 0, len(b_ids))]
+    while stack:
+        item = stack.pop()
+        if item[0] == "match":
+            matches.append((item[1], item[2]))
+            continue
+
+        _, a_lo, a_hi, b_lo, b_hi = item
+        while a_lo < a_hi and b_lo < b_hi and a_ids[a_lo] == b_ids[b_lo]:
+            matches.append((a_lo, b_lo))
+            a_lo += 1
+            b_lo += 1
+        suffix = []
+        while a_lo < a_hi and b_lo < b_hi and a_ids[a_hi - 1] == b_ids[b_hi - 1]:
+            a_hi -= 1
+            b_hi -= 1
+            suffix.append(("match", a_hi, b_hi))
+        # suffix was collected back to front, which is the order the stack pops it in
+        pieces = suffix
+        if a_lo < a_hi and b_lo < b_hi:
+            anchors, width = patience_anchors(a_ids, b_ids, a_lo, a_hi, b_lo, b_hi), 1
+            found = None
+            if not anchors:
+                found = myers_matches(a_ids, b_ids, a_lo, a_hi, b_lo, b_hi)
+            if found is None and not anchors:
+                for width in (4, 16):
+                    anchors = run_anchors(a_ids, b_ids, a_lo, a_hi, b_lo, b_hi, width)
+                    if anchors:
+                        break
+                else:
+                    found = greedy_matches(a_ids, b_ids, a_lo, a_hi, b_lo, b_hi)
+            if anchors:
+                regions = []
+                i, j = a_lo, b_lo
+                for anchor_i, anchor_j in anchors:
+                    regions.append(("region", i, anchor_i, j, anchor_j))
+                    regions.extend(("match", anchor_i + step, anchor_j + step) for step in range(width))
+                    i, j = anchor_i + width, anchor_j + width
+                regions.append(("region", i, a_hi, j, b_hi))
+                pieces = suffix + regions[::-1]
+            else:
+                matches.extend(found)
+        stack.extend(pieces)
+
+    opcodes = []
+    i = j = 0
+    for match_i, match_j in matches + [(len(a_ids), len(b_ids))]:
+        if match_i > i or match_j > j:
+            tag = "replace" if match_i > i and match_j > j else ("delete" if match_i > i else "insert")
+            opcodes.append((tag, i, match_i, j, match_j))
+        if match_i < len(a_ids):
+            if opcodes and opcodes[-1][0] == "equal":
+                opcodes[-1] = ("equal", opcodes[-1][1], match_i + 1, opcodes[-1][3], match_j + 1)
+            else:
+                opcodes.append(("equal", match_i, match_i + 1, match_j, match_j + 1))
+        i, j = match_i + 1, match_j + 1
+    return opcodes
+
+def patience_anchors(a_ids, b_ids, a_lo, a_hi, b_lo, b_hi):
+    """Longest increasing run of lines that occur exactly once on both sides."""
+    a_counts = Counter(a_ids[a_lo:a_hi])
+    b_positions = {}
+    for j in range(b_lo, b_hi):
+        line = b_ids[j]
+        b_positions[line] = -1 if line in b_positions else j
+    pairs = [
+        (i, b_positions[line])
+        for i in range(a_lo, a_hi)
+        for line in (a_ids[i],)
+        if a_counts[line] == 1 and b_positions.get(line, -1) >= 0
+    ]
+    return longest_increasing_pairs(pairs)
+
+def run_anchors(a_ids, b_ids, a_lo, a_hi, b_lo, b_hi, width):
+    """Like patience_anchors, for runs of width consecutive lines.
+
+    Runs of a few lines are unique even where single lines repeat. Returns
+    the (i, j) starts of non-overlapping runs that match in order.
+    """
+    a_runs = [tuple(a_ids[i:i + width]) for i in range(a_lo, a_hi - width + 1)]
+    a_counts = Counter(a_runs)
+    b_positions = {}
+    for j in range(b_lo, b_hi - width + 1):
+        run = tuple(b_ids[j:j + width])
+        b_positions[run] = -1 if run in b_positions else j
+    pairs = [
+        (a_lo + offset, b_positions[run])
+        for offset, run in enumerate(a_runs)
+        if a_counts[run] == 1 and b_positions.get(run, -1) >= 0
+    ]
+    anchors = []
+    for i, j in longest_increasing_pairs(pairs):
+        if not anchors or (i >= anchors[-1][0] + width and j >= anchors[-1][1] + width):
+            anchors.append((i, j))
+    return anchors
+
+def longest_increasing_pairs(pairs):
+    """The longest run of (i, j) pairs, in i order, whose j also increases."""
+    if not pairs:
+        return []
+
+    # Patience sorting: longest increasing subsequence of b positions
+    tails, tail_indexes, previous = [], [], [None] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        slot = bisect.bisect_left(tails, j)
+        if slot:
+            previous[index] = tail_indexes[slot - 1]
+        if slot == len(tails):
+            tails.append(j)
+            tail_indexes.append(index)
+        else:
+            tails[slot] = j
+            tail_indexes[slot] = index
+    anchors = []
+    index = tail_indexes[-1]
+    while index is not None:
+        anchors.append(pairs[index])
+        index = previous[index]
+    return anchors[::-1]
+
+def myers_matches(a_ids, b_ids, a_lo, a_hi, b_lo, b_hi, max_cost=2_000_000):
+    """Matching (i, j) pairs from Myers' O(ND) diff, or None if the region is too costly."""
+    n, m = a_hi - a_lo, b_hi - b_lo
+    max_d = min(n + m, max_cost // (n + m))
+    v = {1: 0}
+    trace = []
+    for d in range(max_d + 1):
+        trace.append(v.copy())
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a_ids[a_lo + x] == b_ids[b_lo + y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                return myers_backtrack(trace, n, m, a_lo, b_lo)
+    return None
+
+def greedy_matches(a_ids, b_ids, a_lo, a_hi, b_lo, b_hi, lookahead=64):
+    """Match lines in order, skipping the fewest lines within lookahead to resync.
+
+    Not minimal, but linear, for regions too repetitive to anchor.
+    """
+    matches = []
+    i, j = a_lo, b_lo
+    while i < a_hi and j < b_hi:
+        if a_ids[i] == b_ids[j]:
+            matches.append((i, j))
+            i += 1
+            j += 1
+            continue
+        for skip in range(1, lookahead + 1):
+            if i + skip < a_hi and a_ids[i + skip] == b_ids[j]:
+                i += skip  # Lines deleted
+                break
+            if j + skip < b_hi and a_ids[i] == b_ids[j + skip]:
+                j += skip  # Lines inserted
+                break
+            if i + skip < a_hi and j + skip < b_hi and a_ids[i + skip] == b_ids[j + skip]:
+                i += skip  # Lines replaced
+                j += skip
+                break
+        else:
+            i += 1
+            j += 1
+    return matches
+
+def myers_backtrack(trace, x, y, a_lo, b_lo):
+    matches = []
+    for d in range(len(trace) - 1, 0, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[prev_k]
+        prev_y = prev_x - prev_k
+        while x > prev_x and y > prev_y:
+            x -= 1
+            y -= 1
+            matches.append((a_lo + x, b_lo + y))
+        x, y = prev_x, prev_y
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        matches.append((a_lo + x, b_lo + y))
+    return matches[::-1]
+
+def group_opcodes(codes, n=3):
+    """Split opcodes into hunks with n lines of context, like SequenceMatcher.get_grouped_opcodes."""
+    codes = list(codes) or [("equal", 0, 1, 0, 1)]
+    if codes[0][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == 'equal':
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+    group = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == 'equal' and i2 - i1 > n + n:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == 'equal'):
+        yield group
+
+def format_range(start, stop):
+    beginning, length = start + 1, stop - start
+    if length == 1:
+        return f"{beginning}"
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+def unified_diff(a, b, n=3):
+    """Drop-in for difflib.unified_diff(a, b, lineterm='', n=n) using diff_opcodes."""
+    started = False
+    for group in group_opcodes(diff_opcodes(a, b), n):
+        if not started:
+            started = True
+            yield '--- '
+            yield '+++ '
+        first, last = group[0], group[-1]
+        yield f"@@ -{format_range(first[1], last[2])} +{format_range(first[3], last[4])} @@"
+        for tag, i1, i2, j1, j2 in group:
+            if tag == 'equal':
+                for line in a[i1:i2]:
+                    yield ' ' + line
+                continue
+            if tag in ('replace', 'delete'):
+                for line in a[i1:i2]:
+                    yield '-' + line
+            if tag in ('replace', 'insert'):
+                for line in b[j1:j2]:
+                    yield '+' + line
+
+def color_diff_line(line):
+    if line.startswith('+'):
+        color = Fore.GREEN
+    elif line.startswith('-'):
+        color = Fore.RED
+    else:
+        color = Fore.BLUE
+    return f"{color}{line}{Style.RESET_ALL}"
+
 def display_diff(original, edited):
-    diff = difflib.unified_diff(
-        original.splitlines(), edited.splitlines(), lineterm='', n=0
-    )
-    for line in diff:
-        if line.startswith('+'):
-            print_colored(line, Fore.GREEN)
-        elif line.startswith('-'):
-            print_colored(line, Fore.RED)
+    diff = unified_diff(original.splitlines(), edited.splitlines(), n=0)
+    # One write for the whole diff instead of a print per line
+    output = "\n".join(color_diff_line(line) for line in diff)
+    if output:
+        print(output)
+
+class IncrementalDiff:
+    """Emit diff hunks while edited lines stream in, before the edit finishes.
+
+    A greedy alignment against the original: a streamed line that matches the
+    next original line extends the current match, anything else is held back
+    until the stream lines up with the original again. The result is a live
+    preview; display_diff still shows the exact diff at the end.
+    """
+
+    RESYNC_WINDOW = 200
+
+    def __init__(self, original_lines, on_hunk=None):
+        self.original = original_lines
+        self.positions = defaultdict(list)
+        for index, line in enumerate(original_lines):
+            self.positions[line].append(index)
+        self.on_hunk = on_hunk or (lambda lines: print("\n".join(map(color_diff_line, lines))))
+        self.i = 0  # Next original line expected
+        self.j = 0  # Lines received so far
+        self.pending = []
+
+    def feed(self, line):
+        if not self.pending and self.i < len(self.original) and self.original[self.i] == line:
+            self.i += 1
+            self.j += 1
+            return
+
+        # Trivial lines like "}" or blank lines only resync at the expected
+        # position, or right after a same-length replacement
+        positions = self.positions.get(line, ())
+        slot = bisect.bisect_left(positions, self.i)
+        if slot < len(positions) and (
+            positions[slot] - self.i in (0, len(self.pending))
+            or (len(line.strip()) > 3 and positions[slot] - self.i <= self.RESYNC_WINDOW)
+        ):
+            self.emit(positions[slot])
+            self.i = positions[slot] + 1
         else:
-            print_colored(line, Fore.BLUE)
+            self.pending.append(line)
+        self.j += 1
+
+    def emit(self, original_end):
+        removed = self.original[self.i:original_end]
+        if not removed and not self.pending:
+            return
+        start_new = self.j - len(self.pending)
+        header = f"@@ -{format_range(self.i, original_end)} +{format_range(start_new, self.j)} @@"
+        self.on_hunk([header] + ['-' + line for line in removed] + ['+' + line for line in self.pending])
+        self.pending = []
+
+    def finish(self):
+        # Lines the editor never reached are kept from the original by stream_file_edit
+        self.emit(max(self.i, min(self.j, len(self.original))))
 
-async def handle_search_command(default_chat_history):
-    search_query = await get_input_async("What would you like to search?")
+async def handle_search_command(default_chat_history, search_query=None):
+    if search_query is None:
+        search_query = await get_input_async("What would you like to search?")
     if not search_query.strip():
         print_colored("❌ Empty search query. Please provide a search term.", Fore.RED)
         return default_chat_history
@@ -672,15 +3635,15 @@ async def handle_search_command(default_chat_history):
 
     try:
         results = await aget_results(search_query)
-        search_name = search_query[:10].strip()  # Truncate to first 10 characters
+        search_name = search_query.strip()
         stored_searches[search_name] = results
         print_colored(f"✅ Search results for '{search_name}' stored in memory.", Fore.GREEN)
 
         # Add search results to chat history
         search_content = f"Search results for '{search_query}':\n"
-        for idx, result in enumerate(results[:8], 1):  # Limit to first 5 results for brevity
-            search_content += f"{idx}. {result['title']}: {result['body'][:100]}...\n"
-        default_chat_history.append({"role": "user", "content": search_content})
+        for idx, result in enumerate(results, 1):
+            search_content += f"{idx}. {result['title']}: {result['body'][:SEARCH_SNIPPET_CHARS]}...\n"
+        default_chat_history.append({"role": "user", "content": search_content, "search": True})
 
     except Exception as e:
         print_colored(f"❌ Error performing search: {e}", Fore.RED)
@@ -691,21 +3654,625 @@ async def handle_help_command():
     print_welcome_message()
 
 def show_current_model():
+    router = get_model_router()
+    if router:
+        print_router_status(router)
+        return
     print_colored(f"Current model: {DEFAULT_MODEL}", Fore.CYAN)
 
 async def change_model():
-    global DEFAULT_MODEL
+    global DEFAULT_MODEL, MODEL_ROUTES, model_router
     new_model = await get_input_async("Enter the new model name: ")
     DEFAULT_MODEL = new_model
+    if get_model_router():
+        MODEL_ROUTES, model_router = [], None
+        print_colored("Model routing is off for this session.", Fore.YELLOW)
     print_colored(f"Model changed to: {DEFAULT_MODEL}", Fore.GREEN)
 
-async def show_file_content(filepath):
-    content = read_file_content(filepath)
-    if content.startswith("❌"):
-        print_colored(content, Fore.RED)
-    else:
+class FileView:
+    """A file mapped into memory and read by line number.
+
+    Lines are found through a sparse index of (line number, byte offset)
+    pairs at line starts about BLOCK bytes apart. The index is only built as
+    far as a lookup needs, so the first page of a huge file shows at once,
+    and a page only decodes the blocks it spans.
+    """
+
+    BLOCK = 64 * 1024
+
+    def __init__(self, path):
+        self.file = open(path, "rb")
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else b""
+        self.lines = [0]  # Line number at the start of each block
+        self.offsets = [0]  # Byte offset of each block
+        self.total_lines = None if self.size else 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.size:
+            self.buffer.close()
+        self.file.close()
+
+    def index_next_block(self):
+        start = self.offsets[-1]
+        end = min(start + self.BLOCK, self.size)
+        if end < self.size:
+            newline = self.buffer.rfind(b"\n", start, end)
+            if newline == -1:
+                newline = self.buffer.find(b"\n", end)  # A line longer than a block
+            end = self.size if newline == -1 else newline + 1
+        lines = self.lines[-1] + self.buffer[start:end].count(b"\n")
+        if end == self.size:
+            # No entry for the end of the file: it is not the start of a line
+            self.total_lines = lines + (self.buffer[-1:] != b"\n")
+            return
+        self.lines.append(lines)
+        self.offsets.append(end)
+
+    def ensure_line(self, line):
+        while self.total_lines is None and self.lines[-1] <= line:
+            self.index_next_block()
+
+    def count_lines(self):
+        while self.total_lines is None:
+            self.index_next_block()
+        return self.total_lines
+
+    def read_lines(self, first, count):
+        """Up to count lines from line first (0-based), decoded."""
+        self.ensure_line(first + count)
+        if self.total_lines is not None:
+            count = min(count, self.total_lines - first)
+        if count <= 0:
+            return []
+        block = bisect.bisect_right(self.lines, first) - 1
+        after = bisect.bisect_right(self.lines, first + count - 1)
+        end = self.offsets[after] if after < len(self.offsets) else self.size
+        text = self.buffer[self.offsets[block]:end].decode("utf-8", errors="replace")
+        skip = first - self.lines[block]
+        return text.split("\n")[skip:skip + count]
+
+    def offset_of(self, line):
+        self.ensure_line(line)
+        block = bisect.bisect_right(self.lines, line) - 1
+        offset = self.offsets[block]
+        for _ in range(line - self.lines[block]):
+            offset = self.buffer.find(b"\n", offset) + 1
+        return offset
+
+    def line_at(self, offset):
+        while self.total_lines is None and self.offsets[-1] <= offset:
+            self.index_next_block()
+        block = bisect.bisect_right(self.offsets, offset) - 1
+        return self.lines[block] + self.buffer[self.offsets[block]:offset].count(b"\n")
+
+    def search(self, pattern, from_line):
+        """First line at or after from_line matching pattern, wrapping around; None if none does."""
+        self.ensure_line(from_line)
+        past_end = self.total_lines is not None and from_line >= self.total_lines
+        start = self.size if past_end else self.offset_of(from_line)
+        match = pattern.search(self.buffer, start) or pattern.search(self.buffer, 0, start)
+        return None if match is None else self.line_at(match.start())
+
+def show_page(view, top, lines, lexer):
+    text = "\n".join(lines)
+    if lexer is not None:
+        # Only the visible page is highlighted; ensurenl adds a final newline
+        text = syntax_highlight(text + "\n", lexer)[:-1]
+    width = len(str(top + len(lines)))
+    for number, line in enumerate(text.split("\n"), top + 1):
+        print(f"{Fore.LIGHTBLACK_EX}{number:>{width}} │{Style.RESET_ALL} {line}")
+
+def parse_show_arguments(argument):
+    """Split "<filepath> [line]" into (filepath, line)."""
+    argument = argument.strip()
+    filepath, _, line = argument.rpartition(" ")
+    if line.isdigit() and filepath and not os.path.exists(argument):
+        return filepath.strip(), int(line)
+    return argument, 1
+
+pager_session = None
+
+async def get_pager_input(message):
+    """Read a pager command, without adding it to the command history."""
+    global pager_session
+    if pager_session is None:
+        pager_session = PromptSession()
+    result = await pager_session.prompt_async(HTML(f"<ansicyan>{message}</ansicyan> "))
+    return result.strip()
+
+async def show_file_content(argument):
+    """Page through a file without reading it into memory.
+
+    Enter or n shows the next page, p the previous one, a number jumps to that
+    line, /regex searches onwards (/ alone repeats it), G goes to the end and
+    q quits. A file that fits on one page is printed as is.
+    """
+    filepath, line = parse_show_arguments(argument)
+    try:
+        view = FileView(filepath)
+    except FileNotFoundError:
+        print_colored(f"❌ Error: File not found: {filepath}", Fore.RED)
+        return
+    except (IOError, ValueError) as e:
+        print_colored(f"❌ Error reading {filepath}: {e}", Fore.RED)
+        return
+
+    with view:
         print_colored(f"Content of {filepath}:", Fore.CYAN)
-        print(content)
+        if view.size == 0:
+            print_colored("(empty file)", Fore.YELLOW)
+            return
+        page = SHOW_PAGE_LINES or max(10, shutil.get_terminal_size().lines - 3)
+        lexer = lexer_for_file(filepath, view.buffer[:4096]) if SHOW_HIGHLIGHT else None
+        top = line - 1
+        pattern = None
+        redraw = True
+        while True:
+            if redraw:
+                lines = view.read_lines(top, page)
+                if not lines and top > 0:
+                    top = max(0, view.count_lines() - page)  # Past the end: show the last page
+                    continue
+                show_page(view, top, lines, lexer)
+            redraw = True
+            at_end = view.total_lines is not None and top + len(lines) >= view.total_lines
+            if top == 0 and at_end:
+                return
+
+            total = f"{view.total_lines:,}" if view.total_lines is not None else "?"
+            command = await get_pager_input(
+                f"Lines {top + 1:,}-{top + len(lines):,} of {total} "
+                "(Enter/n next, p previous, <line>, /regex, G end, q quit):"
+            )
+            if command in ("", "n"):
+                if at_end:
+                    return
+                top += page
+            elif command == "p":
+                top = max(0, top - page)
+            elif command.isdigit():
+                top = max(0, int(command) - 1)
+            elif command == "G":
+                top = max(0, view.count_lines() - page)
+            elif command.startswith("/"):
+                if command[1:]:
+                    try:
+                        pattern = re.compile(command[1:].encode("utf-8"), re.MULTILINE)
+                    except re.error as e:
+                        print_colored(f"❌ Invalid pattern: {e}", Fore.RED)
+                        redraw = False
+                        continue
+                if pattern is None:
+                    print_colored("❌ No search yet. Type /pattern.", Fore.RED)
+                    redraw = False
+                    continue
+                found = view.search(pattern, top + 1)
+                if found is None:
+                    print_colored(f"No match for {pattern.pattern.decode('utf-8')}", Fore.YELLOW)
+                    redraw = False
+                    continue
+                top = found
+            elif command == "q":
+                return
+            else:
+                print_colored(f"❌ Unknown pager command '{command}'.", Fore.RED)
+                redraw = False
+
+class BatchJobError(Exception):
+    """Raised when a batch job can't be run as described."""
+
+RETRYABLE_STATUS = {408, 409, 425, 429, 500, 502, 503, 504}
+
+def is_retryable(error):
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS
+    return isinstance(error, httpx.TransportError)
+
+async def with_retries(call, retries, attempts):
+    """Await call() until it succeeds, retrying rate limits and network errors.
+
+    Backs off exponentially with jitter, or as long as a Retry-After header
+    asks. attempts is a one-item list counting every try, for the report.
+    """
+    for attempt in range(retries + 1):
+        attempts[0] += 1
+        try:
+            return await call()
+        except Exception as e:
+            if attempt == retries or not is_retryable(e):
+                raise
+            delay = min(BATCH_BACKOFF_MAX, BATCH_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1.0)
+            if isinstance(e, httpx.HTTPStatusError):
+                retry_after = e.response.headers.get("retry-after", "")
+                if retry_after.isdigit():
+                    delay = max(delay, float(retry_after))
+            await asyncio.sleep(delay)
+
+async def collect_completion(payload, kind="chat", messages=None):
+    """Run one chat completion without printing it."""
+    content_parts, reasoning_parts, usage = [], [], None
+    async for chunk in open_chat_stream(payload, kind, messages):
+        if chunk.get('usage'):
+            usage = chunk['usage']
+        delta = (chunk.get('choices') or [{}])[0].get('delta', {})
+        if delta.get('reasoning'):
+            reasoning_parts.append(delta['reasoning'])
+        if delta.get('content'):
+            content_parts.append(delta['content'])
+    return {"content": "".join(content_parts), "reasoning": "".join(reasoning_parts), "usage": usage}
+
+def load_batch_manifest(path):
+    """Read one job per line; blank lines and # comments are skipped."""
+    jobs = []
+    with open(path, 'r', encoding='utf-8') as manifest:
+        for number, line in enumerate(manifest, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                job = json.loads(line)
+            except json.JSONDecodeError as e:
+                raise BatchJobError(f"{path}:{number}: {e}") from e
+            job.setdefault("id", str(number))
+            job.setdefault("type", "edit" if job.get("files") else "ask")
+            if job["type"] not in ("ask", "edit") or not job.get("prompt"):
+                raise BatchJobError(f"{path}:{number}: a job needs a prompt and a type of ask or edit")
+            if job["type"] == "edit" and not job.get("files"):
+                raise BatchJobError(f"{path}:{number}: an edit job needs files")
+            jobs.append(job)
+    return jobs
+
+async def run_batch_job(job, retries, dry_run, file_locks, transaction):
+    """Run one manifest job with the planner/editor flow of /edit and return its report entry."""
+    model = job.get("model") or DEFAULT_MODEL
+    filepaths = job.get("files") or []
+    entry = {"id": job["id"], "type": job["type"], "model": model, "status": "ok"}
+    attempts = [0]
+    started = time.perf_counter()
+
+    held_locks = contextlib.AsyncExitStack()
+    try:
+        # Jobs touching the same file run one after the other
+        for path in sorted({os.path.abspath(fp) for fp in filepaths}):
+            await held_locks.enter_async_context(file_locks[path])
+        contents = [read_file_content(fp) for fp in filepaths]
+        for content in contents:
+            if content.startswith("❌"):
+                raise BatchJobError(content)
+
+        history = [{"role": "system", "content": SYSTEM_PROMPT}]
+        if job["type"] == "ask":
+            prompt = "".join(f"File: {fp}\n```\n{content}\n```\n" for fp, content in zip(filepaths, contents))
+            history.append({"role": "user", "content": prompt + job["prompt"]})
+            payload = await build_chat_payload(history, model)
+            response = await with_retries(lambda: collect_completion(payload, messages=history), retries, attempts)
+            entry.update(response=response["content"], usage=response["usage"])
+            return entry
+
+        history.append({"role": "user", "content": build_plan_prompt(filepaths, contents, job["prompt"])})
+        payload = await build_chat_payload(history, model)
+        plan = await with_retries(lambda: collect_completion(payload, "plan", history), retries, attempts)
+        entry.update(instructions=plan["content"], usage=plan["usage"])
+        entry["plan_seconds"] = round(time.perf_counter() - started, 3)
+
+        entry["files"] = []
+        editor_chat_history = [{"role": "system", "content": EDITOR_PROMPT}]
+        for filepath, content in zip(filepaths, contents):
+            _, _, result = await with_retries(
+                lambda: run_editor(filepath, content, plan["content"], editor_chat_history),
+                retries,
+                attempts,
+            )
+            diff = list(unified_diff(content.splitlines(), result.splitlines()))
+            if diff:
+                diff[:2] = [f"--- a/{filepath}", f"+++ b/{filepath}"]
+            changed = result != content
+            if changed and not dry_run:
+                if not write_file_content(filepath, result):
+                    raise BatchJobError(f"failed to save {filepath}")
+                get_undo_store().record(transaction, filepath, content, result)
+            entry["files"].append({"path": filepath, "changed": changed, "diff": "\n".join(diff)})
+        return entry
+    except Exception as e:
+        entry.update(status="error", error=f"{type(e).__name__}: {e}")
+        return entry
+    finally:
+        await held_locks.aclose()
+        entry["attempts"] = attempts[0]
+        entry["seconds"] = round(time.perf_counter() - started, 3)
+
+async def run_batch(manifest_path, report_path, concurrency, retries, dry_run=False):
+    """Run every job of a JSONL manifest on a pool of workers and write a JSONL report.
+
+    Report lines are written as jobs finish, so a partial report survives an
+    interrupted run. Returns the process exit code.
+    """
+    global HTTP_POOL_SIZE
+    try:
+        jobs = load_batch_manifest(manifest_path)
+    except (OSError, BatchJobError) as e:
+        print_colored(f"❌ {e}", Fore.RED)
+        return 2
+
+    HTTP_POOL_SIZE = max(HTTP_POOL_SIZE, concurrency)  # One connection per worker at most
+    queue = asyncio.Queue()
+    for job in jobs:
+        queue.put_nowait(job)
+    file_locks = defaultdict(asyncio.Lock)
+    transaction = get_undo_store().begin()  # One /undo reverts the whole batch
+    failed = 0
+    started = time.perf_counter()
+
+    with open(report_path, 'w', encoding='utf-8') as report, Progress(
+        TextColumn("{task.description}"),
+        BarColumn(),
+        MofNCompleteColumn(),
+        TimeElapsedColumn(),
+    ) as progress:
+        task = progress.add_task(f"🧵 {len(jobs)} jobs, {concurrency} workers", total=len(jobs))
+
+        async def worker():
+            nonlocal failed
+            while not queue.empty():
+                job = queue.get_nowait()
+                entry = await run_batch_job(job, retries, dry_run, file_locks, transaction)
+                if entry["status"] != "ok":
+                    failed += 1
+                    progress.console.print(f"❌ {entry['id']}: {entry['error']}", style="red")
+                report.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                report.flush()
+                progress.advance(task)
+
+        await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(jobs))))))
+
+    elapsed = time.perf_counter() - started
+    await close_http_client()
+    print_colored(
+        f"{'✅' if not failed else '⚠️'} {len(jobs) - failed}/{len(jobs)} jobs succeeded in {elapsed:.1f}s "
+        f"({len(jobs) / elapsed * 60 if elapsed else 0:.1f} jobs/min). Report: {report_path}",
+        Fore.GREEN if not failed else Fore.YELLOW,
+    )
+    return 1 if failed else 0
+
+job_output = contextvars.ContextVar("job_output", default=None)
+
+class JobAwareStdout:
+    """sys.stdout stand-in that sends what a background job prints to the job's buffer."""
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def target(self):
+        return job_output.get() or self.stream
+
+    def write(self, text):
+        return self.target().write(text)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, attr):
+        return getattr(self.target(), attr)
+
+class JobScheduler:
+    """Run commands as asyncio tasks next to the chat loop.
+
+    A job works on its own copies of the chat and editor histories and prints
+    into its own buffer. When it finishes, the messages it added are queued and
+    the chat loop appends them to the live histories between commands, so a
+    job never changes a history another command is using. Cancelling a job
+    cancels its task, which closes its HTTP stream; its output so far is kept.
+    """
+
+    def __init__(self):
+        self.jobs = {}
+        self.next_id = 1
+        self.merges = []
+        self.notices = []
+
+    def running(self):
+        return [job for job in self.jobs.values() if job["status"] == "running"]
+
+    def busy_files(self):
+        """Files that running jobs are editing, mapped to the job id."""
+        return {filepath: job["id"] for job in self.running() for filepath in job["files"]}
+
+    def submit(self, command, handler, default_chat_history, editor_chat_history, files=()):
+        """Start handler(default_chat_history, editor_chat_history) on copies of both histories."""
+        if not isinstance(sys.stdout, JobAwareStdout):
+            sys.stdout = JobAwareStdout(sys.stdout)
+        job = {
+            "id": self.next_id,
+            "command": command,
+            "files": list(files),
+            "status": "running",
+            "started": time.monotonic(),
+            "finished": None,
+            "output": StringIO(),
+        }
+        self.next_id += 1
+        self.jobs[job["id"]] = job
+        job["task"] = asyncio.create_task(
+            self.run(job, handler, list(default_chat_history), list(editor_chat_history))
+        )
+        print_colored(f"🧵 Job {job['id']} started: {command}", Fore.BLUE)
+        return job
+
+    async def run(self, job, handler, default_chat_history, editor_chat_history):
+        job_output.set(job["output"])  # Only this task's context
+        default_start, editor_start = len(default_chat_history), len(editor_chat_history)
+        try:
+            default_result, editor_result = await handler(default_chat_history, editor_chat_history)
+            self.merges.append((default_result[default_start:], editor_result[editor_start:]))
+            job["status"] = "done"
+        except asyncio.CancelledError:
+            job["status"] = "cancelled"
+        except Exception as e:
+            print_colored(f"❌ {e}", Fore.RED)
+            job["status"] = "failed"
+        finally:
+            job["finished"] = time.monotonic()
+            job_output.set(None)
+            self.notify(job)
+
+    def notify(self, job):
+        icon = {"done": "✅", "cancelled": "🛑", "failed": "❌"}[job["status"]]
+        notice = (f"{icon} Job {job['id']} {job['status']} after {job['finished'] - job['started']:.1f}s: "
+                  f"{job['command']} (/wait {job['id']} shows its output)")
+        if get_app().is_running:
+            run_in_terminal(lambda: print_colored(notice, Fore.MAGENTA))  # Above the prompt
+        else:
+            self.notices.append(notice)  # Not in the middle of another command's output
+
+    def merge(self, default_chat_history, editor_chat_history):
+        """Append what finished jobs added to the live histories, in the order they finished."""
+        for notice in self.notices:
+            print_colored(notice, Fore.MAGENTA)
+        self.notices.clear()
+        for default_messages, editor_messages in self.merges:
+            default_chat_history.extend(default_messages)
+            editor_chat_history.extend(editor_messages)
+        self.merges.clear()
+        return default_chat_history, editor_chat_history
+
+    def find(self, argument):
+        """The jobs an argument names: one id, or every job when it's empty."""
+        argument = argument.strip()
+        if not argument:
+            return list(self.jobs.values())
+        job = self.jobs.get(int(argument)) if argument.isdigit() else None
+        if job is None:
+            print_colored(f"❌ No job {argument}. /jobs lists them.", Fore.RED)
+            return []
+        return [job]
+
+    def show_output(self, job):
+        print_colored(f"\n===== Job {job['id']} ({job['status']}): {job['command']} =====", Fore.MAGENTA)
+        print(job["output"].getvalue(), end="")
+        print_colored("=" * 50, Fore.MAGENTA)
+
+    async def wait(self, argument):
+        jobs = self.find(argument)
+        running = [job for job in jobs if job["status"] == "running"]
+        if not argument.strip() and not running:
+            print_colored("No running jobs.", Fore.YELLOW)
+        if running:
+            print_colored(f"⏳ Waiting for {len(running)} job(s)...", Fore.BLUE)
+            # Shielded: interrupting the wait must not cancel the jobs
+            await asyncio.shield(asyncio.gather(*(job["task"] for job in running)))
+        for job in jobs if argument.strip() else running:
+            self.show_output(job)
+
+    async def cancel(self, argument):
+        if not argument.strip():
+            print_colored("❌ /cancel needs a job id, /jobs lists them.", Fore.RED)
+            return
+        for job in self.find(argument):
+            if job["status"] != "running":
+                print_colored(f"Job {job['id']} already {job['status']}.", Fore.YELLOW)
+                continue
+            job["task"].cancel()
+            await asyncio.gather(job["task"], return_exceptions=True)
+            self.show_output(job)
+
+    async def cancel_all(self):
+        running = self.running()
+        if running:
+            print_colored(f"🛑 Cancelling {len(running)} running job(s).", Fore.YELLOW)
+        for job in running:
+            job["task"].cancel()
+        await asyncio.gather(*(job["task"] for job in running), return_exceptions=True)
+
+    def print_jobs(self):
+        if not self.jobs:
+            print_colored("No background jobs. Start one with /bg <command>.", Fore.YELLOW)
+            return
+        table = Table(title="Background jobs")
+        table.add_column("Job", justify="right")
+        table.add_column("Status")
+        table.add_column("Time", justify="right")
+        table.add_column("Command")
+        table.add_column("Last output")
+        now = time.monotonic()
+        colors = {"running": "cyan", "done": "green", "cancelled": "yellow", "failed": "red"}
+        for job in self.jobs.values():
+            lines = [line for line in job["output"].getvalue().splitlines() if line.strip()]
+            last = re.sub(r"\x1b\[[0-9;]*m", "", lines[-1]) if lines else ""
+            table.add_row(
+                str(job["id"]),
+                f"[{colors[job['status']]}]{job['status']}[/{colors[job['status']]}]",
+                f"{(job['finished'] or now) - job['started']:.1f}s",
+                job["command"],
+                last[:60],
+            )
+        Console().print(table)
+
+scheduler = JobScheduler()
+
+async def handle_chat_prompt(default_chat_history, prompt, journal=None):
+    """Send a chat message and add the reply to default_chat_history.
+
+    With journal, the message is journaled before the reply streams.
+    """
+    print_colored("\n🤖 Assistant:", Fore.BLUE)
+    default_chat_history.append({"role": "user", "content": prompt})
+    if journal:
+        journal.sync(default_chat_history)
+    extra_messages = None
+    if is_rag_on:
+        retrieved = await retrieve_context(prompt)
+        extra_messages = [retrieved] if retrieved else None
+    response = await get_streaming_response(
+        default_chat_history, DEFAULT_MODEL, extra_messages
+    )
+
+    # Store both content and reasoning in chat history
+    default_chat_history.append({
+        "role": "assistant", 
+        "content": response["content"],
+        "reasoning": response["reasoning"] if response["reasoning"] else None
+    })
+    return default_chat_history
+
+def edit_conflicts(filepaths):
+    """Report files a background job is still editing; True when there are any."""
+    busy = scheduler.busy_files()
+    conflicts = [filepath for filepath in filepaths if filepath in busy]
+    for filepath in conflicts:
+        print_colored(f"❌ {filepath} is being edited by job {busy[filepath]}. /wait {busy[filepath]} first.", Fore.RED)
+    return bool(conflicts)
+
+async def handle_bg_command(default_chat_history, editor_chat_history, command):
+    """Ask anything the command needs up front, then run it as a background job."""
+    command = command.strip()
+    if command.startswith("/edit "):
+        filepaths = command.split("/edit ", 1)[1].strip().split()
+        if edit_conflicts(filepaths):
+            return
+        user_request = await get_input_async(f"What would you like to change in {', '.join(filepaths)}?")
+
+        async def handler(default_history, editor_history):
+            return await handle_edit_command(default_history, editor_history, filepaths, user_request)
+
+        scheduler.submit(command, handler, default_chat_history, editor_chat_history, files=filepaths)
+    elif command.startswith("/search"):
+        search_query = command[len("/search"):].strip() or await get_input_async("What would you like to search?")
+
+        async def handler(default_history, editor_history):
+            return await handle_search_command(default_history, search_query), editor_history
+
+        scheduler.submit(f"/search {search_query}", handler, default_chat_history, editor_chat_history)
+    elif command and not command.startswith("/"):
+        async def handler(default_history, editor_history):
+            return await handle_chat_prompt(default_history, command), editor_history
+
+        scheduler.submit(command, handler, default_chat_history, editor_chat_history)
+    else:
+        print_colored("❌ Usage: /bg /edit <files>, /bg /search [query] or /bg <message>", Fore.RED)
 
 async def main():
     default_chat_history = [{"role": "system", "content": SYSTEM_PROMPT}]
@@ -716,7 +4283,10 @@ async def main():
 
     while True:
         try:
+            default_chat_history, editor_chat_history = scheduler.merge(default_chat_history, editor_chat_history)
+            session_journal.sync(default_chat_history)
             prompt = await get_input_async(f"\n\nYou:")
+            default_chat_history, editor_chat_history = scheduler.merge(default_chat_history, editor_chat_history)
 
             print_files_and_searches_in_memory()
 
@@ -733,6 +4303,8 @@ async def main():
 
             if prompt.startswith("/edit "):
                 filepaths = prompt.split("/edit ", 1)[1].strip().split()
+                if edit_conflicts(filepaths):
+                    continue
                 default_chat_history, editor_chat_history = await handle_edit_command(
                     default_chat_history, editor_chat_history, filepaths
                 )
@@ -749,6 +4321,22 @@ async def main():
                 default_chat_history = await handle_search_command(default_chat_history)
                 continue
 
+            if prompt.startswith("/index"):
+                await handle_index_command()
+                continue
+
+            if prompt.startswith("/rag"):
+                toggle_rag()
+                continue
+
+            if prompt.startswith("/cache"):
+                await handle_cache_command(prompt[len("/cache"):])
+                continue
+
+            if prompt.startswith("/stats"):
+                handle_stats_command(prompt[len("/stats"):])
+                continue
+
             if prompt.startswith("/clear"):
                 await handle_clear_command()
                 continue
@@ -760,15 +4348,39 @@ async def main():
                 continue
 
             if prompt.startswith("/diff"):
-                toggle_diff()
+                toggle_diff(prompt[len("/diff"):])
+                continue
+
+            if prompt.startswith("/quiet"):
+                toggle_quiet()
+                continue
+
+            if prompt.startswith("/edit_mode"):
+                await change_edit_mode(prompt[len("/edit_mode"):])
+                continue
+
+            if prompt.startswith("/editor_context"):
+                await change_editor_context(prompt[len("/editor_context"):])
                 continue
 
             if prompt.startswith("/history"):
                 handle_history_command(default_chat_history)
                 continue
 
+            if prompt.startswith("/context"):
+                handle_context_command(default_chat_history, DEFAULT_MODEL)
+                continue
+
+            if prompt.startswith("/pin"):
+                handle_pin_command(default_chat_history, prompt[len("/pin"):].strip())
+                continue
+
+            if prompt.startswith("/unpin"):
+                handle_pin_command(default_chat_history, prompt[len("/unpin"):].strip(), pinned=False)
+                continue
+
             if prompt.startswith("/save"):
-                await handle_save_command(default_chat_history)
+                await handle_save_command(default_chat_history, prompt[len("/save"):])
                 continue
 
             if prompt.startswith("/image "):
@@ -777,14 +4389,17 @@ async def main():
                 continue
 
             if prompt.startswith("/load"):
-                loaded_history = await handle_load_command()
+                loaded_history = await handle_load_command(prompt[len("/load"):])
                 if loaded_history:
                     default_chat_history = loaded_history
                 continue
 
-            if prompt.startswith("/undo "):
-                filepath = prompt.split("/undo ", 1)[1].strip()
-                await handle_undo_command(filepath)
+            if prompt.startswith("/undo"):
+                await handle_undo_command(prompt[len("/undo"):])
+                continue
+
+            if prompt.startswith("/redo"):
+                await handle_undo_command(prompt[len("/redo"):], redo=True)
                 continue
 
             if prompt.startswith("/help"):
@@ -799,22 +4414,28 @@ async def main():
                 await change_model()
                 continue
 
+            if prompt.startswith("/bg "):
+                await handle_bg_command(default_chat_history, editor_chat_history, prompt[len("/bg "):])
+                continue
+
+            if prompt.startswith("/jobs"):
+                scheduler.print_jobs()
+                continue
+
+            if prompt.startswith("/wait"):
+                await scheduler.wait(prompt[len("/wait"):])
+                continue
+
+            if prompt.startswith("/cancel"):
+                await scheduler.cancel(prompt[len("/cancel"):])
+                continue
+
             if prompt.startswith("/show "):
-                filepath = prompt.split("/show ", 1)[1].strip()
-                await show_file_content(filepath)
+                await show_file_content(prompt.split("/show ", 1)[1])
                 continue
 
-            print_colored("\n🤖 Assistant:", Fore.BLUE)
             try:
-                default_chat_history.append({"role": "user", "content": prompt})
-                response = get_streaming_response(default_chat_history, DEFAULT_MODEL)
-                
-                # Store both content and reasoning in chat history
-                default_chat_history.append({
-                    "role": "assistant", 
-                    "content": response["content"],
-                    "reasoning": response["reasoning"] if response["reasoning"] else None
-                })
+                await handle_chat_prompt(default_chat_history, prompt, session_journal)
             except Exception as e:
                 print_colored(f"Error: {e}. Please try again.", Fore.RED)
 
@@ -822,5 +4443,19 @@ async def main():
             print_colored(f"An error occurred: {e}", Fore.RED)
             continue
 
+    await scheduler.cancel_all()
+    default_chat_history, _ = scheduler.merge(default_chat_history, editor_chat_history)
+    session_journal.sync(default_chat_history)
+    await close_http_client()
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Omni Engineer")
+    parser.add_argument("--batch", metavar="MANIFEST", help="Run the jobs of a JSONL manifest without prompting")
+    parser.add_argument("--report", default=BATCH_REPORT_PATH, help="Where the JSONL batch report is written")
+    parser.add_argument("--concurrency", type=int, default=BATCH_CONCURRENCY, help="Jobs run at once")
+    parser.add_argument("--retries", type=int, default=BATCH_RETRIES, help="Retries per model call on rate limits and network errors")
+    parser.add_argument("--dry-run", action="store_true", help="Report diffs without writing files")
+    args = parser.parse_args()
+    if args.batch:
+        sys.exit(asyncio.run(run_batch(args.batch, args.report, args.concurrency, args.retries, args.dry_run)))
     asyncio.run(main())
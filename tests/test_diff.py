@@ -0,0 +1,73 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+def apply_opcodes(a, b, opcodes):
+    result = []
+    for tag, i1, i2, j1, j2 in opcodes:
+        result.extend(a[i1:i2] if tag == "equal" else b[j1:j2])
+    return result
+
+
+def changed_lines(opcodes):
+    return sum(max(i2 - i1, j2 - j1) for tag, i1, i2, j1, j2 in opcodes if tag != "equal")
+
+
+def scattered_edits(lines, count, vocabulary, seed):
+    rng = random.Random(seed)
+    edited = list(lines)
+    for _ in range(count):
+        k = rng.randrange(len(edited))
+        op = rng.randrange(3)
+        if op == 0:
+            edited[k] = rng.choice(vocabulary) + "  # changed"
+        elif op == 1:
+            del edited[k]
+        else:
+            edited.insert(k, rng.choice(vocabulary))
+    return edited
+
+
+def test_small_edit():
+    a = ["def f():", "    return 1", "", "def g():", "    return 2"]
+    b = ["def f():", "    return 10", "", "def g():", "    return 2"]
+    opcodes = main.diff_opcodes(a, b)
+    assert apply_opcodes(a, b, opcodes) == b
+    assert changed_lines(opcodes) == 1
+
+
+def test_many_repeated_lines():
+    # No line is unique and the region is far too big for Myers' budget
+    vocabulary = ["", "}", "    pass", "    return None", "        break", "# ---", "{"]
+    rng = random.Random(0)
+    a = [rng.choice(vocabulary) for _ in range(20000)]
+    b = scattered_edits(a, 300, vocabulary, seed=1)
+    opcodes = main.diff_opcodes(a, b)
+    assert apply_opcodes(a, b, opcodes) == b
+    assert changed_lines(opcodes) < 1000
+
+
+def test_periodic_lines():
+    # Not even runs of lines are unique here
+    a = ["a", "b"] * 10000
+    b = list(a)
+    for k in range(0, len(b), 70):
+        b[k] = "z"
+    opcodes = main.diff_opcodes(a, b)
+    assert apply_opcodes(a, b, opcodes) == b
+    assert changed_lines(opcodes) < 1000
+
+
+def test_undo_patch_round_trip():
+    vocabulary = ["", "}", "    pass", "{"]
+    rng = random.Random(2)
+    old = "\n".join(rng.choice(vocabulary) for _ in range(5000))
+    new = "\n".join(scattered_edits(old.split("\n"), 50, vocabulary, seed=3))
+    patch = main.make_patch(new, old)
+    assert main.apply_patch(new, patch) == old
+    assert sum(end - start for start, end, _ in patch) < 500
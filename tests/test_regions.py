@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+CONTENT = "\n".join(f"value_{number} = {number}" for number in range(1, 201))
+
+
+@pytest.fixture(autouse=True)
+def no_context_lines(monkeypatch):
+    monkeypatch.setattr(main, "REGION_CONTEXT_LINES", 0)
+
+
+@pytest.mark.parametrize("instructions, regions", [
+    ("Fix lines 5 and 90", [(4, 4), (89, 89)]),
+    ("Fix lines 5, 90 and 150", [(4, 4), (89, 89), (149, 149)]),
+    ("Fix lines 5, and 90", [(4, 4), (89, 89)]),
+    ("Fix line 12", [(11, 11)]),
+])
+def test_lists_are_separate_lines(instructions, regions):
+    assert main.find_edit_regions(CONTENT, instructions) == regions
+
+
+@pytest.mark.parametrize("instructions, regions", [
+    ("Fix lines 5-9", [(4, 8)]),
+    ("Fix lines 5 – 9", [(4, 8)]),
+    ("Fix lines 5 to 9", [(4, 8)]),
+    ("Fix lines 5 through 9", [(4, 8)]),
+    ("Fix lines 5-9 and 90 to 92", [(4, 8), (89, 91)]),
+])
+def test_ranges(instructions, regions):
+    assert main.find_edit_regions(CONTENT, instructions) == regions
@@ -0,0 +1,56 @@
+import asyncio
+import contextlib
+import io
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+from benchmarks.mock_server import MockServer, encode_events, synthesize_events  # noqa: E402
+
+MESSAGES = [{"role": "system", "content": "sys"}, {"role": "user", "content": "hi"}]
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "is_response_cache_on", True)
+    monkeypatch.setattr(main, "response_cache", main.ResponseCache(str(tmp_path / "cache.sqlite")))
+    return main.response_cache
+
+
+def ask(capture):
+    async def run():
+        base_url = main.OPENROUTER_BASE_URL
+        async with MockServer(capture=capture) as server:
+            await main.close_http_client()
+            main.OPENROUTER_BASE_URL = server.base_url
+            try:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    return await main.get_streaming_response(MESSAGES, main.DEFAULT_MODEL)
+            finally:
+                main.OPENROUTER_BASE_URL = base_url
+                await main.close_http_client()
+
+    return asyncio.run(run())
+
+
+def test_complete_reply_is_cached(cache):
+    ask(b"".join(encode_events(synthesize_events("Hello there", reasoning_ratio=0.0))))
+    assert cache.stats()[0] == 1
+
+
+def test_error_stream_is_not_cached(cache):
+    error = {"error": {"code": 502, "message": "Provider returned error"}}
+    response = ask(f"data: {json.dumps(error)}\n\ndata: [DONE]\n\n".encode("utf-8"))
+    assert response["content"] == ""
+    assert cache.stats()[0] == 0
+
+
+def test_unfinished_stream_is_not_cached(cache):
+    events = encode_events(synthesize_events("Hello there", reasoning_ratio=0.0))
+    ask(b"".join(events[:-1]))  # Cut off before [DONE]
+    assert cache.stats()[0] == 0
@@ -0,0 +1,52 @@
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def small_blocks(monkeypatch):
+    monkeypatch.setattr(main.FileView, "BLOCK", 16)
+
+
+def view_of(tmp_path, content):
+    path = tmp_path / "file.txt"
+    path.write_bytes(content.encode("utf-8"))
+    return main.FileView(str(path))
+
+
+@pytest.mark.parametrize("content", ["a\nb", "a\nb\n", "", "a", "\n\n"])
+def test_read_lines(tmp_path, content):
+    expected = content.split("\n")
+    if content.endswith("\n") or not content:
+        expected.pop()
+    with view_of(tmp_path, content) as view:
+        assert view.read_lines(0, 10) == expected
+        for first in range(len(expected)):
+            assert view.read_lines(first, 10) == expected[first:]
+        assert view.count_lines() == len(expected)
+
+
+def test_no_trailing_newline(tmp_path):
+    with view_of(tmp_path, "a\nb") as view:
+        assert view.read_lines(1, 10) == ["b"]
+        assert view.search(re.compile(rb"b"), 0) == 1
+        assert view.read_lines(view.search(re.compile(rb"b"), 0), 1) == ["b"]
+
+
+@pytest.mark.parametrize("trailing", ["", "\n"])
+def test_random_access_across_blocks(tmp_path, small_blocks, trailing):
+    expected = [f"line {number} " + "x" * (number % 7) for number in range(200)]
+    with view_of(tmp_path, "\n".join(expected) + trailing) as view:
+        assert view.read_lines(199, 10) == expected[199:]
+        assert view.read_lines(150, 30) == expected[150:180]
+        assert view.read_lines(0, 5) == expected[:5]
+        assert view.count_lines() == len(expected)
+        assert view.search(re.compile(rb"line 199 "), 0) == 199
+        assert view.search(re.compile(rb"line 3 "), 100) == 3
+        assert view.search(re.compile(rb"missing"), 0) is None